@@ -1,10 +1,8 @@
 '''
 This file includes code that actually runs FastQC and any other tools after the fastq files have actually been made. This uses a pool of workers to process each request.
 '''
-import multiprocessing as mp
 import glob
 import sys
-import subprocess
 import os
 import os.path
 import shlex
@@ -12,11 +10,12 @@ import shutil
 import xml.etree.ElementTree as ET
 import syslog
 import csv
-import numpy as np
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-import matplotlib.image as img
+import functools
+from bcl2fastq_pipeline import ledger
+from bcl2fastq_pipeline import metrics
+from bcl2fastq_pipeline import profiling
+from bcl2fastq_pipeline.runner import runCommand
+from bcl2fastq_pipeline import executor
 
 '''
 Do we really need the md5sum?
@@ -24,16 +23,57 @@ Do we really need the md5sum?
 
 localConfig = None
 
+def sampleUnit(d) :
+    """(project, sample) for a sample directory"""
+    d = d.rstrip("/").split("/")
+    return d[-2], d[-1]
+
+def fileUnit(fname) :
+    """(project, sample/file) for a fastq file"""
+    fname = fname.split("/")
+    return fname[-3], "{}/{}".format(fname[-2], fname[-1])
+
+def projectUnit(d) :
+    """(project, "") for a project directory"""
+    return os.path.basename(d.rstrip("/")), ""
+
+def ledgerTask(stage, unit) :
+    '''
+    Record each call of a pool worker in the ledger, skipping those already done, and profile it if enabled
+    '''
+    def wrap(func) :
+        @functools.wraps(func)
+        def worker(arg) :
+            project, sample = unit(arg)
+            with profiling.profiled(localConfig, "{}_{}".format(stage, os.path.basename(arg.rstrip("/")))):
+                return ledger.runTask(localConfig, stage, func, arg, project=project, sample=sample)
+        # The batch executor records jobs in the ledger itself and runs func remotely
+        worker.ledgerStage = stage
+        worker.ledgerUnit = unit
+        return worker
+    return wrap
+
+def setLocalConfig(config) :
+    '''
+    Pool initializer, so each worker gets the config of the flow cell it's working on even if several are processed at once
+    '''
+    global localConfig
+    localConfig = config
+
 def bgzip_worker(fname) :
     global localConfig
     config = localConfig
-    cmd = "%s -r %s" % (
-        config.get("bgzip","bgzip_command"),
-        fname)
-    syslog.syslog("[bgzip_worker] Running %s\n" % cmd)
-    subprocess.check_call(cmd, shell=True)
+    cmd = shlex.split(config.get("bgzip","bgzip_command")) + ["-r", fname]
+    syslog.syslog("[bgzip_worker] Running %s\n" % " ".join(cmd))
+    runCommand(config, "bgzip", cmd, label=os.path.basename(fname))
 
 def plotFastqScreen(fname) :
+    # numpy and matplotlib are slow to import, so only load them in the workers that plot
+    import numpy as np
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
     species=[]
     ohol=[]
     mhol=[]
@@ -73,6 +113,7 @@ def plotFastqScreen(fname) :
     plt.savefig("%s.png" % fname.replace("_screen.txt","_screen"))
     plt.close()
 
+@ledgerTask("fastq_screen", fileUnit)
 def fastq_screen_worker(fname) :
     global localConfig
     config = localConfig
@@ -88,23 +129,19 @@ def fastq_screen_worker(fname) :
 
     #Subsample
     ofile=fname.replace("_R1.fastq.gz","subsampled.fastq")
-    cmd = "%s sample %s %s %s" % (
-        config.get("fastq_screen","seqtk_command"),
-        config.get("fastq_screen","seqtk_options"),
-        fname,
-        config.get("fastq_screen","seqtk_size"))
-    syslog.syslog("[fastq_screen_worker] Running %s\n" % cmd)
+    cmd = shlex.split(config.get("fastq_screen","seqtk_command")) + ["sample"] + \
+          shlex.split(config.get("fastq_screen","seqtk_options")) + \
+          [fname, config.get("fastq_screen","seqtk_size")]
+    syslog.syslog("[fastq_screen_worker] Running %s\n" % " ".join(cmd))
     o = open(ofile, "w")
-    subprocess.check_call(cmd, shell=True, stdout=o)
+    runCommand(config, "seqtk", cmd, label=bname, stdout=o)
     o.close()
 
     #fastq_screen
-    cmd = "%s %s '%s'" % (
-        config.get("fastq_screen", "fastq_screen_command"),
-        config.get("fastq_screen", "fastq_screen_options"),
-        ofile)
-    syslog.syslog("[fastq_screen_worker] Running %s\n" % cmd)
-    subprocess.check_call(cmd, shell=True)
+    cmd = shlex.split(config.get("fastq_screen", "fastq_screen_command")) + \
+          shlex.split(config.get("fastq_screen", "fastq_screen_options")) + [ofile]
+    syslog.syslog("[fastq_screen_worker] Running %s\n" % " ".join(cmd))
+    runCommand(config, "fastq_screen", cmd, label=bname)
 
     #Unlink/rename
     os.unlink(ofile)
@@ -113,6 +150,7 @@ def fastq_screen_worker(fname) :
     #Create the images
     plotFastqScreen(fname.replace("_R1.fastq.gz", "_R1_screen.txt"))
 
+@ledgerTask("FastQC", fileUnit)
 def FastQC_worker(fname) :
     global localConfig
     config = localConfig
@@ -122,15 +160,15 @@ def FastQC_worker(fname) :
 
     projectName = fname.split("/")[-3] #It's the penultimate directory
     libName = fname.split("/")[-2] #The last directory
-    cmd = "%s %s -o %s/%s%s/FASTQC_%s/%s %s" % (
-          config.get("FastQC","fastqc_command"),
-          config.get("FastQC","fastqc_options"),
-          config.get("Paths","outputDir"),
-          config.get("Options","runID"),
-          lanes,
-          projectName,
-          libName,
-          fname)
+    cmd = shlex.split(config.get("FastQC","fastqc_command")) + \
+          shlex.split(config.get("FastQC","fastqc_options")) + \
+          ["-o", "%s/%s%s/FASTQC_%s/%s" % (
+              config.get("Paths","outputDir"),
+              config.get("Options","runID"),
+              lanes,
+              projectName,
+              libName),
+           fname]
 
     # Skip if the output exists
     if os.path.exists("%s/%s%s/FASTQC_%s/%s/%s_fastqc.zip" % (config.get("Paths","outputDir"),
@@ -146,8 +184,8 @@ def FastQC_worker(fname) :
           lanes,
           projectName,
           libName), exist_ok=True)
-    syslog.syslog("[FastQC_worker] Running %s\n" % cmd)
-    subprocess.check_call(cmd, shell=True)
+    syslog.syslog("[FastQC_worker] Running %s\n" % " ".join(cmd))
+    runCommand(config, "FastQC", cmd, label=os.path.basename(fname))
 
 def toDirs(files) :
     s = set()
@@ -156,16 +194,20 @@ def toDirs(files) :
         s.add(d[:d.rfind('/')]) #We just want projects, not individual libraries
     return s
 
+@ledgerTask("md5sum", projectUnit)
 def md5sum_worker(d) :
     global localConfig
     config = localConfig
     oldWd = os.getcwd()
     os.chdir(d)
-    cmd = "md5sum */*.fastq.gz > md5sums.txt"
+    cmd = ["md5sum"] + sorted(glob.glob("*/*.fastq.gz"))
     syslog.syslog("[md5sum_worker] Processing %s\n" % d)
-    subprocess.check_call(cmd, shell=True)
+    o = open("md5sums.txt", "w")
+    runCommand(config, "md5sum", cmd, label=os.path.basename(d), stdout=o)
+    o.close()
     os.chdir(oldWd)
 
+@ledgerTask("multiqc", projectUnit)
 def multiqc_worker(d) :
     global localConfig
     config = localConfig
@@ -174,11 +216,12 @@ def multiqc_worker(d) :
     dname = d.split("/")
     dname[-1] = "FASTQC_{}".format(dname[-1])
     dname = "/".join(dname)
-    cmd = "{} {} {}/*/*.zip".format(config.get("MultiQC", "multiqc_command"), config.get("MultiQC", "multiqc_options"), dname)
+    cmd = shlex.split(config.get("MultiQC", "multiqc_command")) + shlex.split(config.get("MultiQC", "multiqc_options")) + sorted(glob.glob("{}/*/*.zip".format(dname)))
     syslog.syslog("[multiqc_worker] Processing %s\n" % d)
-    subprocess.check_call(cmd, shell=True)
+    runCommand(config, "multiqc", cmd, label=os.path.basename(d))
     os.chdir(oldWd)
 
+@ledgerTask("clumpify", sampleUnit)
 def clumpify_worker(d):
     global localConfig
     config = localConfig
@@ -193,31 +236,26 @@ def clumpify_worker(d):
     for r1 in read1s:
         # This takes a while, don't duplicate work
         if os.path.exists("{}.duplicate.txt".format(r1[:-12])):
-            os.chdir(oldWd)
-            return
+            continue
 
         r2 = "{}_R2.fastq.gz".format(r1[:-12])
         if os.path.exists(r2):
-            cmd = "{} in={} in2={} out=temp.fq.gz {} dupedist={} threads={}".format(config.get("bbmap", "clumpify_command"),
-                                                                                    r1, r2,
-                                                                                    config.get("bbmap", "clumpify_options"),
-                                                                                    dist,
-                                                                                    config.get("bbmap", "clumpify_threads"))
+            inputs = ["in={}".format(r1), "in2={}".format(r2)]
         else:
             PE = 0
-            cmd = "{} in={} out=temp.fq.gz {} dupedist={} threads={}".format(config.get("bbmap", "clumpify_command"),
-                                                                             r1,
-                                                                             config.get("bbmap", "clumpify_options"),
-                                                                             dist,
-                                                                             config.get("bbmap", "clumpify_threads"))
-        syslog.syslog("[clumpify_worker] Processing %s\n" % cmd)
-        subprocess.check_call(cmd, shell=True)
-        cmd = " ".join(["splitFastq", "temp.fq.gz", "{}".format(PE), r1[:-12], "{}".format(config.get("bbmap", "pigzThreads"))])
-        syslog.syslog("[clumpify_worker] Splitting %s\n" % cmd)
-        subprocess.check_call(cmd, shell=True)
+            inputs = ["in={}".format(r1)]
+        cmd = shlex.split(config.get("bbmap", "clumpify_command")) + inputs + ["out=temp.fq.gz"] + \
+              shlex.split(config.get("bbmap", "clumpify_options")) + \
+              ["dupedist={}".format(dist), "threads={}".format(config.get("bbmap", "clumpify_threads"))]
+        syslog.syslog("[clumpify_worker] Processing %s\n" % " ".join(cmd))
+        runCommand(config, "clumpify", cmd, label=r1[:-12])
+        cmd = ["splitFastq", "temp.fq.gz", "{}".format(PE), r1[:-12], "{}".format(config.get("bbmap", "pigzThreads"))]
+        syslog.syslog("[clumpify_worker] Splitting %s\n" % " ".join(cmd))
+        runCommand(config, "splitFastq", cmd, label=r1[:-12])
         os.remove("temp.fq.gz")
     os.chdir(oldWd)
 
+@ledgerTask("clumpifyNextSeq", sampleUnit)
 def clumpifyNextSeq_worker(d):
     global localConfig
     config = localConfig
@@ -229,30 +267,23 @@ def clumpifyNextSeq_worker(d):
     for r1 in read1s:
         # This takes a while, don't duplicate work
         if os.path.exists("{}.duplicate.txt".format(r1[:-12])):
-            os.chdir(oldWd)
-            return
+            continue
 
         r2 = "{}_R2.fastq.gz".format(r1[:-12])
         if os.path.exists(r2):
-            cmd = "{} in={} in2={} out=temp.fq.gz {} {} dupedist={} threads={}".format(config.get("bbmap", "clumpify_command"),
-                                                                                       r1, r2,
-                                                                                       config.get("bbmap", "clumpify_options"),
-                                                                                       config.get("bbmap", "clumpify_NextSeq_options"),
-                                                                                       config.get("bbmap", "clumpify_NextSeq_dist"),
-                                                                                       config.get("bbmap", "clumpify_threads"))
+            inputs = ["in={}".format(r1), "in2={}".format(r2)]
         else:
             PE = 0
-            cmd = "{} in={} out=temp.fq.gz {} {} dupedist={} threads={}".format(config.get("bbmap", "clumpify_command"),
-                                                                                r1,
-                                                                                config.get("bbmap", "clumpify_options"),
-                                                                                config.get("bbmap", "clumpify_NextSeq_options"),
-                                                                                config.get("bbmap", "clumpify_NextSeq_dist"),
-                                                                                config.get("bbmap", "clumpify_threads"))
-        syslog.syslog("[clumpify_worker] Processing %s\n" % cmd)
-        subprocess.check_call(cmd, shell=True)
-        cmd = " ".join(["splitFastq", "temp.fq.gz", "{}".format(PE), r1[:-12], "{}".format(config.get("bbmap", "pigzThreads"))])
-        syslog.syslog("[clumpify_worker] Splitting %s\n" % cmd)
-        subprocess.check_call(cmd, shell=True)
+            inputs = ["in={}".format(r1)]
+        cmd = shlex.split(config.get("bbmap", "clumpify_command")) + inputs + ["out=temp.fq.gz"] + \
+              shlex.split(config.get("bbmap", "clumpify_options")) + \
+              shlex.split(config.get("bbmap", "clumpify_NextSeq_options")) + \
+              ["dupedist={}".format(config.get("bbmap", "clumpify_NextSeq_dist")), "threads={}".format(config.get("bbmap", "clumpify_threads"))]
+        syslog.syslog("[clumpify_worker] Processing %s\n" % " ".join(cmd))
+        runCommand(config, "clumpify", cmd, label=r1[:-12])
+        cmd = ["splitFastq", "temp.fq.gz", "{}".format(PE), r1[:-12], "{}".format(config.get("bbmap", "pigzThreads"))]
+        syslog.syslog("[clumpify_worker] Splitting %s\n" % " ".join(cmd))
+        runCommand(config, "splitFastq", cmd, label=r1[:-12])
         os.remove("temp.fq.gz")
     os.chdir(oldWd)
 
@@ -310,61 +341,51 @@ def postMakeSteps(config) :
       1) Run FastQC on each fastq.gz file
       2) Run md5sum on the files in each project directory
     Other steps could easily be added to follow those. Note that this function
-    will try to use a pool of threads. The size of the pool is set by config.postMakeThreads
+    will try to use a pool of threads. The size of the pool is set by config.postMakeThreads.
+    Alternatively, the work can be submitted as batch jobs (see executor.py).
+
+    The time taken by each pool is recorded (see metrics.py).
     '''
     lanes = config.get("Options", "lanes")
     if lanes != "": 
         lanes = "_lanes{}".format(lanes)
+    odir = "%s/%s%s" % (config.get("Paths","outputDir"), config.get("Options","runID"), lanes)
 
     projectDirs = glob.glob("%s/%s%s/Project_*/*/*.fastq.gz" % (config.get("Paths","outputDir"), config.get("Options","runID"), lanes))
     projectDirs = toDirs(projectDirs)
     sampleFiles = glob.glob("%s/%s%s/Project_*/*/*.fastq.gz" % (config.get("Paths","outputDir"),config.get("Options","runID"), lanes))
-    global localConfig
-    localConfig = config
 
     #Deduplicate if this is a HiSeq 3000 run
     if config.get("Options", "runID")[7] in ["J", "A"]:
         sampleDirs = glob.glob("%s/%s%s/Project_*/*/*_R1.fastq.gz" % (config.get("Paths","outputDir"),config.get("Options","runID"), lanes))
         sampleDirs = [os.path.dirname(x) for x in sampleDirs]
-        p = mp.Pool(int(config.get("Options", "deduplicateInstances")))
-        p.map(clumpify_worker, sampleDirs)
-        p.close()
-        p.join()
+        with metrics.timed(config, "clumpify", path=odir, tasks=len(sampleDirs), workers=int(config.get("Options", "deduplicateInstances"))):
+            executor.mapWorkers(config, clumpify_worker, sampleDirs, int(config.get("Options", "deduplicateInstances")), setLocalConfig)
     #Different deduplication for NextSeq samples
     elif config.get("Options", "runID")[7:9] == "NB":
         sampleDirs = glob.glob("%s/%s%s/Project_*/*/*_R1.fastq.gz" % (config.get("Paths","outputDir"),config.get("Options","runID"), lanes))
         sampleDirs = [os.path.dirname(x) for x in sampleDirs]
-        p = mp.Pool(int(config.get("Options", "deduplicateInstances")))
-        p.map(clumpifyNextSeq_worker, sampleDirs)
-        p.close()
-        p.join()
+        with metrics.timed(config, "clumpifyNextSeq", path=odir, tasks=len(sampleDirs), workers=int(config.get("Options", "deduplicateInstances"))):
+            executor.mapWorkers(config, clumpifyNextSeq_worker, sampleDirs, int(config.get("Options", "deduplicateInstances")), setLocalConfig)
 
     # Avoid running post-processing (in case of a previous error) on optical duplicate files.
     sampleFiles = [x for x in sampleFiles if "optical_duplicates" not in x]
 
     #FastQC
-    p = mp.Pool(int(config.get("Options","postMakeThreads")))
-    p.map(FastQC_worker, sampleFiles)
-    p.close()
-    p.join()
+    with metrics.timed(config, "FastQC", path=odir, tasks=len(sampleFiles), workers=int(config.get("Options", "postMakeThreads"))):
+        executor.mapWorkers(config, FastQC_worker, sampleFiles, int(config.get("Options","postMakeThreads")), setLocalConfig)
 
     #md5sum
-    p = mp.Pool(int(config.get("Options","postMakeThreads")))
-    p.map(md5sum_worker, projectDirs)
-    p.close()
-    p.join()
+    with metrics.timed(config, "md5sum", path=odir, tasks=len(projectDirs), workers=int(config.get("Options", "postMakeThreads"))):
+        executor.mapWorkers(config, md5sum_worker, projectDirs, int(config.get("Options","postMakeThreads")), setLocalConfig)
 
     #fastq_screen
-    p = mp.Pool(int(config.get("Options", "postMakeThreads")))
-    p.map(fastq_screen_worker, sampleFiles)
-    p.close()
-    p.join()
+    with metrics.timed(config, "fastq_screen", path=odir, tasks=len(sampleFiles), workers=int(config.get("Options", "postMakeThreads"))):
+        executor.mapWorkers(config, fastq_screen_worker, sampleFiles, int(config.get("Options", "postMakeThreads")), setLocalConfig)
 
     # multiqc
-    p = mp.Pool(int(config.get("Options","postMakeThreads")))
-    p.map(multiqc_worker, projectDirs)
-    p.close()
-    p.join()
+    with metrics.timed(config, "multiqc", path=odir, tasks=len(projectDirs), workers=int(config.get("Options", "postMakeThreads"))):
+        executor.mapWorkers(config, multiqc_worker, projectDirs, int(config.get("Options","postMakeThreads")), setLocalConfig)
 
     #disk usage
     (tot,used,free) = shutil.disk_usage(config.get("Paths","outputDir"))
@@ -0,0 +1,199 @@
+'''
+An on-disk cache of the barcode frequencies from pyBarcodes.getStatsMulti().
+
+handleRevComp() decodes the index cycles of every lane to check the barcode
+orientation, which is slow (particularly on MiSeqs) and used to be repeated
+after every restart, after every error and for each sample sheet of a flow
+cell. The frequencies of each lane are now kept under [Paths]->barcodeCache
+(outputDir/barcodeCache by default), in a small binary file per run folder,
+lane, set of cycles and sampling options.
+
+Each file name includes a hash of the size and mtime of every BCL and filter
+file that's read (and the pyBarcodes version), so a lane is decoded again if
+any of them change, e.g., while the run is still being written. Older files
+for the same lane, cycles and options are then removed. A run's files are
+removed once all of its lane groups have been processed (see markFinished())
+and when the space manager evicts one of its output directories.
+
+File format (little endian): b"BFQB", the format version (uint8) and the
+number of barcodes (uint32), then for each barcode its length (uint8), the
+barcode and its frequency (float32).
+
+A lane often needs several sets of cycles, one per barcode mask (e.g., 8,8
+and 10,10), possibly from different sample sheets. getStatsMasks() then
+decodes the union of the cycles once and has pyBarcodes count the barcodes
+over each set of cycles (its masks option) before any are converted to
+python objects. The results are still cached per set of cycles.
+'''
+import os
+import glob
+import json
+import shutil
+import struct
+import syslog
+import hashlib
+import pyBarcodes
+from pyBarcodes import getStatsMulti
+
+MAGIC = b"BFQB"
+VERSION = 1
+
+
+def cacheDir(config):
+    '''
+    [Paths]->barcodeCache, or outputDir/barcodeCache by default
+    '''
+    p = config.get("Paths", "barcodeCache", fallback="")
+    if p == "":
+        p = os.path.join(config.get("Paths", "outputDir"), "barcodeCache")
+    return p
+
+
+def removeRun(config, runID):
+    '''
+    Remove the cached frequencies of a run folder
+    '''
+    d = os.path.join(cacheDir(config), runID)
+    if os.path.isdir(d):
+        shutil.rmtree(d, ignore_errors=True)
+
+
+def bclFiles(basePath, runType, lane, cycles):
+    '''
+    The BCL and filter files getStats() reads for a lane
+    '''
+    bc = os.path.join(basePath, "Data", "Intensities", "BaseCalls")
+    if runType == "NextSeq":
+        files = [os.path.join(bc, "L001", "s_1.filter")]
+        files.extend(os.path.join(bc, "L001", "{:04d}.bcl.bgzf".format(c)) for c in cycles)
+        return files
+    if runType == "MiSeq":
+        lane = 1
+    laneDir = os.path.join(bc, "L{:03d}".format(lane))
+    files = []
+    if runType != "NovaSeq":
+        files.extend(glob.glob(os.path.join(laneDir, "*.filter")))
+    for c in cycles:
+        files.extend(glob.glob(os.path.join(laneDir, "C{}.1".format(c), "*")))
+    return files
+
+
+def fingerprint(basePath, runType, lane, cycles):
+    '''
+    A hash of the names, sizes and mtimes of the files read for a lane
+    '''
+    h = hashlib.sha1()
+    for f in sorted(bclFiles(basePath, runType, lane, cycles)):
+        try:
+            st = os.stat(f)
+        except OSError:
+            continue
+        h.update("{}\t{}\t{}\n".format(os.path.relpath(f, basePath), st.st_size, st.st_mtime_ns).encode())
+    h.update(pyBarcodes.__version__.encode())
+    return h.hexdigest()[:16]
+
+
+def cachePrefix(config, basePath, runType, lane, cycles, kwargs):
+    '''
+    The cache file name without the fingerprint. threads doesn't change the results, so it isn't part of this.
+    '''
+    opts = {k: v for k, v in kwargs.items() if k != "threads"}
+    key = json.dumps([runType, list(cycles), sorted(opts.items())])
+    return os.path.join(cacheDir(config), os.path.basename(basePath.rstrip("/")),
+                        "L{}.{}".format(lane, hashlib.sha1(key.encode()).hexdigest()[:16]))
+
+
+def load(fname):
+    '''
+    The barcode frequencies in a cache file, or None if it doesn't exist or can't be read
+    '''
+    try:
+        f = open(fname, "rb")
+    except OSError:
+        return None
+    try:
+        data = f.read()
+        if data[:4] != MAGIC or data[4] != VERSION:
+            return None
+        n = struct.unpack_from("<I", data, 5)[0]
+        offset = 9
+        rv = dict()
+        for i in range(n):
+            length = data[offset]
+            bc = data[offset + 1:offset + 1 + length].decode("ascii")
+            rv[bc] = struct.unpack_from("<f", data, offset + 1 + length)[0]
+            offset += 5 + length
+        return rv
+    except (IndexError, struct.error, UnicodeDecodeError):
+        return None
+    finally:
+        f.close()
+
+
+def store(prefix, fname, barcodes):
+    '''
+    Atomically write the barcode frequencies of a lane, removing older versions
+    '''
+    os.makedirs(os.path.dirname(fname), exist_ok=True)
+    parts = [MAGIC, struct.pack("<BI", VERSION, len(barcodes))]
+    for bc, freq in barcodes.items():
+        b = bc.encode("ascii")
+        parts.append(struct.pack("<B", len(b)) + b + struct.pack("<f", freq))
+    tmp = "{}.{}.tmp".format(fname, os.getpid())
+    f = open(tmp, "wb")
+    f.write(b"".join(parts))
+    f.close()
+    os.replace(tmp, fname)
+    for old in glob.glob("{}.*.bcs".format(prefix)):
+        if old != fname:
+            try:
+                os.remove(old)
+            except OSError:
+                pass
+
+
+def decodeMasks(basePath, runType, cycleSets, lanes, **kwargs):
+    '''
+    getStatsMulti() for each of cycleSets, with each lane decoded only once.
+    Returns a list per lane with a dictionary per set of cycles.
+    '''
+    union = sorted(set().union(*cycleSets))
+    if all(list(cycles) == union for cycles in cycleSets):
+        return [[barcodes] * len(cycleSets) for barcodes in getStatsMulti(basePath, runType, union, lanes=lanes, **kwargs)]
+
+    masks = [list(cycles) for cycles in cycleSets]
+    return getStatsMulti(basePath, runType, union, lanes=lanes, masks=masks, **kwargs)
+
+
+def getStatsMasks(config, basePath, runType, cycleSets, lanes, **kwargs):
+    '''
+    decodeMasks(basePath, runType, cycleSets, lanes, **kwargs), except that
+    what's already in the cache isn't decoded again. Returns the list (one per
+    lane) of lists of dictionaries (one per set of cycles) and the number of
+    lanes found entirely in the cache.
+    '''
+    rv = dict()
+    files = dict()
+    for lane in lanes:
+        rv[lane] = []
+        for i, cycles in enumerate(cycleSets):
+            prefix = cachePrefix(config, basePath, runType, lane, cycles, kwargs)
+            fname = "{}.{}.bcs".format(prefix, fingerprint(basePath, runType, lane, cycles))
+            files[lane, i] = (prefix, fname)
+            rv[lane].append(load(fname))
+
+    missing = [lane for lane in lanes if None in rv[lane]]
+    nCached = len(lanes) - len(missing)
+    if len(missing) > 0:
+        # Only the sets of cycles that aren't cached for some lane are decoded
+        idx = sorted({i for lane in missing for i in range(len(cycleSets)) if rv[lane][i] is None})
+        for lane, decoded in zip(missing, decodeMasks(basePath, runType, [cycleSets[i] for i in idx], missing, **kwargs)):
+            for i, barcodes in zip(idx, decoded):
+                if rv[lane][i] is not None:
+                    continue
+                rv[lane][i] = barcodes
+                try:
+                    store(files[lane, i][0], files[lane, i][1], barcodes)
+                except OSError:
+                    syslog.syslog("[barcodeCache] Couldn't write {}\n".format(files[lane, i][1]))
+    return [rv[lane] for lane in lanes], nCached
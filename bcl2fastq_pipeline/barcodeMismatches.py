@@ -0,0 +1,149 @@
+'''
+Choose bcl2fastq's --barcode-mismatches before running it.
+
+bcl2fq() used to start with 2 mismatches and, if bcl2fastq failed (usually on
+a barcode collision), start over with 1 and then 0. On a NovaSeq run each
+failed attempt could take hours before bcl2fastq reported the collision.
+
+bcl2fastq allows the mismatches in each index read separately, so two samples
+in a lane collide if, for every index read, their barcodes are within twice
+the number of mismatches of each other. maxMismatches() therefore returns the
+largest value (up to 2) for which every pair of samples in each lane of the
+rewritten sample sheet has an index read whose barcodes differ at more than
+twice that many positions. Index bases masked out by [Options]->index_mask
+(e.g., the last base with I6n) aren't compared, since bcl2fastq ignores them.
+
+The barcodes of a lane are encoded as an (samples x bases) uint8 array, and
+the Hamming distances of all pairs are computed at once for each index read
+by broadcasting it against itself.
+'''
+import re
+import csv
+import codecs
+import syslog
+
+# bcl2fastq's largest (and the pipeline's default) --barcode-mismatches
+MAX_MISMATCHES = 2
+CODES = {"A": 1, "C": 2, "G": 3, "T": 4}
+
+
+def encodeBarcodes(barcodes):
+    '''
+    The barcodes (strings of the same length) as a uint8 array with a row per
+    barcode (anything but A, C, G or T is 0)
+    '''
+    import numpy as np
+    return np.array([[CODES.get(b, 0) for b in bc] for bc in barcodes], dtype="uint8")
+
+
+def maskedLengths(mask, bcLens):
+    '''
+    bcLens, with each index cut to the number of bases that mask (a
+    --use-bases-mask, e.g., I6n or Y*,I8,I8n,Y*) reads from it. Indices that
+    mask doesn't cover (or that it reads with I*) are left as they are.
+    '''
+    # Lane-specific masks look like 1:Y*,I6n,Y*, only the first is used
+    mask = re.sub(r"^[0-9]+:", "", mask.strip().split(" ")[0])
+    reads = [x for x in mask.split(",") if x != "" and "y" not in x.lower()]
+    rv = list(bcLens)
+    for i, read in enumerate(reads[:len(rv)]):
+        used = 0
+        for base, count in re.findall(r"([IiNn])([0-9]+|\*)?", read):
+            if base not in "Ii":
+                continue
+            if count == "*":
+                used = None
+                break
+            used += int(count) if count else 1
+        if used is not None:
+            rv[i] = min(rv[i], used)
+    return rv
+
+
+def readBarcodes(fname, bcLens, lanes=None):
+    '''
+    A dictionary with lanes (None if there's no Lane column) as keys and
+    lists of (sample, index1+index2) as values, from the [Data] section of a
+    sample sheet. Each index is cut to its length in bcLens. If lanes (a
+    list of strings) is given, other lanes are skipped.
+    '''
+    rv = dict()
+    header = None
+    inData = False
+    for line in csv.reader(codecs.open(fname, "r", "iso-8859-1")):
+        if len(line) == 0 or line[0].strip() == "":
+            continue
+        if line[0].startswith("["):
+            inData = line[0].startswith("[Data]")
+            header = None
+            continue
+        if not inData:
+            continue
+        if header is None:
+            header = line
+            continue
+
+        row = dict(zip(header, [x.strip() for x in line]))
+        lane = row.get("Lane")
+        if lanes and lane is not None and lane not in lanes:
+            continue
+        # Shorter barcodes are padded with Ns, so the indices line up
+        bc = row.get("index", "")[:bcLens[0]].ljust(bcLens[0], "N")
+        if len(bcLens) > 1 and bcLens[1] > 0:
+            bc += row.get("index2", "")[:bcLens[1]].ljust(bcLens[1], "N")
+        rv.setdefault(lane, []).append((row.get("Sample_ID", ""), bc.upper()))
+    return rv
+
+
+def laneMismatches(barcodes, bcLens):
+    '''
+    The most mismatches that don't cause a collision between any of the
+    barcodes of a lane, as (mismatches, colliding pair or None)
+    '''
+    # numpy is slow to import, and makeFastq and the orchestrator import this module
+    import numpy as np
+    if len(barcodes) < 2:
+        return MAX_MISMATCHES, None
+    codes = encodeBarcodes([bc for sample, bc in barcodes])
+
+    # The largest distance of any index read between each pair of barcodes
+    d = np.zeros((len(barcodes), len(barcodes)), dtype="int64")
+    start = 0
+    for l in bcLens:
+        if l > 0:
+            idx = codes[:, start:start + l]
+            d = np.maximum(d, (idx[:, None, :] != idx[None, :, :]).sum(axis=2))
+        start += l
+
+    # Distinguishable with m mismatches if some index differs at more than 2m bases
+    i, j = np.triu_indices(len(barcodes), k=1)
+    m = np.maximum(0, (d[i, j] - 1) // 2)
+    first = int(np.argmin(m))
+    if m[first] >= MAX_MISMATCHES:
+        return MAX_MISMATCHES, None
+    return int(m[first]), (barcodes[i[first]][0], barcodes[j[first]][0])
+
+
+def maxMismatches(config):
+    '''
+    The --barcode-mismatches to give bcl2fastq for the (rewritten) sample
+    sheet in config, or MAX_MISMATCHES if there's no sample sheet or index
+    '''
+    ss = config.get("Options", "sampleSheet")
+    if ss == "":
+        return MAX_MISMATCHES
+    bcLens = [int(x) for x in config.get("Options", "bcLen").split(",")]
+    mask = config.get("Options", "index_mask", fallback="")
+    if mask != "":
+        bcLens = maskedLengths(mask, bcLens)
+    if sum(bcLens) == 0:
+        return MAX_MISMATCHES
+    lanes = [x for x in config.get("Options", "lanes").split("_") if x != ""]
+
+    rv = MAX_MISMATCHES
+    for lane, barcodes in readBarcodes(ss, bcLens, lanes).items():
+        m, pair = laneMismatches(barcodes, bcLens)
+        if m < rv:
+            rv = m
+            syslog.syslog("[maxMismatches] Samples {} and {} in lane {} limit --barcode-mismatches to {}\n".format(pair[0], pair[1], lane, m))
+    return rv
@@ -0,0 +1,237 @@
+'''
+Run the postMakeSteps workers in a local pool or as batch jobs on other nodes.
+
+[Executor]->backend (or backend_<stage>, e.g., backend_clumpify) selects how
+the workers of a stage (clumpify, clumpifyNextSeq, FastQC, md5sum,
+fastq_screen and multiqc) are run:
+
+  * local: a multiprocessing.Pool on this host, as before
+  * batch: one job per work unit (sample, file or project), submitted with
+    [Executor]->submitCommand. Jobs are polled every pollInterval seconds
+    with statusCommand and cancelled with cancelCommand if processing the
+    flow cell is interrupted.
+
+Each batch job runs "python -m bcl2fastq_pipeline.executor" with a copy of the
+flow cell's config, calls the worker and writes its result (or error) to a
+JSON file next to the job script in logDir/<runID><lanes>/jobs/, from where
+it's collected. The task ledger is updated here rather than in the jobs, since
+sqlite shouldn't be shared across hosts. The output and tool paths must
+therefore be the same on every node.
+
+In the command templates, {name}, {script}, {log}, {jobID} and {options}
+([Executor]->submitOptions or submitOptions_<stage>) are replaced. The job ID
+is the first word printed by submitCommand (up to any ";", as printed by
+sbatch --parsable). A job is considered finished once its result file exists,
+and failed if statusCommand fails or prints nothing for 3 polls in a row
+without a result file appearing. bin/fakeBatch.py implements these commands
+locally, for trying this out without a cluster.
+'''
+import os
+import re
+import sys
+import json
+import time
+import shlex
+import syslog
+import traceback
+import importlib
+import subprocess
+import configparser
+import multiprocessing as mp
+from bcl2fastq_pipeline import ledger
+from bcl2fastq_pipeline.metrics import runName
+
+# Polls without a job or result file before a job is considered lost
+MISSING_POLLS = 3
+
+
+def setting(config, name, stage, default=""):
+    '''
+    [Executor]->name_stage, falling back to [Executor]->name
+    '''
+    return config.get("Executor", "{}_{}".format(name, stage), fallback=config.get("Executor", name, fallback=default))
+
+
+def backend(config, stage):
+    return setting(config, "backend", stage, "local")
+
+
+def localMap(config, worker, args, processes, initializer):
+    p = mp.Pool(processes, initializer=initializer, initargs=(config,))
+    try:
+        return p.map(worker, args)
+    finally:
+        p.close()
+        p.join()
+
+
+def runTemplate(config, command, **kwargs):
+    '''
+    Run one of the submit/status/cancel commands. Returns (exit code, stdout)
+    '''
+    cmd = shlex.split(config.get("Executor", command).format(**kwargs))
+    try:
+        res = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, timeout=300)
+    except subprocess.TimeoutExpired:
+        return 1, ""
+    return res.returncode, res.stdout
+
+
+class BatchJob(object):
+    def __init__(self, config, worker, arg, idx, d, configFile):
+        self.arg = arg
+        self.idx = idx
+        self.stage = worker.ledgerStage
+        self.project, self.sample = worker.ledgerUnit(arg)
+        self.started = None
+        self.jobID = None
+        self.finished = False
+        self.missing = 0
+
+        label = re.sub(r"[^\w.-]", "_", os.path.basename(arg.rstrip("/")))
+        prefix = os.path.join(d, "{}.{}.{}".format(self.stage, idx, label))
+        self.name = "bfq_{}_{}".format(self.stage, label)
+        self.script = "{}.sh".format(prefix)
+        self.log = "{}.log".format(prefix)
+        self.resultFile = "{}.json".format(prefix)
+        if os.path.exists(self.resultFile):
+            os.remove(self.resultFile)
+
+        f = open(self.script, "w")
+        f.write("#!/bin/sh\n")
+        f.write("cd {}\n".format(shlex.quote(os.getcwd())))
+        f.write("exec {} -m bcl2fastq_pipeline.executor {} {} {} {} {}\n".format(
+            shlex.quote(config.get("Executor", "python", fallback="") or sys.executable),
+            shlex.quote(configFile),
+            shlex.quote(worker.__module__),
+            shlex.quote(worker.__name__),
+            shlex.quote(arg),
+            shlex.quote(self.resultFile)))
+        f.close()
+        os.chmod(self.script, 0o750)
+
+    def submit(self, config):
+        rv, out = runTemplate(config, "submitCommand", name=self.name, script=self.script, log=self.log,
+                              options=setting(config, "submitOptions", self.stage))
+        if rv != 0 or out.strip() == "":
+            raise RuntimeError("Couldn't submit {} (exit code {})".format(self.script, rv))
+        self.jobID = out.split()[0].split(";")[0]
+        syslog.syslog("[executor] Submitted {} as job {}\n".format(self.name, self.jobID))
+
+    def poll(self, config):
+        '''
+        Returns the result dictionary once the job has finished, otherwise None
+        '''
+        if os.path.exists(self.resultFile):
+            self.finished = True
+            return json.load(open(self.resultFile))
+        rv, out = runTemplate(config, "statusCommand", jobID=self.jobID, name=self.name)
+        if rv != 0 or out.strip() == "":
+            self.missing += 1
+            if self.missing >= MISSING_POLLS:
+                self.finished = True
+                return {"exitCode": 1, "result": None, "error": "Job {} finished without a result, see {}".format(self.jobID, self.log)}
+        else:
+            self.missing = 0
+        return None
+
+    def cancel(self, config):
+        if self.jobID is not None and not self.finished:
+            syslog.syslog("[executor] Cancelling job {}\n".format(self.jobID))
+            runTemplate(config, "cancelCommand", jobID=self.jobID, name=self.name)
+
+
+def batchMap(config, worker, args):
+    '''
+    Submit a job per argument and wait for them all. Like Pool.map(), the
+    results are returned in order and an exception is raised if any failed
+    (once all have finished).
+    '''
+    d = os.path.join(config.get("Paths", "logDir"), runName(config), "jobs")
+    os.makedirs(d, exist_ok=True)
+    configFile = os.path.join(d, "{}.ini".format(worker.ledgerStage))
+    #This has the Parkour and Galaxy passwords, so it's never readable by anyone else, even while being written
+    fd = os.open(configFile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    os.fchmod(fd, 0o600)
+    with os.fdopen(fd, "w") as f:
+        config.write(f)
+
+    results = [None] * len(args)
+    pending = []
+    errors = []
+    try:
+        for idx, arg in enumerate(args):
+            job = BatchJob(config, worker, arg, idx, d, configFile)
+            done, rv = ledger.claimTask(config, job.stage, project=job.project, sample=job.sample, inputs=[arg])
+            if done:
+                results[idx] = rv
+                continue
+            job.started = rv
+            job.submit(config)
+            pending.append(job)
+
+        interval = float(config.get("Executor", "pollInterval", fallback="30"))
+        while len(pending) > 0:
+            time.sleep(interval)
+            for job in list(pending):
+                rv = job.poll(config)
+                if rv is None:
+                    continue
+                pending.remove(job)
+                if rv["exitCode"] == 0:
+                    results[job.idx] = rv["result"]
+                    ledger.finishTask(config, job.stage, job.started, project=job.project, sample=job.sample, inputs=[job.arg], result=rv["result"])
+                else:
+                    errors.append("{} of {}: {}".format(job.stage, job.arg, rv["error"]))
+                    ledger.finishTask(config, job.stage, job.started, project=job.project, sample=job.sample, inputs=[job.arg], error=rv["error"])
+    except:
+        for job in pending:
+            job.cancel(config)
+        raise
+
+    if len(errors) > 0:
+        raise RuntimeError("{} job(s) failed:\n{}".format(len(errors), "\n".join(errors)))
+    return results
+
+
+def mapWorkers(config, worker, args, processes, initializer):
+    '''
+    Run worker on each of args with the configured backend. processes and
+    initializer (which is passed config) are used by the local pool.
+    '''
+    args = list(args)
+    if backend(config, worker.ledgerStage) == "batch":
+        return batchMap(config, worker, args)
+    return localMap(config, worker, args, processes, initializer)
+
+
+def runRemote(configFile, module, name, arg, resultFile):
+    '''
+    The entry point of a batch job
+    '''
+    config = configparser.ConfigParser()
+    config.read(configFile)
+    m = importlib.import_module(module)
+    m.setLocalConfig(config)
+    worker = getattr(m, name)
+
+    from bcl2fastq_pipeline import profiling
+    rv = {"exitCode": 0, "result": None, "error": None}
+    try:
+        with profiling.profiled(config, "{}_{}".format(worker.ledgerStage, os.path.basename(arg.rstrip("/")))):
+            rv["result"] = worker.__wrapped__(arg)
+    except:
+        traceback.print_exc()
+        rv["exitCode"] = 1
+        rv["error"] = "{}: {}".format(sys.exc_info()[0].__name__, sys.exc_info()[1])
+
+    # Written atomically, since its presence means that the job is done
+    f = open("{}.tmp".format(resultFile), "w")
+    json.dump(rv, f)
+    f.close()
+    os.replace("{}.tmp".format(resultFile), resultFile)
+    return rv["exitCode"]
+
+
+if __name__ == "__main__":
+    sys.exit(runRemote(*sys.argv[1:]))
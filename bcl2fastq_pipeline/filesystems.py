@@ -0,0 +1,29 @@
+'''
+Which filesystem a path is on.
+
+The watcher and the ledger both behave differently on network filesystems
+(NFS, CIFS, ...): inotify doesn't see changes made by other hosts and sqlite's
+WAL mode doesn't work there.
+'''
+import os
+
+NETWORK_FS = ["nfs", "nfs4", "cifs", "smbfs", "smb3", "fuse.sshfs", "lustre", "gpfs", "beegfs", "afs"]
+
+
+def getFsType(path):
+    '''
+    Return the filesystem type of the mount holding path, or None if /proc/mounts can't be read
+    '''
+    path = os.path.realpath(path)
+    best = ""
+    fsType = None
+    try:
+        for line in open("/proc/mounts"):
+            cols = line.split()
+            mnt = cols[1].replace("\\040", " ")
+            if (path == mnt or path.startswith(mnt.rstrip("/") + "/")) and len(mnt) > len(best):
+                best = mnt
+                fsType = cols[2]
+    except OSError:
+        return None
+    return fsType
@@ -8,9 +8,26 @@ such as marking it as having been processed and sending emails.
 import os
 import sys
 import glob
+import fnmatch
 import syslog
 import xml.etree.ElementTree as ET
-from pyBarcodes import getStats
+from bcl2fastq_pipeline import runRegistry
+from bcl2fastq_pipeline import barcodeCache
+from bcl2fastq_pipeline import metrics
+from bcl2fastq_pipeline import profiling
+
+# Run folders from these machines are processed
+RUN_PATTERNS = ["*_SN*_*", "*_NB*_*", "*_M*_*", "*_J*_*", "*_A*_*"]
+
+
+def outputName(config):
+    '''
+    The name of the output directory for a flow cell, e.g., 150416_SN7001180_0196_BC605HACXX_lanes1_2
+    '''
+    lanes = config.get("Options", "lanes")
+    if lanes != "":
+        lanes = "_lanes{}".format(lanes)
+    return "{}{}".format(config.get("Options", "runID"), lanes)
 
 
 #Returns True on processed, False on unprocessed
@@ -134,12 +151,114 @@ def getReadLengths(basePath):
     return offsets[1:]
 
 
-def handleRevComp(d, basePath):
+def getRunType(basePath):
+    """
+    The run type, as used by pyBarcodes.getStats(), from the machine ID in the run folder name
+    """
+    machine = os.path.split(basePath.rstrip("/"))[1].split("_")[1]
+    if machine[0] == 'N':
+        return "NextSeq"
+    elif machine[0] == 'M':
+        return "MiSeq"
+    elif machine[0] == 'S':
+        return "HiSeq2500"
+    elif machine[0] == 'A':
+        return "NovaSeq"
+    return "HiSeq3000"
+
+
+# [Options] keys for getStatsMulti()'s keyword arguments
+BARCODE_OPTIONS = [("barcodeThreads", "threads", int),
+                   ("barcodeSampleSize", "sampleSize", int),
+                   ("barcodeThreshold", "threshold", float),
+                   ("barcodeTileStride", "tileStride", int),
+                   ("barcodeRandomTiles", "randomTiles", int),
+                   ("barcodeBothSurfaces", "bothSurfaces", bool)]
+
+
+def barcodeSampling(config, runType):
+    """
+    The keyword arguments to getStatsMulti() for a run type, from
+    [Options]->barcode<Option>_<runType> (e.g., barcodeTileStride_NovaSeq) or
+    else [Options]->barcode<Option>. Options that are unset or blank keep
+    pyBarcodes' defaults.
+    """
+    rv = dict()
+    for key, arg, conv in BARCODE_OPTIONS:
+        val = config.get("Options", "{}_{}".format(key, runType), fallback=config.get("Options", key, fallback="")).strip()
+        if val == "":
+            continue
+        if conv is bool:
+            rv[arg] = config.BOOLEAN_STATES[val.lower()]
+        else:
+            rv[arg] = conv(val)
+    return rv
+
+
+def indexCycles(readOffsets, mask):
+    """
+    The cycles of the barcodes in a mask (e.g., '8,8'), given the read offsets from getReadLengths()
+    """
+    cycles = list(range(readOffsets[0], readOffsets[0] + int(mask.split(",")[0])))
+    cycles.extend(list(range(readOffsets[1], readOffsets[1] + int(mask.split(",")[1]))))
+    return cycles
+
+
+def maskBarcodes(basePath, sheets, config=None):
+    """
+    The observed barcode frequencies handleRevComp() needs for each of
+    sheets (dictionaries like its input), as a dictionary with (lane, mask)
+    keys. Each lane is decoded once for all of the masks it's used with,
+    with all lanes using the same masks decoded at once, each in its own
+    thread (see barcodeCache.decodeMasks()).
+
+    If config is given, the time taken is recorded (see metrics.py) and the
+    results are cached (see barcodeCache.py).
+    """
+    # lane -> the masks with a second barcode that it's used with
+    laneMasks = dict()
+    for d in sheets:
+        for v in d.values():
+            mask = v[2]
+            if int(mask.split(",")[1]) == 0:
+                continue
+            for lane in (v[1] if len(v[1]) > 0 else [1]):
+                laneMasks.setdefault(lane, set()).add(mask)
+    if len(laneMasks) == 0:
+        return dict()
+
+    runType = getRunType(basePath)
+    readOffsets = getReadLengths(basePath)
+    groups = dict()
+    for lane, masks in laneMasks.items():
+        groups.setdefault(tuple(sorted(masks)), []).append(lane)
+
+    rv = dict()
+    for masks, lanes in groups.items():
+        lanes = sorted(lanes)
+        cycleSets = [indexCycles(readOffsets, mask) for mask in masks]
+        if config is not None:
+            kwargs = barcodeSampling(config, runType)
+            nCycles = len(set().union(*cycleSets))
+            with metrics.timed(config, "getStats", run=os.path.basename(basePath), lanes=len(lanes), cycles=nCycles, masks=len(masks), **kwargs) as rec:
+                laneBarcodes, rec["cachedLanes"] = barcodeCache.getStatsMasks(config, basePath, runType, cycleSets, lanes, **kwargs)
+                rec["barcodes"] = sum(len(x) for y in laneBarcodes for x in y)
+        else:
+            laneBarcodes = barcodeCache.decodeMasks(basePath, runType, cycleSets, lanes)
+        for lane, barcodes in zip(lanes, laneBarcodes):
+            for mask, bcs in zip(masks, barcodes):
+                rv[lane, mask] = bcs
+    return rv
+
+
+def handleRevComp(d, basePath, config=None, barcodes=None):
     """
     Input is a dictionary with masks as keys and values as lists with 3 items: output sample sheet(s) (list of lines), lane(s) (set), barcode lengths (string)
 
     If there's no barcode 2, simply return the lists as is. Otherwise, see if the barcodes match better what the sequencer saw or the rev. comp.
     In the latter case, rev. comp. and then return.
+
+    barcodes are the observed barcode frequencies from maskBarcodes(), which is otherwise called with config.
     """
     # Empty sample sheet
     if not d or not len(d):
@@ -152,21 +271,9 @@ def handleRevComp(d, basePath):
     if tot == 0:
         return d
 
-    # Get the flow cell type
-    machine = os.path.split(basePath.rstrip("/"))[1].split("_")[1]
-    if machine[0] == 'N':
-        runType = "NextSeq"
-    elif machine[0] == 'M':
-        runType = "MiSeq"
-    elif machine[0] == 'S':
-        runType = "HiSeq2500"
-    elif machine[0] == 'A':
-        runType = "NovaSeq"
-    else:
-        runType = "HiSeq3000"
-
     # At least 1 lane has a barcode 2
-    readOffsets = getReadLengths(basePath)
+    if barcodes is None:
+        barcodes = maskBarcodes(basePath, [d], config=config)
     sampleSheets = []
     lanes = []
     masks = []
@@ -198,14 +305,11 @@ def handleRevComp(d, basePath):
                 d2[lane] = list()
             d2[lane].append(line)
 
-        # for each lane, get the observed barcode frequency
-        cycles = list(range(readOffsets[0], readOffsets[0] + int(mask.split(",")[0])))
-        cycles.extend(list(range(readOffsets[1], readOffsets[1] + int(mask.split(",")[1]))))
         finalSS = []
         outputLanes = set()
+        # for each lane, compare with the observed barcode frequencies
         for lane in localLanes:
-            barcodes = getStats(basePath, runType, cycles, lane)
-
+            observed = barcodes[lane, mask]
             totF = 0.0
             totR = 0.0
             # See what the total is if we used the barcodes as given
@@ -218,10 +322,10 @@ def handleRevComp(d, basePath):
                 else:
                     bcF = "{}{}".format(line[2].strip(), line[3].strip())
                     bcR = "{}{}".format(line[2].strip(), revComp(line[3].strip()))
-                if bcF in barcodes:
-                    totF += barcodes[bcF]
-                if bcR in barcodes:
-                    totR += barcodes[bcR]
+                if bcF in observed:
+                    totF += observed[bcF]
+                if bcR in observed:
+                    totR += observed[bcR]
 
             if totR > totF:
                 for idx in range(len(d2[lane])):
@@ -255,11 +359,9 @@ def handleRevComp(d, basePath):
     return rv
 
 
-def parseSampleSheet(ss, fullSheets=False):
+def readSampleSheet(ss):
     """
-    Return a dictionary with keys: (Barcode length 1, Barcode length 2)
-
-    return ss, laneOut, bcLens
+    Return a dictionary with keys: (Barcode length 1, Barcode length 2), as used by handleRevComp()
     """
     rv = dict()
 
@@ -328,26 +430,46 @@ def parseSampleSheet(ss, fullSheets=False):
                     colLabs[3] = cols.index("Sample_Project")
                 continue
 
+    return rv
+
+
+def parseSampleSheet(ss, fullSheets=False, config=None, rv=None, barcodes=None):
+    """
+    Return a dictionary with keys: (Barcode length 1, Barcode length 2)
+
+    rv is the output of readSampleSheet(ss), if it's already been read. barcodes are passed to handleRevComp().
+
+    return ss, laneOut, bcLens
+    """
+    if rv is None:
+        rv = readSampleSheet(ss)
     if fullSheets:
-        return reformatSS(handleRevComp(rv, os.path.dirname(ss)))
+        return reformatSS(handleRevComp(rv, os.path.dirname(ss), config=config, barcodes=barcodes))
     else:
         return reformatSS(rv)
 
 
-def getSampleSheets(d, fullSheets=False):
+def getSampleSheets(d, fullSheets=False, config=None):
     """
-    Provide a list of output directories and sample sheets
+    Provide a list of output directories and sample sheets. config is only used for recording metrics and caching barcodes.
+
+    With fullSheets, the index reads are decoded once for the masks of all of the sample sheets (see maskBarcodes()).
     """
     ss = glob.glob("%s/SampleSheet*.csv" % d)
 
     if len(ss) == 0:
         return ([None], [None], [''])
 
+    sheets = [readSampleSheet(sheet) for sheet in ss]
+    barcodes = None
+    if fullSheets:
+        barcodes = maskBarcodes(d, sheets, config=config)
+
     laneOut = []
     bcLens = []
     ssUse = []
-    for sheet in ss:
-        ss_, laneOut_, bcLens_ = parseSampleSheet(sheet, fullSheets=fullSheets)
+    for sheet, rv in zip(ss, sheets):
+        ss_, laneOut_, bcLens_ = parseSampleSheet(sheet, fullSheets=fullSheets, config=config, rv=rv, barcodes=barcodes)
         nSS = 0
         if ss_ is not None and len(ss_) > 0:
             ssUse.extend(ss_)
@@ -364,28 +486,62 @@ def getSampleSheets(d, fullSheets=False):
     return ssUse, laneOut, bcLens
 
 
+def listRunDirs(config):
+    '''
+    List the run folders under baseDir from the machines we handle. This reads
+    baseDir once rather than globbing it once per machine type.
+    '''
+    try:
+        names = sorted(os.listdir(config.get("Paths","baseDir")))
+    except OSError:
+        return []
+
+    dirs = []
+    seen = set()
+    for pattern in RUN_PATTERNS:
+        for name in fnmatch.filter(names, pattern):
+            if name in seen:
+                continue
+            seen.add(name)
+            dirs.append(os.path.join(config.get("Paths","baseDir"), name))
+    return dirs
+
+
 '''
-Iterate over all folders in config.baseDir from machine SN7001180. For each,
-see if it contains an RTAComplete.txt file, as this signifies the completion
-of a sequencing run.
+Iterate over all run folders in config.baseDir. For each, see if it contains
+an RTAComplete.txt file, as this signifies the completion of a sequencing run.
 
 If a run has finished, we then check to see if it's already been processed.
 Runs are marked as having been processed if they appear in config.finalDir
 and have a file called casava.finished or fastq.made. casava.finished is
 produced by the old pipeline, while this one creates fastq.made.
 
+What's learned about each run folder (RTAComplete.txt and sample sheet mtimes,
+lane groups and their processed state) is kept in the run registry (see
+runRegistry.py), so for runs that have been completely processed and whose
+folder and sample sheets haven't changed only the fastq.made files are checked.
+
+skip is an optional set of (runID, lanes) tuples, such as those of flow cells
+currently being processed, that should be ignored.
+
 This function always returns its configuration. If there's a new flow cell to
 process, then the runID is filled in. Otherwise, that's set to None.
 '''
-def newFlowCell(config) :
-    dirs = glob.glob("%s/*_SN*_*/RTAComplete.txt" % config.get("Paths","baseDir"))
-    dirs.extend(glob.glob("%s/*_NB*_*/RTAComplete.txt" % config.get("Paths","baseDir")))
-    dirs.extend(glob.glob("%s/*_M*_*/RTAComplete.txt" % config.get("Paths","baseDir")))
-    dirs.extend(glob.glob("%s/*_J*_*/RTAComplete.txt" % config.get("Paths","baseDir")))
-    dirs.extend(glob.glob("%s/*_A*_*/RTAComplete.txt" % config.get("Paths","baseDir")))
-    for d in dirs :
+def newFlowCell(config, skip=None) :
+    if skip is None:
+        skip = set()
+    conn = runRegistry.openRegistry(config)
+    try:
+        with metrics.timed(config, "newFlowCell"), profiling.profiled(config, "newFlowCell"):
+            return _newFlowCell(config, conn, skip)
+    finally:
+        conn.close()
+
+
+def _newFlowCell(config, conn, skip) :
+    for d in listRunDirs(config) :
         #Get the flow cell ID (e.g., 150416_SN7001180_0196_BC605HACXX)
-        config.set('Options','runID',d.split("/")[-2])
+        config.set('Options','runID',os.path.basename(d))
 
         # Before 1703 only a single sample sheet was supported
         # Before 1706, parkour wasn't being used, so barcode revComp might be wrong
@@ -393,38 +549,62 @@ def newFlowCell(config) :
         if config.get("Options","runID")[:6] < "190813":
             continue
 
-        gotHits = False
-        sampleSheet, lanes, bcLens = getSampleSheets(os.path.dirname(d))
+        # Sample sheets edited in place don't change the folder's mtime, so their signature is checked too
+        dirMtime = runRegistry.getMtime(d)
+        ssSignature = runRegistry.sampleSheetSignature(d)
+        row = runRegistry.getRun(conn, d)
+        recheck = row is None or row[0] != dirMtime or row[2] != ssSignature
 
-        for ss, lane, bcLen in zip(sampleSheet, lanes, bcLens):
-            config.set('Options','runID',d.split("/")[-2])
-            lanesUse = ""
+        # The lane groups of completely processed and unchanged runs are taken from the registry
+        if recheck or not runRegistry.allProcessed(conn, d):
+            rtaMtime = runRegistry.getMtime("{}/RTAComplete.txt".format(d))
+            if rtaMtime is None:
+                continue
+
+            if row is None or row[1] != rtaMtime or row[2] != ssSignature:
+                sampleSheet, lanes, bcLens = getSampleSheets(d)
+                runRegistry.storeRun(conn, d, dirMtime, rtaMtime, ssSignature, sampleSheet, lanes, bcLens)
+            elif recheck:
+                runRegistry.touchRun(conn, d, dirMtime)
+
+        gotHits = False
+        for ss, lane, bcLen, processed in runRegistry.getGroups(conn, d):
+            # fastq.made is always checked, since deleting it is how a flow cell is reprocessed
+            config.set('Options','runID',os.path.basename(d))
             if lane is not None and lane != "":
                 config.set("Options","lanes",lane)
-                lanesUse = "_lanes{}".format(lane)
             else:
                 config.set("Options","lanes","")
-            if ss is None:
-                ss = ''
-            if bcLen is not None and bcLen is not '':
+            if bcLen is not None and bcLen != '':
                 config.set("Options","bcLen",bcLen)
             else:
                 config.set("Options","bcLen","0,0")
-    
+
             if flowCellProcessed(config) is False:
-                gotHits = True
+                if (os.path.basename(d), config.get("Options","lanes")) not in skip:
+                    gotHits = True
+                if processed:
+                    runRegistry.markProcessed(conn, d, config.get("Options","lanes"), False)
             else :
+                if not processed:
+                    runRegistry.markProcessed(conn, d, config.get("Options","lanes"))
                 config.set("Options","runID","")
 
         # This may seem like code duplication, but for things like a MiSeq it takes a long time to parse the BCL files. This skips that unless needed
         if gotHits:
-            try:
-                sampleSheet, lanes, bcLens = getSampleSheets(os.path.dirname(d), fullSheets=True)
-            except:
-                print("Skipping {}".format(os.path.dirname(d)))
-                continue   
+            # The barcode orientation may already have been checked, possibly before the run finished (see preflight.py)
+            fullSheets = runRegistry.getFullSheets(conn, d, ssSignature)
+            if fullSheets is not None:
+                sampleSheet, lanes, bcLens = fullSheets
+            else:
+                try:
+                    sampleSheet, lanes, bcLens = getSampleSheets(d, fullSheets=True, config=config)
+                except:
+                    print("Skipping {}".format(d))
+                    continue
+                runRegistry.storeFullSheets(conn, d, ssSignature, sampleSheet, lanes, bcLens)
             for ss, lane, bcLen in zip(sampleSheet, lanes, bcLens):
-                config.set('Options','runID',d.split("/")[-2])
+                config.set('Options','runID',os.path.basename(d))
                 lanesUse = ""
                 if lane is not None and lane != "":
                     config.set("Options","lanes",lane)
@@ -438,6 +618,8 @@ def newFlowCell(config) :
                 else:
                     config.set("Options","bcLen","0,0")
    
+                if (config.get("Options","runID"), config.get("Options","lanes")) in skip:
+                    continue
                 if flowCellProcessed(config) is False:
                     syslog.syslog("Found a new flow cell: %s\n" % config.get("Options","runID"))
                     odir = "{}/{}{}".format(config.get("Paths", "outputDir"), config.get("Options", "runID"), lanesUse)
@@ -464,6 +646,14 @@ def markFinished(config) :
 
     open("%s/%s%s/fastq.made" % (config["Paths"]["outputDir"], config["Options"]["runID"], lanes), "w").close()
 
+    conn = runRegistry.openRegistry(config)
+    d = os.path.join(config.get("Paths","baseDir"), config.get("Options","runID"))
+    runRegistry.markProcessed(conn, d, config.get("Options","lanes"))
+    #The barcode frequencies are only needed until every lane group is processed
+    if runRegistry.allProcessed(conn, d):
+        barcodeCache.removeRun(config, config.get("Options","runID"))
+    conn.close()
+
 '''
 This function needs to be run after newFlowCell() returns with config.runID
 filled in. It creates the output directories.
@@ -1,6 +1,4 @@
 import configparser
-from bioblend.galaxy import GalaxyInstance
-from bioblend.galaxy.objects import GalaxyInstance as GI
 import sys
 import os
 import glob
@@ -124,7 +122,14 @@ def linkIntoGalaxy(config):
          shared library folder structure
       2) Link all samples, preserving directory structures
       3) TODO: Handle Galaxy stripping off the .gz file extension
+
+    Returns the message and whether every project was linked. Groups without
+    a Galaxy library have nothing to link to, so they don't count as failures.
     """
+    # bioblend is slow to import, so it's only loaded when needed
+    from bioblend.galaxy import GalaxyInstance
+    from bioblend.galaxy.objects import GalaxyInstance as GI
+
     lanes = config.get("Options", "lanes")
     if lanes != "":
         lanes = "_lanes{}".format(lanes)
@@ -140,6 +145,7 @@ def linkIntoGalaxy(config):
     gi2 = GI(url=url, api_key=userKey, verify=verify)
 
     message = "\n"
+    uploaded = True
     projects = glob.glob("%s/%s%s/Project_*" % (config.get("Paths","outputDir"),config.get("Options","runID"), lanes))
     for project in projects :
         pname = project.split("/")[-1][8:]
@@ -198,4 +204,5 @@ def linkIntoGalaxy(config):
             message += "\n{}\tSuccessfully uploaded to Galaxy".format(pname)
         except:
             message += "\n{}\tError during Galaxy upload ({}\t{})".format(pname, sys.exc_info()[0], sys.exc_info()[1])
-    return message
+            uploaded = False
+    return message, uploaded
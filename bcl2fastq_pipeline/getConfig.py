@@ -7,3 +7,11 @@ def getConfig() :
     if("Paths" in config.sections()) :
         return config
     return None
+
+def copyConfig(config) :
+    '''
+    An independent copy of a config, so per-flow cell options (runID, lanes, etc.) can be set without affecting others
+    '''
+    c = configparser.ConfigParser()
+    c.read_dict({s: dict(config.items(s, raw=True)) for s in config.sections()})
+    return c
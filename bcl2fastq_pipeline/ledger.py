@@ -0,0 +1,187 @@
+'''
+A crash-safe ledger of every unit of work done on a flow cell.
+
+Each (run, project, sample, stage) is recorded in an sqlite database along
+with its status, inputs, start/end times, duration and result. The database is
+in WAL mode, since the pool workers write to it concurrently, unless it's on a
+network filesystem, where WAL doesn't work and the rollback journal is used. If the pipeline is restarted or
+a stage fails part way through, only the units that didn't finish are redone;
+finished ones just return their stored result.
+
+The run is the output directory name (runID plus any lanes suffix). Run level
+stages use "" as the project and sample. Rerunning bcl2fastq on a flow cell
+clears its entries (see resetRun()), as does reprocessing a flow cell that was
+finished (see markRunFinished()).
+'''
+import os
+import sys
+import json
+import time
+import sqlite3
+import syslog
+from bcl2fastq_pipeline.findFlowCells import outputName
+from bcl2fastq_pipeline.filesystems import getFsType, NETWORK_FS
+
+# The journal mode of each ledger path
+journalModes = dict()
+
+
+def ledgerPath(config):
+    '''
+    The ledger lives in [Paths]->ledger, or logDir/taskLedger.sqlite by default
+    '''
+    p = config.get("Paths", "ledger", fallback="")
+    if p == "":
+        p = os.path.join(config.get("Paths", "logDir"), "taskLedger.sqlite")
+    return p
+
+
+def journalMode(fname):
+    '''
+    WAL needs shared memory between the processes, so it's only used on local filesystems
+    '''
+    if fname not in journalModes:
+        fsType = getFsType(os.path.dirname(os.path.abspath(fname)))
+        if fsType is None or fsType in NETWORK_FS:
+            syslog.syslog("[ledger] {} may be on a network filesystem, not using WAL\n".format(fname))
+            journalModes[fname] = "DELETE"
+        else:
+            journalModes[fname] = "WAL"
+    return journalModes[fname]
+
+
+def openLedger(config):
+    fname = ledgerPath(config)
+    conn = sqlite3.connect(fname, timeout=300)
+    conn.execute("PRAGMA journal_mode={}".format(journalMode(fname)))
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("""CREATE TABLE IF NOT EXISTS tasks (
+                    run TEXT,
+                    project TEXT,
+                    sample TEXT,
+                    stage TEXT,
+                    status TEXT,
+                    inputs TEXT,
+                    started REAL,
+                    finished REAL,
+                    duration REAL,
+                    result TEXT,
+                    error TEXT,
+                    PRIMARY KEY (run, project, sample, stage))""")
+    conn.commit()
+    return conn
+
+
+def getTask(conn, run, project, sample, stage):
+    '''
+    Return (status, result) for a unit of work, or None if it's never been started
+    '''
+    row = conn.execute("SELECT status, result FROM tasks WHERE run = ? AND project = ? AND sample = ? AND stage = ?", (run, project, sample, stage)).fetchone()
+    if row is None:
+        return None
+    return row[0], json.loads(row[1]) if row[1] is not None else None
+
+
+def recordTask(conn, run, project, sample, stage, status, inputs, started, result=None, error=None):
+    finished = None
+    duration = None
+    if status != "running":
+        finished = time.time()
+        duration = finished - started
+    conn.execute("INSERT OR REPLACE INTO tasks VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                 (run, project, sample, stage, status, json.dumps(inputs), started, finished, duration, json.dumps(result), error))
+    conn.commit()
+
+
+def claimTask(config, stage, project="", sample="", inputs=None):
+    '''
+    Mark a unit of work as running, unless it's already done. Returns (True,
+    stored result) if it's done and (False, start time) otherwise, in which
+    case finishTask() must be called once it completes.
+    '''
+    run = outputName(config)
+    conn = openLedger(config)
+    try:
+        rv = getTask(conn, run, project, sample, stage)
+        if rv is not None and rv[0] == "done":
+            syslog.syslog("[ledger] Skipping {} of {}/{}/{}, already done\n".format(stage, run, project, sample))
+            return True, rv[1]
+        started = time.time()
+        recordTask(conn, run, project, sample, stage, "running", inputs, started)
+        return False, started
+    finally:
+        conn.close()
+
+
+def finishTask(config, stage, started, project="", sample="", inputs=None, result=None, error=None):
+    '''
+    Record a unit of work claimed with claimTask() as done or, if error isn't None, failed
+    '''
+    conn = openLedger(config)
+    if error is None:
+        recordTask(conn, outputName(config), project, sample, stage, "done", inputs, started, result=result)
+    else:
+        recordTask(conn, outputName(config), project, sample, stage, "failed", inputs, started, error=error)
+    conn.close()
+
+
+def runTask(config, stage, func, *args, project="", sample="", inputs=None):
+    '''
+    Run func(*args) as a unit of work, unless the ledger says that it's already
+    done for this flow cell, in which case its stored result is returned.
+    Exceptions are recorded and then reraised.
+
+    inputs defaults to the arguments other than a config.
+    '''
+    if inputs is None:
+        inputs = [x for x in args if isinstance(x, (str, int, float))]
+
+    done, rv = claimTask(config, stage, project=project, sample=sample, inputs=inputs)
+    if done:
+        return rv
+
+    try:
+        result = func(*args)
+    except:
+        finishTask(config, stage, rv, project=project, sample=sample, inputs=inputs, error="{}: {}".format(sys.exc_info()[0].__name__, sys.exc_info()[1]))
+        raise
+
+    finishTask(config, stage, rv, project=project, sample=sample, inputs=inputs, result=result)
+    return result
+
+
+def taskDone(config, run, project, stage, sample=""):
+    '''
+    Whether a unit of work of the run (an output directory name) is recorded as done
+    '''
+    conn = openLedger(config)
+    rv = getTask(conn, run, project, sample, stage)
+    conn.close()
+    return rv is not None and rv[0] == "done"
+
+
+def markRunFinished(config):
+    '''
+    Record that everything was done on a flow cell, see runFinished()
+    '''
+    conn = openLedger(config)
+    recordTask(conn, outputName(config), "", "", "finished", "done", None, time.time())
+    conn.close()
+
+
+def runFinished(config):
+    '''
+    Whether a flow cell was already processed to the end, in which case being
+    picked up again (i.e., its fastq.made was removed) means reprocessing it
+    '''
+    return taskDone(config, outputName(config), "", "finished")
+
+
+def resetRun(config):
+    '''
+    Forget everything done on a flow cell, e.g., before demultiplexing it again
+    '''
+    conn = openLedger(config)
+    conn.execute("DELETE FROM tasks WHERE run = ?", (outputName(config),))
+    conn.commit()
+    conn.close()
@@ -1,7 +1,6 @@
 '''
 This file contains functions required to actually convert the bcl files to fastq
 '''
-import subprocess
 import os
 import sys
 import shutil
@@ -12,11 +11,10 @@ import codecs
 import tempfile
 import xml.etree.ElementTree as ET
 import re
-from reportlab.lib import colors, utils
-from reportlab.platypus import BaseDocTemplate, Table, Preformatted, Paragraph, Spacer, Image, Frame, NextPageTemplate, PageTemplate, TableStyle
-from reportlab.lib.styles import ParagraphStyle, getSampleStyleSheet
-from reportlab.lib.pagesizes import A4
-from reportlab.pdfgen import canvas
+import shlex
+from bcl2fastq_pipeline import metrics
+from bcl2fastq_pipeline import barcodeMismatches
+from bcl2fastq_pipeline.runner import runCommand
 
 def determineMask(config):
     '''
@@ -176,28 +174,27 @@ def bcl2fq(config) :
         mask = rv
     print("rv {} mask {}".format(rv, mask))
 
-    mismatch = 2
+    #Start with the most mismatches that won't cause a barcode collision, falling back to fewer if bcl2fastq still fails
+    try:
+        mismatch = barcodeMismatches.maxMismatches(config)
+    except:
+        syslog.syslog("[bcl2fq] Couldn't check the barcodes for collisions: {}\n".format(sys.exc_info()[1]))
+        mismatch = barcodeMismatches.MAX_MISMATCHES
     while mismatch >= 0:
-        cmd = "%s %s %s -o %s/%s%s -R %s/%s --interop-dir %s/%s%s/InterOp --barcode-mismatches %i" % (
-              config.get("bcl2fastq","bcl2fastq"),
-              config.get("bcl2fastq","bcl2fastq_options"),
-              mask,
-              config.get("Paths","outputDir"),
-              config.get("Options","runID"),
-              lanes,
-              config.get("Paths","baseDir"),
-              config.get("Options","runID"),
-              config.get("Paths","seqFacDir"),
-              config.get("Options","runID"),
-              lanes,
-              mismatch
-        )
-        print(cmd)
-        syslog.syslog("[bcl2fq] Running: %s\n" % cmd)
+        cmd = shlex.split(config.get("bcl2fastq","bcl2fastq")) + \
+              shlex.split(config.get("bcl2fastq","bcl2fastq_options")) + \
+              shlex.split(mask) + \
+              ["-o", "%s/%s%s" % (config.get("Paths","outputDir"), config.get("Options","runID"), lanes),
+               "-R", "%s/%s" % (config.get("Paths","baseDir"), config.get("Options","runID")),
+               "--interop-dir", "%s/%s%s/InterOp" % (config.get("Paths","seqFacDir"), config.get("Options","runID"), lanes),
+               "--barcode-mismatches", "%i" % mismatch]
+        print(" ".join(cmd))
+        syslog.syslog("[bcl2fq] Running: %s\n" % " ".join(cmd))
         logOut = open("%s/%s%s.stdout" % (config.get("Paths","logDir"), config.get("Options","runID"), lanes), "w")
         logErr = open("%s/%s%s.stderr" % (config.get("Paths","logDir"), config.get("Options","runID"), lanes), "w")
         try:
-            subprocess.check_call(cmd, stdout=logOut, stderr=logErr, shell=True)
+            with metrics.timed(config, "bcl2fqAttempt", path="%s/%s%s" % (config.get("Paths","outputDir"), config.get("Options","runID"), lanes), barcodeMismatches=mismatch):
+                runCommand(config, "bcl2fastq", cmd, label="mismatch{}".format(mismatch), stdout=logOut, stderr=logErr)
             rv = 0
         except:
             mismatch -= 1
@@ -243,6 +240,12 @@ def MakeTotalPDF(config) :
 
     Also, parse the fastq_screen .txt files and calculate the per-sample off-species rate
     '''
+    # reportlab is slow to import, so it's only loaded when needed
+    from reportlab.lib import utils
+    from reportlab.platypus import BaseDocTemplate, Table, Paragraph, Spacer, Image, Frame, PageTemplate
+    from reportlab.lib.styles import getSampleStyleSheet
+    from reportlab.lib.pagesizes import A4
+
     lanes = config.get("Options", "lanes")
     if lanes != '':
         lanes = '_lanes{}'.format(lanes)
@@ -0,0 +1,198 @@
+'''
+Structured timing and throughput metrics for each stage of the pipeline.
+
+Every stage (newFlowCell, getStats, each bcl2fastq attempt, fixNames, each of
+the postMakeSteps pools, the reports, transferData, linkIntoGalaxy and
+jsonParkour) appends a JSON object per line to [Paths]->metricsFile (default:
+logDir/metrics.jsonl) with the run, stage, status, start time, wall time and,
+where relevant:
+
+  * queueWait: seconds spent waiting for a resource slot (see orchestrator.py)
+  * readBytes/writeBytes: bytes read from and written to storage by the
+    daemon and its (finished) child processes, from /proc/self/io. These are
+    process wide, so they overlap if several flow cells are in flight.
+  * outputBytes/outputFiles: the change in size and file count of the output
+    directory. Counting these walks the whole directory before and after the
+    stage, which is a lot of metadata I/O on a network filesystem, so they're
+    only recorded if [Options]->metricsOutputCounts is True
+
+If [Paths]->promFile is set, totals and the most recent value per stage are
+also written there in the Prometheus text format, for node_exporter's
+textfile collector.
+
+Errors writing metrics are logged and otherwise ignored.
+'''
+import os
+import sys
+import json
+import time
+import syslog
+import threading
+import contextlib
+
+_lock = threading.Lock()
+# (stage, status) -> [count, total seconds]
+_totals = dict()
+# stage -> most recent record
+_last = dict()
+
+# Prometheus gauge name suffix -> record key
+LAST_FIELDS = [("seconds", "wall"),
+               ("queue_wait_seconds", "queueWait"),
+               ("read_bytes", "readBytes"),
+               ("write_bytes", "writeBytes"),
+               ("output_bytes", "outputBytes"),
+               ("output_files", "outputFiles"),
+               ("timestamp_seconds", "finished")]
+
+
+def metricsPath(config):
+    '''
+    The JSON-lines file, [Paths]->metricsFile or logDir/metrics.jsonl by default
+    '''
+    p = config.get("Paths", "metricsFile", fallback="")
+    if p == "":
+        p = os.path.join(config.get("Paths", "logDir"), "metrics.jsonl")
+    return p
+
+
+def runName(config):
+    '''
+    runID plus any lanes suffix, or "" if there's no flow cell
+    '''
+    runID = config.get("Options", "runID", fallback="")
+    lanes = config.get("Options", "lanes", fallback="")
+    if runID != "" and lanes != "":
+        return "{}_lanes{}".format(runID, lanes)
+    return runID
+
+
+def ioCounters():
+    '''
+    (read_bytes, write_bytes) for this process and its reaped children, or (0, 0) if unavailable
+    '''
+    try:
+        d = dict()
+        for line in open("/proc/self/io"):
+            k, v = line.split(":")
+            d[k] = int(v)
+        return d["read_bytes"], d["write_bytes"]
+    except:
+        return 0, 0
+
+
+def dirCounts(path):
+    '''
+    (bytes, files) under a path
+    '''
+    nBytes = 0
+    nFiles = 0
+    for r, dirs, files in os.walk(path):
+        for f in files:
+            try:
+                nBytes += os.lstat(os.path.join(r, f)).st_size
+                nFiles += 1
+            except OSError:
+                pass
+    return nBytes, nFiles
+
+
+def promLabel(v):
+    return str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def writeProm(fname):
+    '''
+    Write everything recorded so far in the Prometheus text format. This must be called with _lock held.
+    '''
+    lines = ["# HELP bfq_stage_runs_total Times each pipeline stage has finished, by status",
+             "# TYPE bfq_stage_runs_total counter"]
+    for (stage, status), (count, seconds) in sorted(_totals.items()):
+        lines.append('bfq_stage_runs_total{{stage="{}",status="{}"}} {}'.format(promLabel(stage), status, count))
+    lines.extend(["# HELP bfq_stage_seconds_total Wall time spent in each pipeline stage",
+                  "# TYPE bfq_stage_seconds_total counter"])
+    for (stage, status), (count, seconds) in sorted(_totals.items()):
+        lines.append('bfq_stage_seconds_total{{stage="{}",status="{}"}} {:.3f}'.format(promLabel(stage), status, seconds))
+    for suffix, key in LAST_FIELDS:
+        lines.extend(["# HELP bfq_stage_last_{} The most recent {} of each pipeline stage".format(suffix, key),
+                      "# TYPE bfq_stage_last_{} gauge".format(suffix)])
+        for stage, rec in sorted(_last.items()):
+            if key in rec:
+                lines.append('bfq_stage_last_{}{{stage="{}",run="{}"}} {}'.format(suffix, promLabel(stage), promLabel(rec["run"]), rec[key]))
+
+    # The collector may read the file at any time, so replace it atomically
+    tmp = "{}.{}.tmp".format(fname, os.getpid())
+    f = open(tmp, "w")
+    f.write("\n".join(lines) + "\n")
+    f.close()
+    os.replace(tmp, fname)
+
+
+def record(config, stage, started, wall, status="ok", prom=True, **fields):
+    '''
+    Record a finished stage. prom=False only writes it to the JSON-lines file
+    and leaves it out of the Prometheus totals, e.g., for records from pool
+    workers, which would otherwise overwrite the file with their own totals.
+    '''
+    rec = {"run": runName(config),
+           "stage": stage,
+           "status": status,
+           "started": round(started, 3),
+           "finished": round(started + wall, 3),
+           "wall": round(wall, 3)}
+    rec.update(fields)
+    try:
+        with _lock:
+            f = open(metricsPath(config), "a")
+            f.write(json.dumps(rec) + "\n")
+            f.close()
+            if not prom:
+                return
+
+            k = (stage, status)
+            if k not in _totals:
+                _totals[k] = [0, 0.0]
+            _totals[k][0] += 1
+            _totals[k][1] += wall
+            _last[stage] = rec
+
+            promFile = config.get("Paths", "promFile", fallback="")
+            if promFile != "":
+                writeProm(promFile)
+    except:
+        syslog.syslog("[metrics] Couldn't record metrics for {}: {}\n".format(stage, sys.exc_info()[1]))
+
+
+@contextlib.contextmanager
+def timed(config, stage, path=None, **fields):
+    '''
+    Time the enclosed block as a stage, along with the I/O done and, if path
+    is given and [Options]->metricsOutputCounts is set, the change in what's
+    under it. Yields a dictionary to which further fields can be added. The
+    stage is recorded as failed if an exception is raised (which is then
+    reraised).
+    '''
+    rec = dict(fields)
+    if not config.getboolean("Options", "metricsOutputCounts", fallback=False):
+        path = None
+    if path is not None:
+        before = dirCounts(path)
+    io = ioCounters()
+    started = time.time()
+    t0 = time.perf_counter()
+    status = "ok"
+    try:
+        yield rec
+    except:
+        status = "failed"
+        raise
+    finally:
+        wall = time.perf_counter() - t0
+        io2 = ioCounters()
+        rec["readBytes"] = io2[0] - io[0]
+        rec["writeBytes"] = io2[1] - io[1]
+        if path is not None:
+            after = dirCounts(path)
+            rec["outputBytes"] = after[0] - before[0]
+            rec["outputFiles"] = after[1] - before[1]
+        record(config, stage, started, wall, status=status, **rec)
@@ -4,15 +4,8 @@ Misc. functions
 
 import configparser
 import shutil
-import smtplib
-from email.mime.text import MIMEText
 import xml.etree.ElementTree as ET
-from reportlab.lib import colors, utils
-from reportlab.platypus import BaseDocTemplate, Table, Preformatted, Paragraph, Spacer, Image, Frame, NextPageTemplate, PageTemplate, TableStyle, PageBreak, ListFlowable, ListItem
-from reportlab.lib.styles import ParagraphStyle, getSampleStyleSheet
-from reportlab.lib.pagesizes import A4, landscape
 from time import strftime
-from reportlab.pdfgen import canvas
 import csv
 import sys
 import glob
@@ -22,100 +15,138 @@ import os.path
 import syslog
 import stat
 import codecs
-import requests
 import json
+import re
+import subprocess
+from bcl2fastq_pipeline import spaceEstimate
+from bcl2fastq_pipeline import ledger
+from bcl2fastq_pipeline import runner
+from bcl2fastq_pipeline import outbox
+
+def projectGroup(pname) :
+    """
+    The group a project (without the "Project_" prefix) belongs to
+    """
+    group = pname.split("_")[-1].lower()
+    if "-" in group:
+        # Handle things like cabezas-wallschied -> cabezas
+        group =  group.split("-")[0]
+    return group
+
+def transferProject(config, project) :
+    """
+    Distribute the fastq and fastQC files of a single project. Returns a
+    message, exceptions are raised on failure (including a FEX upload that
+    fexsend doesn't report as successful, see [Uni]->fexsendSuccess).
+    """
+    lanes = config.get("Options", "lanes")
+    if lanes != "":
+        lanes = "_lanes{}".format(lanes)
+
+    pname = project.split("/")[-1][8:]
+    group = projectGroup(pname)
+    syslog.syslog("[transferData] Transferring %s\n" % pname)
+
+    if os.path.exists("{}/{}/sequencing_data".format(config.get("Paths","groupDir"), group)):
+        #Local group
+        p = pathlib.Path("%s/%s/sequencing_data/%s%s" % (
+            config.get("Paths","groupDir"),
+            group,
+            config.get("Options","runID"),
+            lanes))
+        if(p.exists() == False) :
+            p.mkdir(mode=0o750, parents=True)
+
+        # Remove anything left behind by an interrupted transfer
+        dest = "%s/%s/sequencing_data/%s%s/%s" % (
+            config.get("Paths","groupDir"),
+            group,
+            config.get("Options","runID"),
+            lanes,
+            project.split("/")[-1])
+        for d in [dest, "%s/%s/sequencing_data/%s%s/FASTQC_%s" % (
+                config.get("Paths","groupDir"),
+                group,
+                config.get("Options","runID"),
+                lanes,
+                project.split("/")[-1])]:
+            if os.path.exists(d):
+                shutil.rmtree(d)
+
+        shutil.copytree(project, dest)
+
+        shutil.copytree("%s/%s%s/FASTQC_%s" % (
+            config.get("Paths","outputDir"),
+            config.get("Options","runID"),
+            lanes,
+            project.split("/")[-1])
+            , "%s/%s/sequencing_data/%s%s/FASTQC_%s" % (
+            config.get("Paths","groupDir"),
+            group,
+            config.get("Options","runID"),
+            lanes,
+            project.split("/")[-1]))
+
+        for r, dirs, files in os.walk("%s/%s/sequencing_data/%s%s" % (
+            config.get("Paths","groupDir"),
+            group,
+            config.get("Options","runID"),
+            lanes)):
+            for d in dirs:
+                os.chmod(os.path.join(r, d), stat.S_IRWXU | stat.S_IRGRP | stat.S_IXGRP)
+            for f in files:
+                os.chmod(os.path.join(r, f), stat.S_IRWXU | stat.S_IRGRP)
+
+        return "\n%s\ttransferred" % pname
+    else:
+        #Upload with FEX
+        # The Schuele group has its own person that should get these
+        if project.split("/")[-1].startswith("B01Schuele_"):
+            recipient = config.get("Uni","Schuele")
+        else:
+            recipient = config.get("Uni","default")
+        tarCmd = ["tar", "cf", "-",
+                  "%s/%s%s/FASTQC_%s" % (config.get("Paths","outputDir"), config.get("Options","runID"), lanes, project.split("/")[-1]),
+                  "%s/%s%s/%s" % (config.get("Paths","outputDir"), config.get("Options","runID"), lanes, project.split("/")[-1])]
+        fexCmd = ["fexsend", "-s",
+                  "%s%s_%s.tar" % (config.get("Options", "runID"), lanes, project.split("/")[-1]),
+                  recipient]
+        cmd = "%s | %s" % (" ".join(tarCmd), " ".join(fexCmd))
+        fexLog = runner.taskLog(config, "fexsend", pname, "stdout")
+        tar = runner.spawn(config, "tar", tarCmd, label=pname, stdout=subprocess.PIPE)
+        fex = runner.spawn(config, "fexsend", fexCmd, label=pname, stdin=tar.stdout, stdout=fexLog)
+        tar.stdout.close()
+        # fexsend doesn't return 0 on success, so its output is checked instead
+        rv = fex.wait(check=False)
+        fexLog.close()
+        tar.wait()
+        if re.search(config.get("Uni", "fexsendSuccess", fallback="Location:"), open(fexLog.name).read()) is None:
+            raise RuntimeError("fexsend didn't report a successful upload (return code %s from command '%s'), see %s" % (rv, cmd, fexLog.name))
+        return "\n%s\ttransferred (return code %s from command '%s')" % (pname, rv, cmd)
 
 def transferData(config) :
     """
-    Distribute fastq and fastQC files to users.
+    Distribute fastq and fastQC files to users. Each project is a separate
+    unit in the task ledger, so only projects that failed are retried.
+
+    Returns the message and whether every project was transferred.
     """
     lanes = config.get("Options", "lanes")
     if lanes != "":
         lanes = "_lanes{}".format(lanes)
 
     message = ""
+    transferred = True
     projects = glob.glob("%s/%s%s/Project_*" % (config.get("Paths","outputDir"),config.get("Options","runID"), lanes))
     for project in projects :
         pname = project.split("/")[-1][8:]
-        group = pname.split("_")[-1].lower()
-        if "-" in group:
-            # Handle things like cabezas-wallschied -> cabezas
-            group =  group.split("-")[0]
-        syslog.syslog("[transferData] Transferring %s\n" % pname)
-
-        if os.path.exists("{}/{}/sequencing_data".format(config.get("Paths","groupDir"), group)):
-            #Local group
-            syslog.syslog("[transferData] Transferring %s\n" % pname)
-            try :
-                p = pathlib.Path("%s/%s/sequencing_data/%s%s" % (
-                    config.get("Paths","groupDir"),
-                    group,
-                    config.get("Options","runID"),
-                    lanes))
-                if(p.exists() == False) :
-                    p.mkdir(mode=0o750, parents=True)
-
-                shutil.copytree(project, "%s/%s/sequencing_data/%s%s/%s" % (
-                    config.get("Paths","groupDir"),
-                    group,
-                    config.get("Options","runID"),
-                    lanes,
-                    project.split("/")[-1]))
-
-                shutil.copytree("%s/%s%s/FASTQC_%s" % (
-                    config.get("Paths","outputDir"),
-                    config.get("Options","runID"),
-                    lanes,
-                    project.split("/")[-1])
-                    , "%s/%s/sequencing_data/%s%s/FASTQC_%s" % (
-                    config.get("Paths","groupDir"),
-                    group,
-                    config.get("Options","runID"),
-                    lanes,
-                    project.split("/")[-1]))
-
-                for r, dirs, files in os.walk("%s/%s/sequencing_data/%s%s" % (
-                    config.get("Paths","groupDir"),
-                    group,
-                    config.get("Options","runID"),
-                    lanes)):
-                    for d in dirs:
-                        os.chmod(os.path.join(r, d), stat.S_IRWXU | stat.S_IRGRP | stat.S_IXGRP)
-                    for f in files:
-                        os.chmod(os.path.join(r, f), stat.S_IRWXU | stat.S_IRGRP)
-
-                message += "\n%s\ttransferred" % pname
-            except :
-                e = sys.exc_info()
-                message += "\n%s\tError during transfer (%s: %s)!" % (pname, e[0], e[1])
-        else:
-            #Upload with FEX
-            syslog.syslog("[transferData] Transferring %s\n" % pname)
-            try :
-                # The Schuele group has its own person that should get these
-                if project.split("/")[-1].startswith("B01Schuele_"):
-                    recipient = config.get("Uni","Schuele")
-                else:
-                    recipient = config.get("Uni","default")
-                cmd = "tar cf - %s/%s%s/FASTQC_%s %s/%s%s/%s | fexsend -s %s%s_%s.tar %s" % (
-                    config.get("Paths","outputDir"),
-                    config.get("Options","runID"),
-                    lanes,
-                    project.split("/")[-1],
-                    config.get("Paths","outputDir"),
-                    config.get("Options","runID"),
-                    lanes,
-                    project.split("/")[-1],
-                    config.get("Options", "runID"),
-                    lanes,
-                    project.split("/")[-1],
-                    recipient)
-                rv = os.system(cmd)
-                message += "\n%s\ttransferred (return code %s from command '%s')" % (pname, rv, cmd)
-            except :
-                # fexsend doesn't return 0 on success
-                message += "\n%s\ttransferred (return code %s from command '%s')" % (pname, rv, cmd)
-    return message
+        try :
+            message += ledger.runTask(config, "transferData", transferProject, config, project, project=pname)
+        except :
+            e = sys.exc_info()
+            message += "\n%s\tError during transfer (%s: %s)!" % (pname, e[0], e[1])
+            transferred = False
+    return message, transferred
 
 def getSampleIDNameProjectLaneTuple(config) :
     """
@@ -179,6 +210,12 @@ def makeProjectPDF(node, project, config) :
       * Average base quality
     For paired-end datasets, the last two columns are repeated and named differently.
     """
+    # reportlab is slow to import, so it's only loaded when needed
+    from reportlab.lib import utils
+    from reportlab.platypus import BaseDocTemplate, Table, Paragraph, Spacer, Image, Frame, NextPageTemplate, PageTemplate, TableStyle, PageBreak, ListFlowable
+    from reportlab.lib.styles import getSampleStyleSheet
+    from reportlab.lib.pagesizes import A4, landscape
+
     lanes = config.get("Options", "lanes")
     if lanes != "":
         lanes = "_lanes{}".format(lanes)
@@ -497,27 +534,31 @@ def parseConversionStats(config) :
             makeProjectPDF(project, project.get("name"), config)
     return metrics
 
-def enoughFreeSpace(config) :
+def enoughFreeSpace(config, reserved=0) :
     """
-    Ensure that outputDir has at least minSpace gigs
+    Ensure that outputDir will still have at least minSpace gigs after
+    processing the flow cell in config (see spaceEstimate.py) and after
+    writing reserved bytes (e.g., for flow cells already being processed)
     """
     (tot,used,free) = shutil.disk_usage(config.get("Paths","outputDir"))
+    free -= spaceEstimate.remainingFootprint(config) + reserved
     free /= 1024*1024*1024
     if(free >= float(config.get("Options","minSpace"))) :
         return True
     return False
 
 def errorEmail(config, errTuple, msg) :
-    msg = MIMEText(msg + "\nError type: %s\nError value: %s\n%s\n" % (errTuple[0], errTuple[1], errTuple[2]))
-    msg['Subject'] = "[bcl2fastq_pipeline] Error"
-    msg['From'] = config.get("Email","fromAddress")
-    msg['To'] = config.get("Email","errorTo")
-
-    s = smtplib.SMTP(config.get("Email","host"))
-    s.send_message(msg)
-    s.quit()
+    """
+    Queue an error email, it's sent in the background (see outbox.py)
+    """
+    outbox.enqueue(config, "email", {"subject": "[bcl2fastq_pipeline] Error",
+                                     "to": config.get("Email","errorTo"),
+                                     "body": msg + "\nError type: %s\nError value: %s\n%s\n" % (errTuple[0], errTuple[1], errTuple[2])})
 
 def finishedEmail(config, msg, runTime, transferTime) :
+    """
+    Queue the email saying that a flow cell is done, it's sent in the background (see outbox.py)
+    """
     lanes = config.get("Options", "lanes")
     if lanes != "":
         lanes = "_lanes{}".format(lanes)
@@ -527,16 +568,14 @@ def finishedEmail(config, msg, runTime, transferTime) :
     message += "Data transfer: %s\n" % transferTime
     message += msg
 
-    msg = MIMEText(message)
-    msg['Subject'] = "[bcl2fastq_pipeline] %s%s processed" % (config.get("Options","runID"), lanes)
-    msg['From'] = config.get("Email","fromAddress")
-    msg['To'] = config.get("Email","finishedTo")
-
-    s = smtplib.SMTP(config.get("Email","host"))
-    s.send_message(msg)
-    s.quit()
+    outbox.enqueue(config, "email", {"subject": "[bcl2fastq_pipeline] %s%s processed" % (config.get("Options","runID"), lanes),
+                                     "to": config.get("Email","finishedTo"),
+                                     "body": message})
 
 def jsonParkour(config, msg):
+    """
+    Queue an update of the flow cell statistics in Parkour, it's posted in the background (see outbox.py)
+    """
     d = dict()
     d['flowcell_id'] = config.get("Options", "runID").split("_")[3][1:]
     if "-" in d['flowcell_id']:
@@ -586,8 +625,5 @@ def jsonParkour(config, msg):
             laneDict[lane]["name"] = lane
 
     d['matrix'] = json.dumps(list(laneDict.values()))
-    res = requests.post(config.get("parkour", "URL"), auth=(config.get("parkour", "user"), config.get("parkour", "password")), data=d)
-    if res.status_code == 200:
-        return "\nParkour: updated\n"
-    else:
-        return "\nParkour: parkour returned {}, status {}\nSent: {}".format(res.text, res.status_code, d)
+    outbox.enqueue(config, "parkour", d)
+    return "\nParkour: update queued\n"
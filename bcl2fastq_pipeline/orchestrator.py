@@ -0,0 +1,295 @@
+'''
+Process several flow cells at once, each at its own stage.
+
+Each flow cell (runID plus lanes) is processed in its own thread, going
+through the same stages bfq.py always ran. Stages needing a constrained
+resource have to acquire a slot for it first, so for example the bcl2fastq of
+one run can proceed while another run is busy transferring data. The budgets
+are set under [Options]:
+
+  * runsInFlight: the number of flow cells processed at once
+  * cpuSlots: bcl2fq and postMakeSteps
+  * diskSlots: fixNames and cpSeqFac
+  * transferSlots: transferData and linkIntoGalaxy
+
+A flow cell with an error is retried once sleepTime has passed, without
+holding up the others.
+
+The space that flow cells being processed still need in outputDir (see
+reservedSpace()) is predicted once, when each is started. After that, the
+growth of outputDir's used space is subtracted from it (oldest flow cell
+first), so admitting a flow cell doesn't walk the output directories of the
+others. If [Paths]->scratchDir is set, everything up to the
+transfer happens there (see scratch.py).
+
+Resumable stages are recorded in the task ledger (see ledger.py) and skipped
+if they already finished, for example when a flow cell
+is retried after a later stage failed. The bcl.done and files.renamed marker
+files are still used, so existing output directories are handled as before.
+'''
+import sys
+import os
+import shutil
+import datetime
+import syslog
+import threading
+import time
+import bcl2fastq_pipeline.findFlowCells
+import bcl2fastq_pipeline.makeFastq
+import bcl2fastq_pipeline.afterFastq
+import bcl2fastq_pipeline.misc
+import bcl2fastq_pipeline.galaxy
+import bcl2fastq_pipeline.spaceEstimate
+import bcl2fastq_pipeline.runRegistry
+import bcl2fastq_pipeline.scratch
+import bcl2fastq_pipeline.ledger
+import bcl2fastq_pipeline.metrics
+import bcl2fastq_pipeline.profiling
+
+RESOURCES = {"cpu": "cpuSlots", "disk": "diskSlots", "transfer": "transferSlots"}
+
+
+def runKey(config):
+    return (config.get("Options", "runID"), config.get("Options", "lanes"))
+
+
+def outputPath(config, fname):
+    return "{}/{}/{}".format(config.get("Paths", "outputDir"), bcl2fastq_pipeline.findFlowCells.outputName(config), fname)
+
+
+def touch(fname):
+    open(fname, "w").close()
+
+
+class Orchestrator(object):
+    def __init__(self, config, wake=None):
+        '''
+        wake is called whenever a flow cell finishes or fails, so the main loop can admit another
+        '''
+        self.wake = wake
+        self.lock = threading.Lock()
+        self.running = dict()
+        self.retryAfter = dict()
+        #The bytes each flow cell is still predicted to write and outputDir's used bytes when that was last updated
+        self.reserved = dict()
+        self.outputDir = None
+        self.usedAt = 0
+        self.fatal = None
+        self.setBudgets(config)
+
+    def setBudgets(self, config):
+        '''
+        (Re)create the resource slots, this must only be done while nothing is running
+        '''
+        self.slots = dict()
+        for k, v in RESOURCES.items():
+            self.slots[k] = threading.BoundedSemaphore(int(config.get("Options", v, fallback="1")))
+
+    def maxRuns(self, config):
+        return int(config.get("Options", "runsInFlight", fallback="1"))
+
+    def busy(self):
+        '''
+        The set of (runID, lanes) being processed or waiting to be retried
+        '''
+        now = time.time()
+        with self.lock:
+            for k in [k for k, v in self.retryAfter.items() if v <= now]:
+                del self.retryAfter[k]
+            return set(self.running.keys()) | set(self.retryAfter.keys())
+
+    def inFlight(self):
+        with self.lock:
+            return len(self.running)
+
+    def settleReserved(self):
+        '''
+        Subtract what's been written to outputDir since the last call from the
+        reserved space, oldest flow cell first. self.lock must be held.
+        '''
+        if self.outputDir is None:
+            return
+        used = shutil.disk_usage(self.outputDir).used
+        written = used - self.usedAt
+        self.usedAt = used
+        for key in self.reserved:
+            if written <= 0:
+                break
+            d = min(written, self.reserved[key])
+            self.reserved[key] -= d
+            written -= d
+
+    def reservedSpace(self):
+        '''
+        The bytes that flow cells being processed are still predicted to write to outputDir
+        '''
+        with self.lock:
+            self.settleReserved()
+            return sum(self.reserved.values())
+
+    def hasCapacity(self, config):
+        return self.fatal is None and self.inFlight() < self.maxRuns(config)
+
+    def start(self, config):
+        key = runKey(config)
+        t = threading.Thread(target=self.process, args=(config,), name="{}{}".format(*key), daemon=True)
+        #The only time that this flow cell's output directory is walked (see reservedSpace())
+        remaining = bcl2fastq_pipeline.spaceEstimate.remainingFootprint(config)
+        with self.lock:
+            self.settleReserved()
+            if self.outputDir is None:
+                self.outputDir = config.get("Paths", "outputDir")
+                self.usedAt = shutil.disk_usage(self.outputDir).used
+            self.reserved[key] = remaining
+            self.running[key] = t
+        t.start()
+
+    def finish(self, config, retryAfter=None):
+        key = runKey(config)
+        with self.lock:
+            self.running.pop(key, None)
+            self.reserved.pop(key, None)
+            if retryAfter is not None:
+                self.retryAfter[key] = retryAfter
+        if self.wake is not None:
+            self.wake()
+
+    def stage(self, config, resource, errMsg, name, func, *args, resumable=False):
+        '''
+        Run func(config, *args) while holding a slot for resource (which may be None).
+        If resumable is True, this is done as a unit of work called name in the task ledger.
+        The time taken and the time spent waiting for the slot are recorded (see metrics.py),
+        and the stage is profiled if that's enabled (see profiling.py).
+
+        Returns (True, return value) on success. Errors are logged and emailed and (False, None) returned.
+        '''
+        t0 = time.perf_counter()
+        if resource is not None:
+            self.slots[resource].acquire()
+        try:
+            queueWait = round(time.perf_counter() - t0, 3)
+            with bcl2fastq_pipeline.metrics.timed(config, name, path=outputPath(config, ""), queueWait=queueWait, resource=resource), bcl2fastq_pipeline.profiling.profiled(config, name):
+                if resumable:
+                    return True, bcl2fastq_pipeline.ledger.runTask(config, name, func, config, *args)
+                return True, func(config, *args)
+        except:
+            syslog.syslog("{}\n".format(errMsg))
+            bcl2fastq_pipeline.misc.errorEmail(config, sys.exc_info(), errMsg)
+            return False, None
+        finally:
+            if resource is not None:
+                self.slots[resource].release()
+
+    def process(self, config):
+        try:
+            if self.processFlowCell(config):
+                self.finish(config)
+            else:
+                self.finish(config, time.time() + float(config.get("Options", "sleepTime")) * 60 * 60)
+        except:
+            syslog.syslog("Unhandled error while processing {}{}\n".format(*runKey(config)))
+            self.fatal = sys.exc_info()
+            self.finish(config)
+
+    def processFlowCell(self, config):
+        '''
+        Run all of the stages for a single flow cell. Returns False on a (retryable) error.
+        '''
+        startTime = datetime.datetime.now()
+
+        #Keep profiling this flow cell, including in pool workers, even if SIGUSR1 turns it off in the meantime
+        if bcl2fastq_pipeline.profiling.enabled(config):
+            config.set("Options", "profile", "True")
+
+        #Demultiplex and post-process on scratch, if configured and there's space
+        finalConfig = config
+        if bcl2fastq_pipeline.scratch.useScratch(config):
+            config = bcl2fastq_pipeline.scratch.scratchConfig(config)
+
+        #A reprocessed flow cell has its post-processing, transfers and uploads redone, rather than skipped as already done
+        if bcl2fastq_pipeline.ledger.runFinished(config):
+            syslog.syslog("[processFlowCell] Reprocessing {}{}, clearing its ledger entries\n".format(*runKey(config)))
+            bcl2fastq_pipeline.ledger.resetRun(config)
+
+        #Make the fastq files, if not already done
+        if not os.path.exists(outputPath(config, "bcl.done")):
+            #Anything done on a previous demultiplexing is now stale
+            bcl2fastq_pipeline.ledger.resetRun(config)
+            ok, _ = self.stage(config, "cpu", "Got an error in bcl2fq", "bcl2fq", bcl2fastq_pipeline.makeFastq.bcl2fq, resumable=True)
+            if not ok:
+                return False
+            touch(outputPath(config, "bcl.done"))
+
+        #Fix the file names (prepend "Project_" and "Sample_" and such as appropriate)
+        if not os.path.exists(outputPath(config, "files.renamed")):
+            ok, _ = self.stage(config, "disk", "Got an error in fixNames", "fixNames", bcl2fastq_pipeline.makeFastq.fixNames, resumable=True)
+            if not ok:
+                return False
+            touch(outputPath(config, "files.renamed"))
+
+        #Run post-processing steps
+        ok, message = self.stage(config, "cpu", "Got an error during postMakeSteps", "postMakeSteps", bcl2fastq_pipeline.afterFastq.postMakeSteps, resumable=True)
+        if not ok:
+            return False
+
+        #Get more statistics and create PDFs
+        ok, rv = self.stage(config, None, "Got an error during parseConversionStats", "parseConversionStats", lambda c: "\n\n" + bcl2fastq_pipeline.misc.parseConversionStats(c), resumable=True)
+        if not ok:
+            return False
+        message += rv
+
+        #Copy over xml, FastQC, and PDF stuff
+        ok, rv = self.stage(config, "disk", "Got an error in cpSeqFac", "cpSeqFac", bcl2fastq_pipeline.makeFastq.cpSeqFac, resumable=True)
+        if not ok:
+            return False
+        message += rv
+
+        #Move everything from scratch to outputDir
+        if config is not finalConfig:
+            ok, _ = self.stage(config, "disk", "Got an error while moving from scratch to outputDir", "promote", bcl2fastq_pipeline.scratch.promote, finalConfig)
+            if not ok:
+                return False
+            config = finalConfig
+
+        runTime = datetime.datetime.now() - startTime
+        startTime = datetime.datetime.now()
+
+        #Transfer data to groups
+        ok, rv = self.stage(config, "transfer", "Got an error during transferData", "transferData", bcl2fastq_pipeline.misc.transferData)
+        if not ok:
+            return False
+        rv, transferred = rv
+        message += rv
+
+        #Upload to Galaxy, errors are reported but processing continues
+        ok, rv = self.stage(config, "transfer", "Got an error while uploading to Galaxy!", "linkIntoGalaxy", bcl2fastq_pipeline.galaxy.linkIntoGalaxy)
+        galaxy = False
+        if ok:
+            rv, galaxy = rv
+            message += rv
+
+        transferTime = datetime.datetime.now() - startTime
+
+        #Update parkour, errors are non-fatal here
+        ok, rv = self.stage(config, None, "Got an error while updating Parkour!", "jsonParkour", lambda c: message + bcl2fastq_pipeline.misc.jsonParkour(c, message))
+        if ok:
+            message = rv
+
+        #Queue the finished email, it's sent in the background
+        try:
+            bcl2fastq_pipeline.misc.finishedEmail(config, message, runTime, transferTime)
+        except:
+            #Unrecoverable error (the outbox can't be written), the main loop will quit
+            syslog.syslog("Couldn't queue the finished email! Quiting")
+            self.fatal = sys.exc_info()
+            return True
+
+        #Mark the flow cell as having been processed
+        bcl2fastq_pipeline.findFlowCells.markFinished(config)
+        bcl2fastq_pipeline.ledger.markRunFinished(config)
+
+        #Its output directory can later be evicted by the space manager if everything was delivered
+        conn = bcl2fastq_pipeline.runRegistry.openRegistry(config)
+        bcl2fastq_pipeline.runRegistry.markDelivered(conn, bcl2fastq_pipeline.findFlowCells.outputName(config), transferred, galaxy)
+        conn.close()
+        return True
@@ -0,0 +1,221 @@
+'''
+A persistent outbox for emails and Parkour updates.
+
+errorEmail(), finishedEmail() and jsonParkour() used to talk to the SMTP relay
+and Parkour directly, so a slow or unreachable server held up (or, for the
+finished email, stopped) the whole daemon. They now only add a message to an
+sqlite queue ([Paths]->outbox, logDir/outbox.sqlite by default) and return.
+
+A background thread started by bfq.py drains the queue: all pending emails are
+sent over a single SMTP connection and Parkour updates reuse one HTTP session.
+Messages that can't be delivered are retried with exponential backoff (from
+[Options]->outboxRetryMin up to outboxRetryMax minutes) until they're
+delivered. Parkour replies other than 200 and server errors are final and
+reported by email instead. Sent messages are kept for a month, for reference.
+
+If no background thread is running in this process (e.g., in a script), a
+message is delivered as soon as it's enqueued.
+'''
+import os
+import sys
+import json
+import time
+import sqlite3
+import smtplib
+import syslog
+import threading
+from email.mime.text import MIMEText
+
+_wake = threading.Event()
+_thread = None
+# Reused between drains, see parkourSession()
+_session = None
+KEEP_SENT = 30 * 24 * 60 * 60
+
+
+def outboxPath(config):
+    '''
+    The outbox lives in [Paths]->outbox, or logDir/outbox.sqlite by default
+    '''
+    p = config.get("Paths", "outbox", fallback="")
+    if p == "":
+        p = os.path.join(config.get("Paths", "logDir"), "outbox.sqlite")
+    return p
+
+
+def openOutbox(config):
+    conn = sqlite3.connect(outboxPath(config), timeout=60)
+    conn.execute("""CREATE TABLE IF NOT EXISTS messages (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    kind TEXT,
+                    payload TEXT,
+                    created REAL,
+                    attempts INTEGER,
+                    nextAttempt REAL,
+                    status TEXT,
+                    lastError TEXT,
+                    sent REAL)""")
+    conn.commit()
+    return conn
+
+
+def enqueue(config, kind, payload):
+    '''
+    Add a message to the outbox. kind is "email" (payload: subject, to and
+    body) or "parkour" (payload: the form data to post).
+    '''
+    conn = openOutbox(config)
+    conn.execute("INSERT INTO messages (kind, payload, created, attempts, nextAttempt, status) VALUES (?, ?, ?, 0, ?, 'pending')",
+                 (kind, json.dumps(payload), time.time(), time.time()))
+    conn.commit()
+    conn.close()
+
+    if _thread is not None and _thread.is_alive():
+        _wake.set()
+    else:
+        try:
+            drain(config)
+        except:
+            syslog.syslog("[outbox] Couldn't drain the outbox: {}\n".format(sys.exc_info()[1]))
+
+
+def retryDelay(config, attempts):
+    '''
+    Seconds to wait before another attempt
+    '''
+    low = 60 * float(config.get("Options", "outboxRetryMin", fallback="1"))
+    high = 60 * float(config.get("Options", "outboxRetryMax", fallback="60"))
+    return min(high, low * 2 ** (attempts - 1))
+
+
+def markSent(conn, mid):
+    conn.execute("UPDATE messages SET status = 'sent', sent = ?, attempts = attempts + 1 WHERE id = ?", (time.time(), mid))
+    conn.commit()
+
+
+def markFailed(config, conn, mid, attempts, error, final=False):
+    if final:
+        conn.execute("UPDATE messages SET status = 'failed', attempts = ?, lastError = ? WHERE id = ?", (attempts + 1, error, mid))
+    else:
+        conn.execute("UPDATE messages SET attempts = ?, nextAttempt = ?, lastError = ? WHERE id = ?",
+                     (attempts + 1, time.time() + retryDelay(config, attempts + 1), error, mid))
+    conn.commit()
+
+
+def sendEmails(config, conn, messages):
+    '''
+    Send a batch of emails over one SMTP connection
+    '''
+    try:
+        s = smtplib.SMTP(config.get("Email", "host"), timeout=60)
+    except:
+        err = "{}: {}".format(sys.exc_info()[0].__name__, sys.exc_info()[1])
+        syslog.syslog("[outbox] Couldn't connect to {}: {}\n".format(config.get("Email", "host"), err))
+        for mid, payload, attempts in messages:
+            markFailed(config, conn, mid, attempts, err)
+        return
+
+    try:
+        for i, (mid, payload, attempts) in enumerate(messages):
+            msg = MIMEText(payload["body"])
+            msg['Subject'] = payload["subject"]
+            msg['From'] = config.get("Email", "fromAddress")
+            msg['To'] = payload["to"]
+            try:
+                s.send_message(msg)
+                markSent(conn, mid)
+            except smtplib.SMTPServerDisconnected:
+                # As when we can't connect, this and the remaining messages are retried after the backoff
+                err = "{}: {}".format(sys.exc_info()[0].__name__, sys.exc_info()[1])
+                syslog.syslog("[outbox] Disconnected from {}: {}\n".format(config.get("Email", "host"), err))
+                for mid, payload, attempts in messages[i:]:
+                    markFailed(config, conn, mid, attempts, err)
+                return
+            except:
+                err = "{}: {}".format(sys.exc_info()[0].__name__, sys.exc_info()[1])
+                syslog.syslog("[outbox] Couldn't send \"{}\": {}\n".format(payload["subject"], err))
+                markFailed(config, conn, mid, attempts, err)
+    finally:
+        try:
+            s.quit()
+        except:
+            pass
+
+
+def parkourSession():
+    global _session
+    if _session is None:
+        import requests
+        _session = requests.Session()
+    return _session
+
+
+def sendParkour(config, conn, messages):
+    for mid, payload, attempts in messages:
+        try:
+            res = parkourSession().post(config.get("parkour", "URL"), auth=(config.get("parkour", "user"), config.get("parkour", "password")), data=payload, timeout=120)
+        except:
+            err = "{}: {}".format(sys.exc_info()[0].__name__, sys.exc_info()[1])
+            syslog.syslog("[outbox] Couldn't update Parkour: {}\n".format(err))
+            markFailed(config, conn, mid, attempts, err)
+            continue
+
+        if res.status_code == 200:
+            syslog.syslog("[outbox] Parkour: updated {}\n".format(payload.get("flowcell_id")))
+            markSent(conn, mid)
+        elif res.status_code >= 500:
+            markFailed(config, conn, mid, attempts, "status {}: {}".format(res.status_code, res.text))
+        else:
+            err = "Parkour returned {}, status {}\nSent: {}".format(res.text, res.status_code, payload)
+            markFailed(config, conn, mid, attempts, err, final=True)
+            enqueue(config, "email", {"subject": "[bcl2fastq_pipeline] Error",
+                                      "to": config.get("Email", "errorTo"),
+                                      "body": "Couldn't update Parkour for {}\n{}".format(payload.get("flowcell_id"), err)})
+
+
+def drain(config):
+    '''
+    Try to deliver every message that's due. Returns the number of seconds until the next retry, or None if nothing is pending.
+    '''
+    conn = openOutbox(config)
+    try:
+        now = time.time()
+        rows = conn.execute("SELECT id, kind, payload, attempts FROM messages WHERE status = 'pending' AND nextAttempt <= ? ORDER BY id", (now,)).fetchall()
+        emails = [(mid, json.loads(payload), attempts) for mid, kind, payload, attempts in rows if kind == "email"]
+        parkour = [(mid, json.loads(payload), attempts) for mid, kind, payload, attempts in rows if kind == "parkour"]
+        if len(emails) > 0:
+            sendEmails(config, conn, emails)
+        if len(parkour) > 0:
+            sendParkour(config, conn, parkour)
+
+        conn.execute("DELETE FROM messages WHERE status != 'pending' AND created < ?", (now - KEEP_SENT,))
+        conn.commit()
+
+        rv = conn.execute("SELECT MIN(nextAttempt) FROM messages WHERE status = 'pending'").fetchone()[0]
+        if rv is None:
+            return None
+        return max(0, rv - time.time())
+    finally:
+        conn.close()
+
+
+def outboxLoop(config):
+    while True:
+        _wake.clear()
+        delay = None
+        try:
+            delay = drain(config)
+        except:
+            syslog.syslog("[outbox] Error: {}\n".format(sys.exc_info()[1]))
+            delay = 60
+        _wake.wait(timeout=delay)
+
+
+def startOutbox(config):
+    '''
+    Start delivering queued messages in a daemon thread. Returns the thread.
+    '''
+    global _thread
+    _thread = threading.Thread(target=outboxLoop, args=(config,), name="outbox", daemon=True)
+    _thread.start()
+    return _thread
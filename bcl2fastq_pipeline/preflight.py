@@ -0,0 +1,114 @@
+'''
+Check barcode orientations while a run is still sequencing.
+
+handleRevComp() only needs the index cycles, which are written long before the
+last read finishes. Every [Options]->preflightInterval minutes, runs in baseDir
+without an RTAComplete.txt are checked to see if their index cycles are done.
+If so, getSampleSheets(fullSheets=True) is run and its output stored in the run
+registry, where newFlowCell() will pick it up once the run completes rather
+than decoding the BCL files then.
+'''
+import os
+import sys
+import syslog
+import threading
+import time
+import xml.etree.ElementTree as ET
+from bcl2fastq_pipeline import runRegistry
+from bcl2fastq_pipeline.findFlowCells import listRunDirs, getSampleSheets
+
+
+def lastIndexCycle(d):
+    '''
+    Parse RunInfo.xml to find the last cycle of the last index read. Returns
+    None if there's no index read or if nothing is sequenced after it (in which
+    case we might as well wait for RTAComplete.txt).
+    '''
+    tree = ET.parse("{}/RunInfo.xml".format(d))
+    root = tree.getroot()[0]
+    cycle = 0
+    last = None
+    for node in root.iter("Read"):
+        cycle += int(node.get("NumCycles"))
+        if node.get("IsIndexedRead") == "Y":
+            last = cycle
+    if last is None or last == cycle:
+        return None
+    return last
+
+
+def cycleStarted(d, cycle, lane=1):
+    '''
+    Has the sequencer started writing a given cycle? This is a C<n>.1 directory
+    (HiSeq, MiSeq, NovaSeq) or a <n>.bcl.bgzf file (NextSeq).
+    '''
+    base = "{}/Data/Intensities/BaseCalls/L00{}".format(d, lane)
+    return os.path.exists("{}/C{}.1".format(base, cycle)) or os.path.exists("{}/{:04d}.bcl.bgzf".format(base, cycle))
+
+
+def indexCyclesDone(d):
+    '''
+    True once the cycle following the last index cycle has been started, at which point all index cycles are complete
+    '''
+    try:
+        last = lastIndexCycle(d)
+    except:
+        return False
+    if last is None:
+        return False
+    return cycleStarted(d, last + 1)
+
+
+def preflightRuns(config):
+    '''
+    Check the barcode orientation of each unfinished run whose index cycles are done and that hasn't been checked yet
+    '''
+    conn = runRegistry.openRegistry(config)
+    try:
+        for d in listRunDirs(config):
+            if os.path.basename(d)[:6] < "190813":
+                continue
+            if os.path.exists("{}/RTAComplete.txt".format(d)):
+                continue
+            ssSignature = runRegistry.sampleSheetSignature(d)
+            if ssSignature == "[]":
+                continue
+            if runRegistry.getFullSheets(conn, d, ssSignature) is not None:
+                continue
+            if not indexCyclesDone(d):
+                continue
+
+            syslog.syslog("[preflight] Checking barcodes in {}\n".format(d))
+            try:
+                sampleSheet, lanes, bcLens = getSampleSheets(d, fullSheets=True, config=config)
+            except:
+                # e.g., the filter files aren't written yet, try again next time
+                syslog.syslog("[preflight] Couldn't check {} ({})\n".format(d, sys.exc_info()[1]))
+                continue
+            # The sample sheet may have been replaced in the meantime
+            if runRegistry.sampleSheetSignature(d) == ssSignature:
+                runRegistry.storeFullSheets(conn, d, ssSignature, sampleSheet, lanes, bcLens)
+    finally:
+        conn.close()
+
+
+def preflightLoop(config):
+    interval = 60 * float(config.get("Options", "preflightInterval"))
+    while True:
+        try:
+            preflightRuns(config)
+        except:
+            syslog.syslog("[preflight] Error: {}\n".format(sys.exc_info()[1]))
+        time.sleep(interval)
+
+
+def startPreflight(config):
+    '''
+    Start checking running flow cells in a daemon thread. Returns the thread, or None if [Options]->preflightInterval isn't set.
+    '''
+    interval = config.get("Options", "preflightInterval", fallback="")
+    if interval == "" or float(interval) <= 0:
+        return None
+    t = threading.Thread(target=preflightLoop, args=(config,), name="preflight", daemon=True)
+    t.start()
+    return t
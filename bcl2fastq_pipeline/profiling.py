@@ -0,0 +1,111 @@
+'''
+Opt-in profiling of each pipeline stage and pool worker.
+
+Profiling is on if [Options]->profile is true, or after bfq.py receives
+SIGUSR1 (a second SIGUSR1 turns it back off). A flow cell that starts being
+processed while profiling is on is profiled until it's finished, including in
+the postMakeSteps pool workers.
+
+Each profiled stage is run under cProfile and tracemalloc, and writes to
+logDir/<runID><lanes>/profile/:
+
+  * <stage>.<pid>.<time>.pstats, which can be read with pstats or snakeviz
+  * <stage>.<pid>.<time>.allocations.txt, the peak traced memory, the lines
+    whose (still allocated) memory grew the most during the stage and the
+    functions taking the most cumulative time
+
+tracemalloc is process wide, so allocations from other flow cells processed at
+the same time are included. When profiling is off, the overhead is a single
+config lookup per stage.
+'''
+import os
+import io
+import re
+import time
+import pstats
+import syslog
+import cProfile
+import threading
+import contextlib
+import tracemalloc
+from bcl2fastq_pipeline.metrics import runName
+
+# Set by SIGUSR1 in bfq.py
+_forced = False
+# Stages run within other stages (in the same thread) aren't profiled separately
+_local = threading.local()
+# The number of stages being traced, tracemalloc is stopped once that's back to 0
+_tracing = 0
+_lock = threading.Lock()
+TOP_ALLOCATIONS = 25
+
+
+def toggle():
+    global _forced
+    _forced = not _forced
+    syslog.syslog("[profiling] Profiling is now {}\n".format("on" if _forced else "off"))
+
+
+def enabled(config):
+    return _forced or config.getboolean("Options", "profile", fallback=False)
+
+
+def profileDir(config):
+    return os.path.join(config.get("Paths", "logDir"), runName(config), "profile")
+
+
+def writeReports(config, name, prof, before, peak):
+    d = profileDir(config)
+    os.makedirs(d, exist_ok=True)
+    prefix = os.path.join(d, "{}.{}.{}".format(re.sub(r"[^\w.-]", "_", name), os.getpid(), time.strftime("%Y%m%d-%H%M%S")))
+    prof.dump_stats("{}.pstats".format(prefix))
+
+    f = open("{}.allocations.txt".format(prefix), "w")
+    f.write("Peak traced memory: {:.1f} MiB\n\n".format(peak / 1024. / 1024.))
+    if before is not None:
+        stats = tracemalloc.take_snapshot().compare_to(before, "lineno")
+        f.write("Top {} allocations still held after {}:\n".format(TOP_ALLOCATIONS, name))
+        for stat in stats[:TOP_ALLOCATIONS]:
+            f.write("{}\n".format(stat))
+    s = io.StringIO()
+    pstats.Stats(prof, stream=s).sort_stats("cumulative").print_stats(TOP_ALLOCATIONS)
+    f.write("\nTop {} functions by cumulative time:\n{}".format(TOP_ALLOCATIONS, s.getvalue()))
+    f.close()
+
+
+@contextlib.contextmanager
+def profiled(config, name):
+    '''
+    Profile the enclosed block, if profiling is enabled. Reports are written
+    once it finishes, whether or not an exception was raised.
+    '''
+    if not enabled(config) or getattr(_local, "active", False):
+        yield
+        return
+
+    global _tracing
+    _local.active = True
+    with _lock:
+        if _tracing == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        _tracing += 1
+    before = tracemalloc.take_snapshot()
+    tracemalloc.reset_peak()
+    prof = cProfile.Profile()
+    prof.enable()
+    try:
+        yield
+    finally:
+        prof.disable()
+        peak = tracemalloc.get_traced_memory()[1]
+        try:
+            # There's nowhere useful to write reports for newFlowCell if no flow cell was found
+            if runName(config) != "":
+                writeReports(config, name, prof, before, peak)
+        except:
+            syslog.syslog("[profiling] Couldn't write the profile of {}\n".format(name))
+        with _lock:
+            _tracing -= 1
+            if _tracing == 0:
+                tracemalloc.stop()
+        _local.active = False
@@ -0,0 +1,184 @@
+'''
+A persistent registry of run folders under baseDir.
+
+newFlowCell() used to glob baseDir, parse every sample sheet and stat every
+fastq.made on every wake up. This keeps what was learned about each run folder
+in an sqlite database, so only folders that are new or have changed since the
+last look need to be touched.
+
+For each run folder the following is stored:
+  * The mtime of the run folder itself
+  * The mtime of RTAComplete.txt
+  * A signature of the SampleSheet*.csv files (names and mtimes)
+  * The lane groups from getSampleSheets() (sample sheet, lanes, bcLen)
+  * Whether each lane group has been processed (i.e., has fastq.made)
+  * The sample sheets with barcode orientations checked (i.e., the output of
+    getSampleSheets(fullSheets=True)), which may be made before the run finishes
+
+For each processed output directory (runID plus lanes suffix, relative to
+outputDir), whether it was delivered to the groups and Galaxy and whether it has
+since been evicted by the space manager is also stored.
+'''
+import os
+import glob
+import json
+import sqlite3
+import time
+
+
+def registryPath(config):
+    '''
+    The registry lives in [Paths]->registry, or outputDir/runRegistry.sqlite by default
+    '''
+    p = config.get("Paths", "registry", fallback="")
+    if p == "":
+        p = os.path.join(config.get("Paths", "outputDir"), "runRegistry.sqlite")
+    return p
+
+
+def openRegistry(config):
+    conn = sqlite3.connect(registryPath(config), timeout=60)
+    conn.execute("""CREATE TABLE IF NOT EXISTS runs (
+                    runDir TEXT PRIMARY KEY,
+                    dirMtime REAL,
+                    rtaMtime REAL,
+                    ssSignature TEXT)""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS groups (
+                    runDir TEXT,
+                    idx INTEGER,
+                    sampleSheet TEXT,
+                    lanes TEXT,
+                    bcLen TEXT,
+                    processed INTEGER,
+                    PRIMARY KEY (runDir, idx))""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS fullSheets (
+                    runDir TEXT PRIMARY KEY,
+                    ssSignature TEXT,
+                    sheets TEXT)""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS delivered (
+                    outputName TEXT PRIMARY KEY,
+                    finished REAL,
+                    transferred INTEGER,
+                    galaxy INTEGER,
+                    evicted REAL)""")
+    conn.commit()
+    return conn
+
+
+def getMtime(path):
+    '''
+    Return the mtime of a path or None if it doesn't exist
+    '''
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+def sampleSheetSignature(d):
+    '''
+    A string that changes whenever a sample sheet is added, removed or modified
+    '''
+    sig = []
+    for ss in sorted(glob.glob("{}/SampleSheet*.csv".format(d))):
+        sig.append([os.path.basename(ss), getMtime(ss)])
+    return json.dumps(sig)
+
+
+def getRun(conn, d):
+    '''
+    Return (dirMtime, rtaMtime, ssSignature) or None if the folder isn't registered
+    '''
+    return conn.execute("SELECT dirMtime, rtaMtime, ssSignature FROM runs WHERE runDir = ?", (d,)).fetchone()
+
+
+def getGroups(conn, d):
+    '''
+    Return a list of [sampleSheet, lanes, bcLen, processed] entries in the order that getSampleSheets() produced them
+    '''
+    rv = []
+    for ss, lanes, bcLen, processed in conn.execute("SELECT sampleSheet, lanes, bcLen, processed FROM groups WHERE runDir = ? ORDER BY idx", (d,)):
+        rv.append([ss, lanes, bcLen, bool(processed)])
+    return rv
+
+
+def allProcessed(conn, d):
+    '''
+    True if the run is registered and every lane group has been processed
+    '''
+    n, nDone = conn.execute("SELECT COUNT(*), SUM(processed) FROM groups WHERE runDir = ?", (d,)).fetchone()
+    return n > 0 and n == nDone
+
+
+def storeRun(conn, d, dirMtime, rtaMtime, ssSignature, sampleSheets, lanes, bcLens):
+    '''
+    (Re)register a run folder along with the output of getSampleSheets(). Any
+    previous processed state is dropped, since the lane groups may have changed.
+    '''
+    conn.execute("DELETE FROM groups WHERE runDir = ?", (d,))
+    conn.execute("INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?)", (d, dirMtime, rtaMtime, ssSignature))
+    for idx, (ss, lane, bcLen) in enumerate(zip(sampleSheets, lanes, bcLens)):
+        conn.execute("INSERT INTO groups VALUES (?, ?, ?, ?, ?, 0)", (d, idx, ss, lane, bcLen))
+    conn.commit()
+
+
+def touchRun(conn, d, dirMtime):
+    '''
+    Record a new folder mtime for an otherwise unchanged run
+    '''
+    conn.execute("UPDATE runs SET dirMtime = ? WHERE runDir = ?", (dirMtime, d))
+    conn.commit()
+
+
+def markProcessed(conn, d, lanes, processed=True):
+    '''
+    Set the processed state of every lane group of a run with the given lanes ("" for none)
+    '''
+    conn.execute("UPDATE groups SET processed = ? WHERE runDir = ? AND COALESCE(lanes, '') = ?", (int(processed), d, lanes))
+    conn.commit()
+
+
+def getFullSheets(conn, d, ssSignature):
+    '''
+    Return the stored (sampleSheets, lanes, bcLens) from getSampleSheets(fullSheets=True), or None if
+    there are none for the current sample sheets
+    '''
+    row = conn.execute("SELECT sheets FROM fullSheets WHERE runDir = ? AND ssSignature = ?", (d, ssSignature)).fetchone()
+    if row is None:
+        return None
+    return tuple(json.loads(row[0]))
+
+
+def storeFullSheets(conn, d, ssSignature, sampleSheets, lanes, bcLens):
+    conn.execute("INSERT OR REPLACE INTO fullSheets VALUES (?, ?, ?)", (d, ssSignature, json.dumps([sampleSheets, lanes, bcLens])))
+    conn.commit()
+
+
+def markDelivered(conn, outputName, transferred, galaxy):
+    '''
+    Record that an output directory has been processed, and whether the transfer to the groups and Galaxy worked
+    '''
+    conn.execute("INSERT OR REPLACE INTO delivered VALUES (?, ?, ?, ?, NULL)", (outputName, time.time(), int(transferred), int(galaxy)))
+    conn.commit()
+
+
+def getEvictable(conn):
+    '''
+    Return a list of (outputName, finished time) for fully delivered and not yet evicted output directories, oldest first
+    '''
+    return conn.execute("SELECT outputName, finished FROM delivered WHERE transferred = 1 AND galaxy = 1 AND evicted IS NULL ORDER BY finished").fetchall()
+
+
+def markEvicted(conn, outputName):
+    conn.execute("UPDATE delivered SET evicted = ? WHERE outputName = ?", (time.time(), outputName))
+    conn.commit()
+
+
+def forgetRun(conn, d):
+    '''
+    Remove a run from the registry, it will be rescanned on the next wake up
+    '''
+    conn.execute("DELETE FROM groups WHERE runDir = ?", (d,))
+    conn.execute("DELETE FROM fullSheets WHERE runDir = ?", (d,))
+    conn.execute("DELETE FROM runs WHERE runDir = ?", (d,))
+    conn.commit()
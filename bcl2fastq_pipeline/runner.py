@@ -0,0 +1,162 @@
+'''
+Run external tools as argv lists, with resource accounting, timeouts and priorities.
+
+Every external program (bcl2fastq, bgzip, seqtk, fastq_screen, FastQC,
+md5sum, MultiQC, clumpify, splitFastq, tar and fexsend) is started through
+runCommand() or spawn(). For each invocation:
+
+  * Its CPU time, max RSS and block I/O (from wait4()'s rusage) are appended
+    to the metrics file as a "command" record (see metrics.py), which is what
+    postMakeThreads and deduplicateInstances should be sized from.
+  * Its stdout and stderr, unless redirected elsewhere, go to
+    logDir/<runID><lanes>/tasks/<tool>.<label>.stdout/.stderr
+  * It's killed (along with any children) if it runs longer than the
+    timeout_<tool> minutes under [Runner], or timeout if that's not set.
+  * It's run under nice and ionice if [Runner]->nice and ioniceClass (or
+    their nice_<tool>/ioniceClass_<tool> versions) are set.
+
+Failures raise subprocess.CalledProcessError or subprocess.TimeoutExpired, as
+subprocess.check_call() would.
+'''
+import os
+import re
+import time
+import signal
+import syslog
+import threading
+import subprocess
+from bcl2fastq_pipeline import metrics
+
+# Seconds between SIGTERM and SIGKILL when a tool times out
+KILL_GRACE = 30
+
+
+def setting(config, name, tool):
+    '''
+    [Runner]->name_tool, falling back to [Runner]->name, or "" if neither is set
+    '''
+    return config.get("Runner", "{}_{}".format(name, tool), fallback=config.get("Runner", name, fallback=""))
+
+
+def prefix(config, tool):
+    '''
+    The nice/ionice commands to run a tool under
+    '''
+    rv = []
+    niceness = setting(config, "nice", tool)
+    if niceness != "":
+        rv.extend(["nice", "-n", niceness])
+    ioniceClass = setting(config, "ioniceClass", tool)
+    if ioniceClass != "":
+        rv.extend(["ionice", "-c", ioniceClass])
+        ioniceLevel = setting(config, "ioniceLevel", tool)
+        if ioniceLevel != "" and ioniceClass in ["1", "2"]:
+            rv.extend(["-n", ioniceLevel])
+    return rv
+
+
+def taskLog(config, tool, label, stream):
+    d = os.path.join(config.get("Paths", "logDir"), metrics.runName(config), "tasks")
+    os.makedirs(d, exist_ok=True)
+    name = tool if label == "" else "{}.{}".format(tool, label)
+    return open(os.path.join(d, "{}.{}".format(re.sub(r"[^\w.-]", "_", name), stream)), "w")
+
+
+class Task(object):
+    '''
+    A running tool, see spawn()
+    '''
+    def __init__(self, config, tool, argv, label="", stdin=None, stdout=None, stderr=None, cwd=None):
+        self.config = config
+        self.tool = tool
+        self.argv = [str(x) for x in argv]
+        self.label = label
+        self.timedOut = False
+
+        self.logs = []
+        if stdout is None:
+            stdout = taskLog(config, tool, label, "stdout")
+            self.logs.append(stdout)
+        if stderr is None:
+            stderr = taskLog(config, tool, label, "stderr")
+            self.logs.append(stderr)
+
+        syslog.syslog("[runner] Running {}\n".format(" ".join(self.argv)))
+        self.started = time.time()
+        self.t0 = time.perf_counter()
+        # Its own session, so a timeout kills any children too (e.g., the java started by clumpify.sh)
+        self.proc = subprocess.Popen(prefix(config, tool) + self.argv, stdin=stdin, stdout=stdout, stderr=stderr, cwd=cwd, start_new_session=True)
+        self.stdout = self.proc.stdout
+
+        self.timers = []
+        timeout = setting(config, "timeout", tool)
+        self.timeout = None
+        if timeout != "" and float(timeout) > 0:
+            self.timeout = 60 * float(timeout)
+            self.timers.append(threading.Timer(self.timeout, self.kill, args=(signal.SIGTERM,)))
+            self.timers.append(threading.Timer(self.timeout + KILL_GRACE, self.kill, args=(signal.SIGKILL,)))
+            for t in self.timers:
+                t.daemon = True
+                t.start()
+
+    def kill(self, sig):
+        if self.proc.returncode is not None:
+            return
+        if sig == signal.SIGTERM:
+            syslog.syslog("[runner] {} timed out after {} seconds, killing it\n".format(" ".join(self.argv), self.timeout))
+        self.timedOut = True
+        try:
+            os.killpg(self.proc.pid, sig)
+        except OSError:
+            pass
+
+    def wait(self, check=True):
+        '''
+        Wait for the tool to finish and record its resource usage. Returns its exit code.
+        '''
+        pid, status, ru = os.wait4(self.proc.pid, 0)
+        wall = time.perf_counter() - self.t0
+        self.proc.returncode = os.waitstatus_to_exitcode(status)
+        for t in self.timers:
+            t.cancel()
+        for f in self.logs:
+            f.close()
+        if self.stdout is not None:
+            self.stdout.close()
+
+        metrics.record(self.config, "command", self.started, wall,
+                       status="timeout" if self.timedOut else ("ok" if self.proc.returncode == 0 else "failed"),
+                       prom=False,
+                       tool=self.tool,
+                       label=self.label,
+                       argv=self.argv,
+                       exitCode=self.proc.returncode,
+                       userTime=round(ru.ru_utime, 3),
+                       systemTime=round(ru.ru_stime, 3),
+                       maxRSS=ru.ru_maxrss * 1024,
+                       blockIn=ru.ru_inblock,
+                       blockOut=ru.ru_oublock)
+
+        if check and self.timedOut:
+            raise subprocess.TimeoutExpired(self.argv, self.timeout)
+        if check and self.proc.returncode != 0:
+            raise subprocess.CalledProcessError(self.proc.returncode, self.argv)
+        return self.proc.returncode
+
+
+def spawn(config, tool, argv, label="", stdin=None, stdout=None, stderr=None, cwd=None):
+    '''
+    Start a tool without waiting for it, e.g., for the first command of a
+    pipe (use stdout=subprocess.PIPE and then the .stdout of the returned
+    Task). Call .wait() on the result.
+    '''
+    return Task(config, tool, argv, label=label, stdin=stdin, stdout=stdout, stderr=stderr, cwd=cwd)
+
+
+def runCommand(config, tool, argv, label="", stdin=None, stdout=None, stderr=None, cwd=None, check=True):
+    '''
+    Run a tool and wait for it to finish. stdout/stderr default to per-task
+    log files. label distinguishes the invocations of a tool, e.g., the sample
+    name. Returns the exit code.
+    '''
+    return spawn(config, tool, argv, label=label, stdin=stdin, stdout=stdout, stderr=stderr, cwd=cwd).wait(check=check)
@@ -0,0 +1,84 @@
+'''
+Optionally demultiplex and post-process on a fast local scratch volume.
+
+If [Paths]->scratchDir is set, bcl2fastq, fixNames, postMakeSteps and the
+reports all work in scratchDir/<runID><lanes> rather than outputDir, which
+avoids lots of random I/O on the shared volume (clumpify and FastQC in
+particular). Once done, the whole tree is moved to outputDir in one go and a
+file named "promoted" is written there, after which any remaining (or
+repeated) steps use outputDir as usual.
+
+A flow cell is only staged on scratch if its predicted footprint (see
+spaceEstimate.py) leaves [Options]->scratchMinSpace gigs free there.
+Otherwise it's processed directly in outputDir.
+'''
+import os
+import shutil
+import syslog
+from bcl2fastq_pipeline.getConfig import copyConfig
+from bcl2fastq_pipeline.findFlowCells import outputName
+from bcl2fastq_pipeline.spaceEstimate import remainingFootprint, usedBytes
+from bcl2fastq_pipeline.runRegistry import registryPath
+
+# Moved last, in this order, so an interrupted move never leaves outputDir looking demultiplexed without the data
+MARKERS = ["files.renamed", "bcl.done"]
+
+
+def scratchConfig(config):
+    '''
+    A copy of config with outputDir pointing to scratchDir
+    '''
+    c = copyConfig(config)
+    # This defaults to being under outputDir
+    c.set("Paths", "registry", registryPath(config))
+    c.set("Paths", "outputDir", config.get("Paths", "scratchDir"))
+    return c
+
+
+def useScratch(config):
+    '''
+    Should this flow cell be staged on scratch? This is True if scratchDir is
+    set, the flow cell hasn't already been promoted to outputDir and there's
+    space for it (or it's already partially there).
+    '''
+    if config.get("Paths", "scratchDir", fallback="") == "":
+        return False
+    if os.path.exists(os.path.join(config.get("Paths", "outputDir"), outputName(config), "promoted")):
+        return False
+
+    sConfig = scratchConfig(config)
+    if os.path.exists(os.path.join(sConfig.get("Paths", "outputDir"), outputName(config))):
+        return True
+    (tot, used, free) = shutil.disk_usage(sConfig.get("Paths", "outputDir"))
+    free -= remainingFootprint(sConfig)
+    if free / 1024. / 1024. / 1024. < float(config.get("Options", "scratchMinSpace", fallback="0")):
+        syslog.syslog("[scratch] Not enough space for {}, processing it in outputDir\n".format(outputName(config)))
+        return False
+    return True
+
+
+def promote(config, finalConfig):
+    '''
+    Move everything in the scratch directory of a flow cell to outputDir, replacing anything already there
+    '''
+    src = os.path.join(config.get("Paths", "outputDir"), outputName(config))
+    dst = os.path.join(finalConfig.get("Paths", "outputDir"), outputName(config))
+    os.makedirs(dst, exist_ok=True)
+
+    (tot, used, free) = shutil.disk_usage(dst)
+    size = usedBytes(src)
+    if size > free:
+        raise RuntimeError("Not enough space to move {} ({} bytes) to {}".format(src, size, dst))
+
+    syslog.syslog("[scratch] Moving {} to {}\n".format(src, dst))
+    names = sorted(os.listdir(src))
+    names = [f for f in names if f not in MARKERS] + [f for f in MARKERS if f in names]
+    for f in names:
+        target = os.path.join(dst, f)
+        if os.path.isdir(target) and not os.path.islink(target):
+            shutil.rmtree(target)
+        elif os.path.lexists(target):
+            os.remove(target)
+        shutil.move(os.path.join(src, f), target)
+    os.rmdir(src)
+    open(os.path.join(dst, "promoted"), "w").close()
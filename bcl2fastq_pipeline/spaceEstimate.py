@@ -0,0 +1,184 @@
+'''
+Predict how much space in outputDir processing a flow cell will need.
+
+The prediction uses RunInfo.xml (reads, lanes and tiles) and the cluster counts
+in the CBCL headers (NovaSeq) or filter files (everything else), falling back
+to typical per-lane cluster counts if those can't be read. On top of the final
+fastq files it includes the peak size of the intermediate files:
+
+  * clumpify's temp.fq.gz and the rewritten fastq files (HiSeq 3000, NovaSeq and NextSeq)
+  * the uncompressed fastq_screen subsamples
+  * the FASTQC_* directories
+
+The defaults below are deliberately a bit pessimistic and can be overridden
+under [Options] (see bcl2fastq.ini).
+'''
+import os
+import struct
+import codecs
+import xml.etree.ElementTree as ET
+from bcl2fastq_pipeline.findFlowCells import getRunType
+
+# Used if the cluster counts can't be read, these are the maximum that the instruments produce
+DEFAULT_CLUSTERS = {"MiSeq": 25e6,
+                    "NextSeq": 400e6,  # Over all 4 lanes
+                    "HiSeq2500": 300e6,
+                    "HiSeq3000": 400e6,
+                    "NovaSeq": 2.5e9}
+# The fraction of clusters passing filter, where only raw counts are available
+PF_FRACTION = 0.8
+# Compressed fastq bytes per base (sequence and quality) and per read (the read name, etc.)
+GZ_BYTES_PER_BASE = 0.8
+GZ_BYTES_PER_READ = 15
+FASTQC_BYTES_PER_FILE = 1024 * 1024
+
+
+def readRunInfo(d):
+    '''
+    Return a dictionary with the lane count, tiles per lane and a list of (NumCycles, isIndex) per read
+    '''
+    root = ET.parse("{}/RunInfo.xml".format(d)).getroot()[0]
+    rv = {"lanes": 1, "tiles": 1, "reads": []}
+    layout = root.find("FlowcellLayout")
+    if layout is not None:
+        rv["lanes"] = int(layout.get("LaneCount", 1))
+        rv["tiles"] = int(layout.get("SurfaceCount", 1)) * int(layout.get("SwathCount", 1)) * int(layout.get("TileCount", 1))
+    for node in root.iter("Read"):
+        rv["reads"].append((int(node.get("NumCycles")), node.get("IsIndexedRead") == "Y"))
+    return rv
+
+
+def cbclClusters(fname):
+    '''
+    The total number of (passing filter) clusters over all tiles in a CBCL file header
+    '''
+    f = open(fname, "rb")
+    version, headerSize, bitsPerBase, bitsPerQScore, QBins = struct.unpack("<HIBBI", f.read(12))
+    f.seek(8 * QBins, os.SEEK_CUR)
+    nTiles = struct.unpack("<I", f.read(4))[0]
+    tiles = f.read(16 * nTiles)
+    f.close()
+    total = 0
+    for i in range(nTiles):
+        total += struct.unpack_from("<IIII", tiles, 16 * i)[1]
+    return total
+
+
+def filterClusters(fname):
+    '''
+    The total (raw) number of clusters in a filter file
+    '''
+    f = open(fname, "rb")
+    nClusters = struct.unpack("<III", f.read(12))[2]
+    f.close()
+    return nClusters
+
+
+def clustersPerLane(d, runType, lane, info):
+    '''
+    Estimate the number of clusters passing filter in a lane
+    '''
+    base = "{}/Data/Intensities/BaseCalls/L00{}".format(d, lane)
+    try:
+        if runType == "NovaSeq":
+            total = 0
+            for surface in [1, 2]:
+                fname = "{}/C1.1/L00{}_{}.cbcl".format(base, lane, surface)
+                if os.path.exists(fname):
+                    total += cbclClusters(fname)
+            if total > 0:
+                return total
+        elif runType == "NextSeq":
+            return PF_FRACTION * filterClusters("{}/s_{}.filter".format(base, lane))
+        else:
+            # Extrapolate from the first tile
+            return PF_FRACTION * info["tiles"] * filterClusters("{}/s_{}_1101.filter".format(base, lane))
+    except:
+        pass
+    return DEFAULT_CLUSTERS[runType] / (info["lanes"] if runType == "NextSeq" else 1)
+
+
+def countSamples(config):
+    '''
+    The number of samples in the (rewritten) sample sheet, or 1
+    '''
+    ss = config.get("Options", "sampleSheet")
+    if ss == "" or not os.path.isfile(ss):
+        return 1
+    n = 0
+    inData = False
+    for line in codecs.open(ss, "r", "iso-8859-1"):
+        if line.startswith("[Data]"):
+            inData = True
+            continue
+        if inData and line.strip() != "":
+            n += 1
+    return max(1, n - 1)  # Skip the header
+
+
+def predictFootprint(config):
+    '''
+    Predict the bytes needed in outputDir to process the flow cell in config. 0 is returned if RunInfo.xml can't be read.
+    '''
+    d = "{}/{}".format(config.get("Paths", "baseDir"), config.get("Options", "runID"))
+    try:
+        info = readRunInfo(d)
+    except:
+        return 0
+    runType = getRunType(d)
+
+    lanes = config.get("Options", "lanes")
+    if lanes != "":
+        lanes = [int(x) for x in lanes.split("_")]
+    else:
+        lanes = range(1, info["lanes"] + 1)
+    clusters = 0
+    for lane in lanes:
+        clusters += clustersPerLane(d, runType, lane, info)
+
+    reads = [x[0] for x in info["reads"] if not x[1]]
+    bytesPerBase = float(config.get("Options", "gzBytesPerBase", fallback=GZ_BYTES_PER_BASE))
+    output = clusters * (sum(reads) * bytesPerBase + len(reads) * GZ_BYTES_PER_READ)
+
+    nSamples = countSamples(config)
+    perSample = output / nSamples
+    peak = 0
+
+    # clumpify writes temp.fq.gz, which splitFastq then rewrites into the final files
+    runID = config.get("Options", "runID")
+    if runID[7] in ["J", "A"] or runID[7:9] == "NB":
+        peak += 2 * perSample * min(nSamples, int(config.get("Options", "deduplicateInstances")))
+
+    # Uncompressed fastq_screen subsamples of read 1
+    if len(reads) > 0:
+        subsample = int(config.get("fastq_screen", "seqtk_size")) * (2 * reads[0] + 60)
+        peak += subsample * min(nSamples, int(config.get("Options", "postMakeThreads")))
+
+    fastqc = nSamples * len(reads) * FASTQC_BYTES_PER_FILE
+
+    return int(output + peak + fastqc)
+
+
+def usedBytes(path):
+    '''
+    The apparent size of everything under a path
+    '''
+    total = 0
+    for r, dirs, files in os.walk(path):
+        for f in files:
+            try:
+                total += os.lstat(os.path.join(r, f)).st_size
+            except OSError:
+                pass
+    return total
+
+
+def remainingFootprint(config):
+    '''
+    The predicted bytes still to be written for a flow cell, i.e., the footprint minus what's already in its output directory
+    '''
+    lanes = config.get("Options", "lanes")
+    if lanes != "":
+        lanes = "_lanes{}".format(lanes)
+    used = usedBytes("{}/{}{}".format(config.get("Paths", "outputDir"), config.get("Options", "runID"), lanes))
+    return max(0, predictFootprint(config) - used)
@@ -0,0 +1,116 @@
+'''
+Free space in outputDir by evicting flow cells that have already been delivered.
+
+Once outputDir is more than [Options]->evictHighWater percent full, the output
+directories of flow cells that were processed (fastq.made) and successfully
+transferred to the groups and linked into Galaxy are evicted, oldest first,
+until usage drops below [Options]->evictLowWater percent. Which directories
+were delivered is recorded in the run registry by the orchestrator. Before
+evicting, projects going to a local group must be present in groupDir and
+every other project (i.e., uploaded with FEX) must have its transfer recorded
+as done in the task ledger.
+
+Evicting a directory removes everything in it except fastq.made, so the flow
+cell isn't processed again, and writes an "evicted" file noting when. Any
+cached barcode frequencies of the run (see barcodeCache.py) are removed too. Every
+eviction (or, with [Options]->evictDryRun, every eviction that would have
+happened) is appended to logDir/spaceManager.log.
+'''
+import os
+import glob
+import shutil
+import syslog
+from time import strftime
+from bcl2fastq_pipeline import runRegistry
+from bcl2fastq_pipeline import barcodeCache
+from bcl2fastq_pipeline import ledger
+from bcl2fastq_pipeline.misc import projectGroup
+from bcl2fastq_pipeline.spaceEstimate import usedBytes
+
+
+def audit(config, msg):
+    syslog.syslog("[spaceManager] {}\n".format(msg))
+    f = open(os.path.join(config.get("Paths", "logDir"), "spaceManager.log"), "a")
+    f.write("{}\t{}\n".format(strftime("%Y-%m-%d %H:%M:%S"), msg))
+    f.close()
+
+
+def isDelivered(config, outputName):
+    '''
+    Double check that an output directory is marked as processed, that every
+    project going to a local group is present in groupDir and that every
+    other project's transfer is recorded as done in the ledger
+    '''
+    d = os.path.join(config.get("Paths", "outputDir"), outputName)
+    if not os.path.exists(os.path.join(d, "fastq.made")):
+        return False
+    for project in glob.glob("{}/Project_*".format(d)):
+        pname = os.path.basename(project)
+        base = os.path.join(config.get("Paths", "groupDir"), projectGroup(pname[8:]), "sequencing_data")
+        if os.path.exists(base):
+            if not os.path.exists(os.path.join(base, outputName, pname)):
+                return False
+        elif not ledger.taskDone(config, outputName, pname[8:], "transferData"):
+            return False
+    return True
+
+
+def evict(d):
+    '''
+    Remove everything in an output directory except fastq.made
+    '''
+    for f in os.listdir(d):
+        if f == "fastq.made":
+            continue
+        p = os.path.join(d, f)
+        if os.path.isdir(p) and not os.path.islink(p):
+            shutil.rmtree(p)
+        else:
+            os.remove(p)
+    open(os.path.join(d, "evicted"), "w").write("{}\n".format(strftime("%Y-%m-%d %H:%M:%S")))
+
+
+def manageSpace(config):
+    '''
+    Evict delivered output directories if outputDir is above the high watermark. Returns the number of bytes (that would have been) freed.
+    '''
+    high = config.get("Options", "evictHighWater", fallback="")
+    if high == "":
+        return 0
+    high = float(high)
+    low = float(config.get("Options", "evictLowWater"))
+    dryRun = config.getboolean("Options", "evictDryRun", fallback=False)
+
+    (tot, used, free) = shutil.disk_usage(config.get("Paths", "outputDir"))
+    if 100. * used / tot < high:
+        return 0
+
+    freed = 0
+    conn = runRegistry.openRegistry(config)
+    try:
+        for outputName, finished in runRegistry.getEvictable(conn):
+            if 100. * (used - freed) / tot < low:
+                break
+            d = os.path.join(config.get("Paths", "outputDir"), outputName)
+            if not os.path.isdir(d):
+                runRegistry.markEvicted(conn, outputName)
+                continue
+            if not isDelivered(config, outputName):
+                audit(config, "Skipping {}, it doesn't appear to have been delivered".format(d))
+                continue
+
+            size = usedBytes(d)
+            if dryRun:
+                audit(config, "Would evict {} ({:.1f} gigs)".format(d, size / 1024. / 1024. / 1024.))
+            else:
+                evict(d)
+                barcodeCache.removeRun(config, outputName.split("_lanes")[0])
+                runRegistry.markEvicted(conn, outputName)
+                audit(config, "Evicted {} ({:.1f} gigs)".format(d, size / 1024. / 1024. / 1024.))
+            freed += size
+    finally:
+        conn.close()
+
+    if 100. * (used - freed) / tot >= low:
+        audit(config, "Still above the low watermark after evicting everything that's been delivered")
+    return freed
@@ -0,0 +1,168 @@
+'''
+Wake the main loop as soon as a run finishes, rather than waiting out sleepTime.
+
+On local filesystems inotify is used to watch baseDir for new run folders and
+each run folder for RTAComplete.txt and SampleSheet*.csv being written. Network
+filesystems (NFS, CIFS, ...) don't deliver inotify events for changes made by
+other hosts (i.e., the sequencers), so there baseDir is instead polled every
+[Options]->watchPollInterval minutes. This polling only stats RTAComplete.txt,
+the folder itself and, for finished runs, its SampleSheet*.csv files, so it's
+far cheaper than newFlowCell().
+
+Either way, the callback (typically setting the Event that bfq.py sleeps on) is
+called whenever something relevant changes.
+'''
+import os
+import sys
+import ctypes
+import ctypes.util
+import fnmatch
+import struct
+import syslog
+import threading
+import time
+from bcl2fastq_pipeline.findFlowCells import listRunDirs, RUN_PATTERNS
+from bcl2fastq_pipeline.runRegistry import sampleSheetSignature
+from bcl2fastq_pipeline.filesystems import getFsType, NETWORK_FS
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+
+def watchMode(config):
+    '''
+    Resolve [Options]->watchMode (off, auto, inotify or poll) to off, inotify or poll
+    '''
+    mode = config.get("Options", "watchMode", fallback="off")
+    if mode == "auto":
+        if not sys.platform.startswith("linux"):
+            return "poll"
+        fsType = getFsType(config.get("Paths", "baseDir"))
+        if fsType is None or fsType in NETWORK_FS:
+            return "poll"
+        return "inotify"
+    return mode
+
+
+def isRunDir(name):
+    for pattern in RUN_PATTERNS:
+        if fnmatch.fnmatch(name, pattern):
+            return True
+    return False
+
+
+def isTrigger(name):
+    return name == "RTAComplete.txt" or fnmatch.fnmatch(name, "SampleSheet*.csv")
+
+
+def snapshot(config):
+    '''
+    The cheap state polled for: the RTAComplete.txt and folder mtimes of each
+    run and, once it has finished, the signature of its sample sheets
+    '''
+    s = dict()
+    for d in listRunDirs(config):
+        try:
+            dirMtime = os.stat(d).st_mtime
+        except OSError:
+            continue
+        try:
+            rtaMtime = os.stat(os.path.join(d, "RTAComplete.txt")).st_mtime
+        except OSError:
+            s[d] = (dirMtime, None, None)
+            continue
+        # Sample sheets edited in place don't change the folder's mtime
+        s[d] = (dirMtime, rtaMtime, sampleSheetSignature(d))
+    return s
+
+
+def pollLoop(config, callback):
+    interval = 60 * float(config.get("Options", "watchPollInterval", fallback="5"))
+    last = snapshot(config)
+    while True:
+        time.sleep(interval)
+        cur = snapshot(config)
+        for d, v in cur.items():
+            if v[1] is not None and last.get(d) != v:
+                syslog.syslog("[watcher] Change seen in {}\n".format(d))
+                callback()
+                break
+        last = cur
+
+
+def inotifyLoop(config, callback):
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    fd = libc.inotify_init1(os.O_CLOEXEC)
+    if fd < 0:
+        raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+    baseDir = config.get("Paths", "baseDir")
+    watches = dict()
+
+    def addWatch(d, mask):
+        wd = libc.inotify_add_watch(fd, os.fsencode(d), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_add_watch failed on {}".format(d))
+        watches[wd] = d
+
+    addWatch(baseDir, IN_CREATE | IN_MOVED_TO)
+    for d in listRunDirs(config):
+        addWatch(d, IN_CREATE | IN_CLOSE_WRITE | IN_MOVED_TO)
+
+    while True:
+        buf = os.read(fd, 65536)
+        offset = 0
+        wake = False
+        while offset < len(buf):
+            wd, mask, cookie, nameLen = struct.unpack_from("iIII", buf, offset)
+            name = os.fsdecode(buf[offset + 16:offset + 16 + nameLen].rstrip(b"\0"))
+            offset += 16 + nameLen
+
+            if mask & IN_Q_OVERFLOW:
+                wake = True
+            elif mask & IN_IGNORED:
+                watches.pop(wd, None)
+            elif watches.get(wd) == baseDir:
+                if mask & IN_ISDIR and isRunDir(name):
+                    d = os.path.join(baseDir, name)
+                    try:
+                        addWatch(d, IN_CREATE | IN_CLOSE_WRITE | IN_MOVED_TO)
+                    except OSError:
+                        # Removed again before we could watch it
+                        continue
+                    # It may have been copied in already complete
+                    if os.path.exists(os.path.join(d, "RTAComplete.txt")):
+                        wake = True
+            elif isTrigger(name):
+                syslog.syslog("[watcher] {} written in {}\n".format(name, watches.get(wd)))
+                wake = True
+        if wake:
+            callback()
+
+
+def watch(config, callback):
+    '''
+    Run the watcher in the current thread, falling back to polling if inotify can't be used
+    '''
+    mode = watchMode(config)
+    if mode == "inotify":
+        try:
+            inotifyLoop(config, callback)
+        except Exception:
+            syslog.syslog("[watcher] inotify unavailable ({}), falling back to polling\n".format(sys.exc_info()[1]))
+    pollLoop(config, callback)
+
+
+def startWatcher(config, callback):
+    '''
+    Start watching baseDir in a daemon thread. Returns the thread, or None if [Options]->watchMode is off.
+    '''
+    if watchMode(config) == "off":
+        return None
+    t = threading.Thread(target=watch, args=(config, callback), name="watcher", daemon=True)
+    t.start()
+    return t
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Benchmark how quickly pyBarcodes.getStats() decodes the index reads of a flow
+cell, in clusters per second. Only the clusters passing filter that are
+actually sampled (up to --sampleSize per lane) are counted. The other
+sampling options can be given to compare their decode times.
+
+For example:
+
+  benchBarcodes.py /data/180215_J00182_0064_AHNVNGBBXX HiSeq3000 --cycles 77-92 --lanes 5,6
+"""
+import argparse
+import struct
+import time
+import os
+from pyBarcodes import getStats
+
+# Tile layout (maxSwath, maxTile) of each run type with filter files
+TILES = {"HiSeq3000": (2, 28), "HiSeq2500": (2, 16), "MiSeq": (1, 19)}
+PF = bytes(b & 1 for b in range(256))
+
+
+def countFilter(fname):
+    '''
+    The number of clusters passing filter in a .filter file
+    '''
+    data = open(fname, "rb").read()[12:]
+    return data.translate(PF).count(1)
+
+
+def cbclClusters(fname):
+    '''
+    The number of clusters in each tile of a CBCL file
+    '''
+    f = open(fname, "rb")
+    f.seek(8)
+    QBins = struct.unpack("<I", f.read(4))[0]
+    f.seek(8 * QBins, 1)
+    nTiles = struct.unpack("<I", f.read(4))[0]
+    rv = [struct.unpack("<IIII", f.read(16))[1] for i in range(nTiles)]
+    f.close()
+    return rv
+
+
+def chosen(tiles, tileStride, randomTiles):
+    '''
+    The tiles sampled, like chooseTiles() in pyBarcodes.c (which tiles are
+    chosen at random differs, but not their number)
+    '''
+    if 0 < randomTiles < len(tiles):
+        return tiles[:randomTiles]
+    return tiles[::tileStride]
+
+
+def sampledClusters(path, runType, lane, args):
+    '''
+    Roughly the number of clusters getStats() looks at in a lane (tiles with
+    fewer clusters than their share are assumed not to occur)
+    '''
+    bc = os.path.join(path, "Data", "Intensities", "BaseCalls")
+    if runType == "NextSeq":
+        return min(countFilter(os.path.join(bc, "L001", "s_1.filter")), args.sampleSize)
+    if runType == "NovaSeq":
+        d = os.path.join(bc, "L00{}".format(lane))
+        cycle = sorted(x for x in os.listdir(d) if x.startswith("C"))[0]
+        good = 0
+        for surface in ([1, 2] if args.bothSurfaces else [1]):
+            fname = os.path.join(d, cycle, "L00{}_{}.cbcl".format(lane, surface))
+            if not args.bothSurfaces and not os.path.exists(fname):
+                fname = os.path.join(d, cycle, "L00{}_2.cbcl".format(lane))
+            good += sum(chosen(cbclClusters(fname), args.tileStride, args.randomTiles))
+        return min(good, args.sampleSize)
+
+    if runType == "MiSeq":
+        lane = 1
+    maxSwath, maxTile = TILES[runType]
+    tiles = []
+    for side in [1, 2]:
+        for swath in range(1, maxSwath + 1):
+            for tile in range(1, maxTile + 1):
+                tiles.append(1000 * side + 100 * swath + tile)
+    good = 0
+    for tileNum in chosen(tiles, args.tileStride, args.randomTiles):
+        good += countFilter(os.path.join(bc, "L00{}".format(lane), "s_{}_{}.filter".format(lane, tileNum)))
+    return min(good, args.sampleSize)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the barcode decoding of pyBarcodes.getStats().")
+    parser.add_argument("path", help="The flow cell directory")
+    parser.add_argument("runType", help="One of HiSeq3000, HiSeq2500, NextSeq, NovaSeq or MiSeq")
+    parser.add_argument("--cycles", required=True, help="The index cycles, e.g., 77-92")
+    parser.add_argument("--lanes", default="1", help="Comma separated lanes (default: %(default)s)")
+    parser.add_argument("--repeats", type=int, default=3, help="The number of times to decode each lane (default: %(default)s)")
+    parser.add_argument("--threads", type=int, default=1, help="Threads inflating NovaSeq CBCL files (default: %(default)s)")
+    parser.add_argument("--sampleSize", type=int, default=1000000, help="Clusters to sample per lane (default: %(default)s)")
+    parser.add_argument("--tileStride", type=int, default=1, help="Use every tileStride'th tile (default: %(default)s)")
+    parser.add_argument("--randomTiles", type=int, default=0, help="Use this many random tiles instead, if above 0 (default: %(default)s)")
+    parser.add_argument("--bothSurfaces", action="store_true", help="Sample both surfaces of NovaSeq lanes")
+    args = parser.parse_args()
+
+    first, last = args.cycles.split("-")
+    cycles = list(range(int(first), int(last) + 1))
+    for lane in [int(x) for x in args.lanes.split(",")]:
+        clusters = sampledClusters(args.path, args.runType, lane, args)
+        times = []
+        for i in range(args.repeats):
+            t = time.perf_counter()
+            getStats(args.path, args.runType, cycles, lane, threads=args.threads, sampleSize=args.sampleSize,
+                     tileStride=args.tileStride, randomTiles=args.randomTiles, bothSurfaces=args.bothSurfaces)
+            times.append(time.perf_counter() - t)
+        best = min(times)
+        print("lane {}\t{} clusters\t{:.3f}s\t{:.0f} clusters/s".format(lane, clusters, best, clusters / best))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,7 @@
 #!/usr/bin/env python3
 import sys
 import os
-import datetime
-import time
+import multiprocessing as mp
 import syslog
 import bcl2fastq_pipeline.getConfig
 import bcl2fastq_pipeline.findFlowCells
@@ -10,6 +9,12 @@ import bcl2fastq_pipeline.makeFastq
 import bcl2fastq_pipeline.afterFastq
 import bcl2fastq_pipeline.misc
 import bcl2fastq_pipeline.galaxy
+import bcl2fastq_pipeline.watcher
+import bcl2fastq_pipeline.orchestrator
+import bcl2fastq_pipeline.preflight
+import bcl2fastq_pipeline.spaceManager
+import bcl2fastq_pipeline.profiling
+import bcl2fastq_pipeline.outbox
 import importlib
 import signal
 from threading import Event
@@ -22,130 +27,104 @@ gotHUP = Event()
 def breakSleep(signo, _frame):
     gotHUP.set()
 
+def reloadChanged(modules, mtimes) :
+    """
+    Reimport any module whose file has changed since it was last (re)loaded, in order
+    """
+    for m in modules :
+        mtime = os.stat(m.__file__).st_mtime
+        if m.__name__ in mtimes and mtimes[m.__name__] != mtime :
+            syslog.syslog("Reloading %s\n" % m.__name__)
+            importlib.reload(m)
+        mtimes[m.__name__] = mtime
+
 def sleep(config) :
     gotHUP.wait(timeout=float(config['Options']['sleepTime'])*60*60)
     gotHUP.clear()
 
-signal.signal(signal.SIGHUP, breakSleep)
-
-while True:
-    #Reimport to allow reloading a new version
-    importlib.reload(bcl2fastq_pipeline.getConfig)
-    importlib.reload(bcl2fastq_pipeline.findFlowCells)
-    importlib.reload(bcl2fastq_pipeline.makeFastq)
-    importlib.reload(bcl2fastq_pipeline.afterFastq)
-    importlib.reload(bcl2fastq_pipeline.misc)
-    importlib.reload(bcl2fastq_pipeline.galaxy)
-
-    #Read the config file
-    config = bcl2fastq_pipeline.getConfig.getConfig()
-    if(config is None) :
-        #There's no recovering from this!
-        sys.exit("Error: couldn't read the config file!")
-
-    #Get the next flow cell to process, or sleep
-    config = bcl2fastq_pipeline.findFlowCells.newFlowCell(config)
-    if(config.get('Options','runID') == "") :
-        sleep(config)
-        continue
-
-    #Ensure we have sufficient space
-    if(bcl2fastq_pipeline.misc.enoughFreeSpace(config) == False) :
-        syslog.syslog("Error: insufficient free space!\n")
-        bcl2fastq_pipeline.misc.errorEmail(config, sys.exc_info(), "Error: insufficient free space!")
-        sleep(config)
-        continue
-
-    startTime=datetime.datetime.now()
-
-    #Make the fastq files, if not already done
-    lanes = config["Options"]["lanes"]
-    if lanes != "":
-        lanes = "_lanes{}".format(lanes)
-    if not os.path.exists("{}/{}{}/bcl.done".format(config["Paths"]["outputDir"], config["Options"]["runID"], lanes)):
+def toggleProfiling(signo, _frame):
+    bcl2fastq_pipeline.profiling.toggle()
+
+def main():
+    """
+    Run the daemon: process new flow cells as they finish, forever
+    """
+    signal.signal(signal.SIGHUP, breakSleep)
+    #SIGUSR1 turns profiling of newly started flow cells on or off (see profiling.py)
+    signal.signal(signal.SIGUSR1, toggleProfiling)
+
+    #Flow cells are processed in threads, so don't fork worker pools while other threads might hold locks
+    mp.set_start_method("forkserver")
+
+    _config = bcl2fastq_pipeline.getConfig.getConfig()
+    if _config is not None:
+        #Wake up as soon as a run finishes, if [Options]->watchMode is set
+        bcl2fastq_pipeline.watcher.startWatcher(_config, gotHUP.set)
+        #Check barcode orientations before runs finish, if [Options]->preflightInterval is set
+        bcl2fastq_pipeline.preflight.startPreflight(_config)
+        #Send emails and Parkour updates in the background
+        bcl2fastq_pipeline.outbox.startOutbox(_config)
+
+    orchestrator = None
+    #Modules that may be updated while running, with their mtimes when last loaded
+    reloadable = [bcl2fastq_pipeline.getConfig,
+                  bcl2fastq_pipeline.findFlowCells,
+                  bcl2fastq_pipeline.makeFastq,
+                  bcl2fastq_pipeline.afterFastq,
+                  bcl2fastq_pipeline.misc,
+                  bcl2fastq_pipeline.galaxy]
+    mtimes = dict()
+    reloadChanged(reloadable, mtimes)
+
+    while True:
+        #Reimport anything that's changed to allow reloading a new version, but not while flow cells are being processed
+        if orchestrator is None or orchestrator.inFlight() == 0:
+            reloadChanged(reloadable, mtimes)
+
+        #Read the config file
+        config = bcl2fastq_pipeline.getConfig.getConfig()
+        if(config is None) :
+            #There's no recovering from this!
+            sys.exit("Error: couldn't read the config file!")
+
+        #Resource budgets are only changed when nothing is running
+        if orchestrator is None:
+            orchestrator = bcl2fastq_pipeline.orchestrator.Orchestrator(config, wake=gotHUP.set)
+        elif orchestrator.inFlight() == 0:
+            orchestrator.setBudgets(config)
+
+        #Evict already delivered flow cells if outputDir is getting full
         try:
-            bcl2fastq_pipeline.makeFastq.bcl2fq(config)
-            open("{}/{}{}/bcl.done".format(config["Paths"]["outputDir"], config["Options"]["runID"], lanes), "w").close()
-        except :
-            syslog.syslog("Got an error in bcl2fq\n")
-            bcl2fastq_pipeline.misc.errorEmail(config, sys.exc_info(), "Got an error in bcl2fq")
-            sleep(config)
-            continue
-
-    #Fix the file names (prepend "Project_" and "Sample_" and such as appropriate)
-    if not os.path.exists("{}/{}{}/files.renamed".format(config["Paths"]["outputDir"], config["Options"]["runID"], lanes)):
-        try:
-            bcl2fastq_pipeline.makeFastq.fixNames(config)
-            open("{}/{}{}/files.renamed".format(config["Paths"]["outputDir"], config["Options"]["runID"], lanes), "w").close()
-        except :
-            syslog.syslog("Got an error in fixNames\n")
-            bcl2fastq_pipeline.misc.errorEmail(config, sys.exc_info(), "Got an error in fixNames")
-            sleep(config)
-            continue
-
-    #Run post-processing steps
-    try :
-        message = bcl2fastq_pipeline.afterFastq.postMakeSteps(config)
-    except :
-        syslog.syslog("Got an error during postMakeSteps\n")
-        bcl2fastq_pipeline.misc.errorEmail(config, sys.exc_info(), "Got an error during postMakeSteps")
-        sleep(config)
-        continue
-
-    #Get more statistics and create PDFs
-    try :
-        message += "\n\n"+bcl2fastq_pipeline.misc.parseConversionStats(config)
-    except :
-        syslog.syslog("Got an error during parseConversionStats\n")
-        bcl2fastq_pipeline.misc.errorEmail(config, sys.exc_info(), "Got an error during parseConversionStats")
-        sleep(config)
-        continue
-
-    #Copy over xml, FastQC, and PDF stuff
-    try:
-        message += bcl2fastq_pipeline.makeFastq.cpSeqFac(config)
-    except :
-        syslog.syslog("Got an error in cpSeqFac\n")
-        bcl2fastq_pipeline.misc.errorEmail(config, sys.exc_info(), "Got an error in cpSeqFac")
+            bcl2fastq_pipeline.spaceManager.manageSpace(config)
+        except:
+            syslog.syslog("Got an error in manageSpace\n")
+            bcl2fastq_pipeline.misc.errorEmail(config, sys.exc_info(), "Got an error in manageSpace")
+
+        #Start as many new flow cells as allowed, each is processed in its own thread
+        heldBack = set()
+        while orchestrator.hasCapacity(config):
+            #Get the next flow cell to process
+            runConfig = bcl2fastq_pipeline.findFlowCells.newFlowCell(bcl2fastq_pipeline.getConfig.copyConfig(config), skip=orchestrator.busy() | heldBack)
+            if(runConfig.get('Options','runID') == "") :
+                break
+
+            #Ensure we have sufficient space for this flow cell, a smaller one may still fit
+            if(bcl2fastq_pipeline.misc.enoughFreeSpace(runConfig, orchestrator.reservedSpace()) == False) :
+                syslog.syslog("Error: insufficient free space for %s!\n" % runConfig.get("Options","runID"))
+                bcl2fastq_pipeline.misc.errorEmail(runConfig, sys.exc_info(), "Error: insufficient free space for %s%s!" % (runConfig.get("Options","runID"), runConfig.get("Options","lanes")))
+                heldBack.add(bcl2fastq_pipeline.orchestrator.runKey(runConfig))
+                continue
+
+            orchestrator.start(runConfig)
+
+        if orchestrator.fatal is not None and orchestrator.inFlight() == 0:
+            #Unrecoverable error in one of the flow cells (e.g., the finished email couldn't be sent), quit once the others are done
+            sys.exit()
+
+        #Sleep until the next check, a flow cell finishes, the watcher sees a finished run, or SIGHUP
         sleep(config)
-        continue
 
-    runTime = datetime.datetime.now()-startTime
-    startTime = datetime.datetime.now()
-
-    #Transfer data to groups
-    try : 
-        message += bcl2fastq_pipeline.misc.transferData(config)
-    except :
-        syslog.syslog("Got an error during transferData\n")
-        bcl2fastq_pipeline.misc.errorEmail(config, sys.exc_info(), "Got an error during transferData")
-        sleep(config)
-        continue
-
-    #Upload to Galaxy
-    try :
-        message += bcl2fastq_pipeline.galaxy.linkIntoGalaxy(config)
-    except:
-        syslog.syslog("Got an error while uploading to Galaxy!\n")
-        bcl2fastq_pipeline.misc.errorEmail(config, sys.exc_info(), "Got an error while uploading to Galaxy!")
-        sleep(config)
 
-    transferTime = datetime.datetime.now()-startTime
-
-    #Update parkour, errors are non-fatal here
-    try:
-        message += bcl2fastq_pipeline.misc.jsonParkour(config, message)
-    except:
-        syslog.syslog("Received an error while updating Parkour!\n")
-        bcl2fastq_pipeline.misc.errorEmail(config, sys.exc_info(), "Got an error while updating Parkour!")
-
-    #Email finished message
-    try :
-        bcl2fastq_pipeline.misc.finishedEmail(config, message, runTime, transferTime)
-    except :
-        #Unrecoverable error
-        syslog.syslog("Couldn't send the finished email! Quiting")
-        sys.exit()
-
-    #Mark the flow cell as having been processed
-    bcl2fastq_pipeline.findFlowCells.markFinished(config)
+#Worker processes re-import this script (as __mp_main__), which mustn't start another daemon
+if __name__ == "__main__":
+    main()
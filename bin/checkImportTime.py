@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+Benchmark how long importing each pipeline module takes, in a fresh
+interpreter each time, and check that none of them pull in the heavy
+dependencies (numpy, matplotlib, reportlab, requests, bioblend) at import
+time. These should only be loaded inside the functions using them, since the
+daemon and every pool worker import these modules.
+
+Exits with a non-zero status if a heavy dependency is imported or a module
+takes longer than --maxTime seconds.
+"""
+import argparse
+import json
+import subprocess
+import sys
+
+MODULES = ["bcl2fastq_pipeline.getConfig",
+           "bcl2fastq_pipeline.findFlowCells",
+           "bcl2fastq_pipeline.makeFastq",
+           "bcl2fastq_pipeline.afterFastq",
+           "bcl2fastq_pipeline.misc",
+           "bcl2fastq_pipeline.galaxy",
+           "bcl2fastq_pipeline.orchestrator",
+           "bcl2fastq_pipeline.runRegistry",
+           "bcl2fastq_pipeline.ledger",
+           "bcl2fastq_pipeline.outbox",
+           "bcl2fastq_pipeline.executor",
+           "bcl2fastq_pipeline.runner",
+           "bcl2fastq_pipeline.metrics",
+           "bcl2fastq_pipeline.profiling",
+           "bcl2fastq_pipeline.filesystems",
+           "bcl2fastq_pipeline.watcher",
+           "bcl2fastq_pipeline.preflight",
+           "bcl2fastq_pipeline.scratch",
+           "bcl2fastq_pipeline.spaceEstimate",
+           "bcl2fastq_pipeline.spaceManager",
+           "bcl2fastq_pipeline.barcodeCache",
+           "bcl2fastq_pipeline.barcodeMismatches"]
+HEAVY = ["numpy", "matplotlib", "reportlab", "requests", "bioblend"]
+
+# Run in a child process, prints the import time and any heavy modules loaded
+CHILD = """
+import sys, time, json
+t = time.perf_counter()
+import {}
+t = time.perf_counter() - t
+print(json.dumps([t, sorted(m for m in {} if m in sys.modules)]))
+"""
+
+
+def timeImport(module):
+    out = subprocess.check_output([sys.executable, "-c", CHILD.format(module, HEAVY)])
+    return json.loads(out)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the import time of the pipeline modules.")
+    parser.add_argument("--repeats", type=int, default=5, help="The number of times to import each module (default: %(default)s)")
+    parser.add_argument("--maxTime", type=float, default=0.5, help="The maximum acceptable (best of the repeats) import time per module, in seconds (default: %(default)s)")
+    args = parser.parse_args()
+
+    failed = False
+    for module in MODULES:
+        times = []
+        heavy = set()
+        for i in range(args.repeats):
+            t, loaded = timeImport(module)
+            times.append(t)
+            heavy.update(loaded)
+        best = min(times)
+        status = "OK"
+        if heavy:
+            status = "FAIL (imports {})".format(", ".join(sorted(heavy)))
+            failed = True
+        elif best > args.maxTime:
+            status = "FAIL (slower than {}s)".format(args.maxTime)
+            failed = True
+        print("{}\t{:.3f}s\t{}".format(module, best, status))
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
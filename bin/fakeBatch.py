@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+"""
+A stand-in for a batch scheduler, running jobs on the local host. This can
+be used to try out the batch executor (see bcl2fastq_pipeline/executor.py)
+without a cluster:
+
+    [Executor]
+    backend=batch
+    submitCommand=fakeBatch.py submit {log} {script}
+    statusCommand=fakeBatch.py status {jobID}
+    cancelCommand=fakeBatch.py cancel {jobID}
+
+The job ID is the process ID of the job.
+"""
+import argparse
+import os
+import signal
+import subprocess
+
+
+def isRunning(pid):
+    try:
+        state = open("/proc/{}/stat".format(pid)).read().rsplit(")", 1)[1].split()[0]
+    except (OSError, IndexError):
+        return False
+    return state != "Z"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run batch jobs on the local host.")
+    sub = parser.add_subparsers(dest="command")
+    p = sub.add_parser("submit", help="Start a job script in the background and print its job ID")
+    p.add_argument("log", help="File for the job's stdout and stderr")
+    p.add_argument("script", help="The job script")
+    p = sub.add_parser("status", help="Print RUNNING if a job is running, otherwise nothing")
+    p.add_argument("jobID")
+    p = sub.add_parser("cancel", help="Kill a job")
+    p.add_argument("jobID")
+    args = parser.parse_args()
+
+    if args.command == "submit":
+        log = open(args.log, "w")
+        job = subprocess.Popen(["/bin/sh", args.script], stdout=log, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL, start_new_session=True)
+        print(job.pid)
+    elif args.command == "status":
+        if isRunning(int(args.jobID)):
+            print("RUNNING")
+    elif args.command == "cancel":
+        try:
+            os.killpg(int(args.jobID), signal.SIGTERM)
+        except OSError:
+            pass
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
@@ -6,11 +6,68 @@
 #include <zlib.h>
 #include <stdarg.h>
 #include <unistd.h>
+#include <fcntl.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <pthread.h>
 #include "khash.h"
+//The defaults of getStats()'s sampleSize and threshold
 #define MINCLUSTERS 1000000
 #define THRESHOLD 0.005
-KHASH_MAP_INIT_STR(32, uint32_t)
+//Clusters decoded at a time from each BCL file
+#define CHUNKSIZE 65536
+//The zlib buffer size of each BCL file
+#define GZBUFSIZE 131072
+//The most barcode cycles that fit in a bcKey
+#define MAXCYCLES 32
+//The base call of an N in getBaseCalls()'s matrix (A, C, G and T are 0-3)
+#define BASECALLN 4
+//The columns of the per-cycle composition (A, C, G, T and N) and quality score (0-63) histograms
+#define NCALLS 5
+#define NQUALS 64
+
+//A barcode with 2 bits per base (A: 0, C: 1, G: 2, T: 3) and a bit set in nMask for each N
+typedef struct bcKey bcKey;
+struct bcKey {
+    uint64_t bases;
+    uint32_t nMask;
+};
+
+//splitmix64's finalizer
+static inline khint_t bcKeyHash(bcKey k) {
+    uint64_t x = k.bases ^ ((uint64_t) k.nMask << 40) ^ ((uint64_t) k.nMask >> 24);
+    x ^= x >> 30;
+    x *= 0xbf58476d1ce4e5b9ULL;
+    x ^= x >> 27;
+    x *= 0x94d049bb133111ebULL;
+    x ^= x >> 31;
+    return (khint_t) x;
+}
+#define bcKeyEqual(a, b) ((a).bases == (b).bases && (a).nMask == (b).nMask)
+KHASH_INIT(bc, bcKey, uint32_t, 1, bcKeyHash, bcKeyEqual)
+
+//Where the decoded clusters go: either counted in h (getStats) or, if that's NULL, stored in calls (getBaseCalls)
+typedef struct bcSink bcSink;
+struct bcSink {
+    khash_t(bc) *h;
+    uint8_t *calls;  // nCycles base calls per cluster, one cluster after another
+    int nCycles;
+    uint32_t n;  // The number of clusters in calls
+    uint32_t capacity;  // The most that fit
+    uint64_t *composition;  // If not NULL, the calls of each cycle are also tallied here (nCycles x NCALLS)...
+    uint64_t *quality;  // ...and their quality scores here (nCycles x NQUALS)
+};
 
+//A BCL file, either read through zlib or, if it's not compressed, memory-mapped
+typedef struct bclFile bclFile;
+struct bclFile {
+    gzFile gz;
+    uint8_t *map;
+    size_t size;
+    size_t pos;  // The next byte of map to read
+};
+
+//A memory-mapped CBCL file and the blocks of each of its tiles
 typedef struct CBCL CBCL;
 struct CBCL {
     uint32_t nTiles;
@@ -18,14 +75,94 @@ struct CBCL {
     uint32_t *uncompressedSize;
     uint32_t *compressedSize;
     uint64_t *offsets;
+    uint8_t qScores[4];  // The quality score of each quality bin
+    uint8_t *map;
+    size_t size;
+};
+
+//One tile being inflated, for each cycle
+typedef struct cbclSlot cbclSlot;
+struct cbclSlot {
+    uint8_t **cycles;
+    int done;
+    int error;
+};
+
+//Shared between the threads inflating CBCL files
+typedef struct cbclQueue cbclQueue;
+struct cbclQueue {
+    CBCL **CBCLs;
+    int nCycles;
+    uint32_t nTiles;  // The number of tiles chosen
+    int *tiles;  // Their indices
+    uint32_t next;  // The next chosen tile * nCycles + cycle to inflate
+    uint32_t counted;  // The number of tiles counted
+    int prefetch;  // The number of tiles that may be inflated at once
+    int stop;
+    cbclSlot *slots;
+    pthread_mutex_t lock;
+    pthread_cond_t ready;
+    pthread_cond_t space;
+};
+
+//What each thread inflating CBCL blocks is given
+typedef struct cbclWorkerArg cbclWorkerArg;
+struct cbclWorkerArg {
+    cbclQueue *q;
+    z_stream zs;
+};
+
+//How a lane is decoded and sampled, see getStats()
+typedef struct decodeOpts decodeOpts;
+struct decodeOpts {
+    int threads;  // Threads inflating CBCL files
+    uint32_t sampleSize;  // Clusters to sample, from the first tiles or spread evenly over the chosen ones (see tileQuota())
+    double threshold;  // The fraction of clusters a barcode must be seen in to be returned
+    int tileStride;  // Use every tileStride'th tile...
+    int randomTiles;  // ...or this many tiles chosen at random, if > 0
+    unsigned int seed;  // For randomTiles
+    int bothSurfaces;  // NovaSeq: use the top and bottom surfaces, rather than just the first
+    int cycleStats;  // Also tally the base calls and quality scores of each cycle
+    int nMasks;  // getStatsMulti: return the barcodes over each of these subsets of the cycles, rather than over all of them
+    int *maskLens;
+    int **masks;  // Positions into the cycles, see projectHash()
 };
 
-#define pyBarcodesVersion "0.2.0"
+//The decoded barcodes of a single lane
+typedef struct laneStats laneStats;
+struct laneStats {
+    int lane;
+    int nBarcodes;
+    char **barcodes;
+    float *frequencies;
+    uint64_t *composition;  // With opts->cycleStats, see bcSink
+    uint64_t *quality;
+    int nMasks;
+    laneStats *masked;  // With opts->nMasks, the barcodes and frequencies over each mask
+};
+
+//Shared between the threads of getStatsMulti
+typedef struct laneQueue laneQueue;
+struct laneQueue {
+    char *basePath;
+    char *runType;
+    int nCycles;
+    int *cycles;
+    int nLanes;
+    int next;
+    decodeOpts opts;
+    laneStats *stats;
+    pthread_mutex_t lock;
+};
+
+#define pyBarcodesVersion "0.10.0"
 
-static PyObject *pyGetStats(PyObject *self, PyObject *args);
+static PyObject *pyGetStats(PyObject *self, PyObject *args, PyObject *kwds);
+static PyObject *pyGetStatsMulti(PyObject *self, PyObject *args, PyObject *kwds);
+static PyObject *pyGetBaseCalls(PyObject *self, PyObject *args, PyObject *kwds);
 
 static PyMethodDef barcodesMethods[] = {
-    {"getStats", (PyCFunction) pyGetStats, METH_VARARGS,
+    {"getStats", (PyCFunction) pyGetStats, METH_VARARGS|METH_KEYWORDS,
 "Get a dictionary of barcodes seen and their frequencies.\n\
 \n\
 Required arguments:\n\
@@ -35,9 +172,34 @@ Required arguments:\n\
 \n\
 Optional arguments:\n\
     lane:    The lane number (defaults to 1).\n\
+    threads: The number of threads reading and inflating the CBCL files of\n\
+             NovaSeq runs (defaults to 1). Tiles are counted as they're\n\
+             inflated.\n\
+    sampleSize: The number of clusters passing filter to sample (defaults\n\
+             to 1000000). These come from the first tiles, unless\n\
+             tileStride or randomTiles is given, in which case they're\n\
+             spread evenly over the tiles used.\n\
+    threshold: The fraction of the sampled clusters a barcode must be seen in\n\
+             to be returned (defaults to 0.005).\n\
+    tileStride: Only use every tileStride'th tile (defaults to 1).\n\
+    randomTiles: If greater than 0, use this many tiles chosen at random\n\
+             instead (defaults to 0).\n\
+    seed:    The random seed for randomTiles (defaults to 0).\n\
+    bothSurfaces: For NovaSeq, sample the top and bottom surfaces rather\n\
+             than just the first (defaults to False).\n\
+    cycleStats: Also tally the base calls and quality scores of each cycle\n\
+             of the sampled clusters (defaults to False).\n\
+\n\
+NextSeq runs don't have per-tile files, so the tile options are ignored.\n\
 \n\
 Returns:\n\
     A dictionary with barcodes as keys and fractional prevalence as values.\n\
+    With cycleStats, a tuple of that and two 2 dimensional memoryviews of\n\
+    unsigned 64-bit counts, each with a row per cycle: the composition\n\
+    (columns A, C, G, T and N) and a histogram of quality scores (columns\n\
+    0 to 63). For NovaSeq, quality bin 0 is counted as N and the quality\n\
+    bins are converted to scores using the CBCL headers. numpy.asarray()\n\
+    gives uint64 arrays of these.\n\
 \n\
 >>> from pyBarcodes import getStats\n\
 >>> getStats(`/data/180215_J00182_0064_AHNVNGBBXX', 'HiSeq3000', range([77, 92]), 5)\n\
@@ -48,6 +210,57 @@ Returns:\n\
 'CCTGAGCAGAGGATA': 7.6103925704956055, 'GTACTAGTCTACTCT': 6.675393104553223,\n\
 'AGGCATGAGAGGATA': 4.3499956130981445, 'GTACTAGAGAGGATA': 5.3411946296691895,\n\
 'AAGGCGAAGAGGATA': 8.967890739440918}\n"},
+    {"getStatsMulti", (PyCFunction) pyGetStatsMulti, METH_VARARGS|METH_KEYWORDS,
+"Like getStats(), but for several lanes at once. Each lane is decoded in its\n\
+own native thread, without holding the GIL.\n\
+\n\
+Required arguments:\n\
+    path: The path to the flow cell (it should contain a Data directory).\n\
+    runType: One of HiSeq3000, HiSeq2500, NextSeq, NovaSeq or MiSeq.\n\
+    cycles:  The cycles containing the barcodes.\n\
+\n\
+Optional arguments:\n\
+    lanes:   A list of lane numbers (defaults to [1]).\n\
+    threads: The number of threads to use (defaults to 0, meaning one per\n\
+             lane). Up to this many lanes are decoded at once. For NovaSeq,\n\
+             threads beyond one per lane inflate the CBCL files of each lane\n\
+             (see getStats()).\n\
+    masks:   A list of subsets of cycles (defaults to None). Each lane is\n\
+             sampled once over cycles, and its barcodes are then counted\n\
+             over each subset, so threshold applies to each of them.\n\
+    The sampling options of getStats() are also accepted.\n\
+\n\
+Returns:\n\
+    A list with a dictionary per lane, in the same order as lanes, with\n\
+    barcodes as keys and fractional prevalence as values. With masks, each\n\
+    lane instead has a list with a dictionary per mask. With cycleStats,\n\
+    each is a tuple as returned by getStats(), the statistics covering\n\
+    cycles.\n\
+\n\
+>>> from pyBarcodes import getStatsMulti\n\
+>>> lane5, lane6 = getStatsMulti('/data/180215_J00182_0064_AHNVNGBBXX', 'HiSeq3000', range(77, 92), lanes=[5, 6])\n"},
+    {"getBaseCalls", (PyCFunction) pyGetBaseCalls, METH_VARARGS|METH_KEYWORDS,
+"Get the base calls of the sampled clusters of a lane, rather than counting\n\
+their barcodes.\n\
+\n\
+Required arguments:\n\
+    path: The path to the flow cell (it should contain a Data directory).\n\
+    runType: One of HiSeq3000, HiSeq2500, NextSeq, NovaSeq or MiSeq.\n\
+    cycles:  The cycles containing the barcodes.\n\
+\n\
+Optional arguments:\n\
+    lane, threads, sampleSize, tileStride, randomTiles, seed, bothSurfaces\n\
+    and cycleStats, as for getStats(). The same clusters are sampled.\n\
+\n\
+Returns:\n\
+    A (clusters x cycles) numpy uint8 array. A, C, G and T are 0 to 3 and N\n\
+    is pyBarcodes.N (4). If no clusters pass filter, it has no rows. With\n\
+    cycleStats, a tuple of that and the cycle statistics, as for getStats().\n\
+\n\
+>>> from pyBarcodes import getBaseCalls\n\
+>>> calls = getBaseCalls('/data/180215_J00182_0064_AHNVNGBBXX', 'HiSeq3000', range(77, 92), 5)\n\
+>>> calls.shape\n\
+(1000000, 15)\n"},
     {NULL, NULL, 0, NULL}
 };
 
@@ -74,90 +287,102 @@ PyObject *PyString_FromString(const char *v) {
 }
 #endif
 
-//NextSeq 500/550 and MiniSeq
-gzFile *openNextSeqBCLs(char *basePath, int *cycles, int nCycles) {
-    int i;
-    char fname[16384];
-    gzFile *o = NULL;
-    o = calloc(nCycles, sizeof(FILE*));
-    if(!o) return NULL;
+//Memory-map a whole file read-only, returns 1 on error, 0 on success
+int mapFile(const char *fname, uint8_t **data, size_t *size) {
+    struct stat st;
+    void *p;
+    int fd = open(fname, O_RDONLY);
+    if(fd < 0) return 1;
 
-    for(i=0; i<nCycles; i++) {
-        sprintf(fname, "%s/Data/Intensities/BaseCalls/L001/%04i.bcl.bgzf", basePath, cycles[i]);
-        o[i] = gzopen(fname, "r");
-        if(!o[i] != Z_NULL) goto error;
+    if(fstat(fd, &st) || st.st_size == 0) {
+        close(fd);
+        return 1;
     }
-    return o;
+    p = mmap(NULL, st.st_size, PROT_READ, MAP_PRIVATE, fd, 0);
+    close(fd);
+    if(p == MAP_FAILED) return 1;
 
-error:
-    for(i=0; i<=nCycles; i++) if(o[i] != Z_NULL && o[i] != NULL) gzclose(o[i]);
-    free(o);
-    return NULL;
+    *data = (uint8_t*) p;
+    *size = st.st_size;
+    return 0;
 }
 
-//HiSeq 2000/2500/3000/4000/X single tile
-gzFile *openHiSeq(char *basePath, int lane, int tile, int *cycles, int nCycles) {
+//Open a BCL file, which is memory-mapped if it isn't compressed, returns 1 on error, 0 on success
+int openBCL(bclFile *f, const char *fname, int compressed) {
+    memset(f, 0, sizeof(bclFile));
+    if(!compressed) {
+        if(mapFile(fname, &(f->map), &(f->size))) return 1;
+        madvise(f->map, f->size, MADV_SEQUENTIAL);
+        return 0;
+    }
+
+    f->gz = gzopen(fname, "r");
+    if(f->gz == Z_NULL) return 1;
+    gzbuffer(f->gz, GZBUFSIZE);
+    return 0;
+}
+
+void closeBCLs(bclFile *bcls, int nBCLs) {
+    int i;
+    for(i=0; i<nBCLs; i++) {
+        if(bcls[i].gz) gzclose(bcls[i].gz);
+        if(bcls[i].map) munmap(bcls[i].map, bcls[i].size);
+    }
+    free(bcls);
+}
+
+//NextSeq 500/550 and MiniSeq
+bclFile *openNextSeqBCLs(char *basePath, int *cycles, int nCycles) {
     int i;
     char fname[16384];
-    gzFile *o = NULL;
-    o = calloc(nCycles, sizeof(FILE*));
+    bclFile *o = NULL;
+    o = calloc(nCycles, sizeof(bclFile));
     if(!o) return NULL;
 
     for(i=0; i<nCycles; i++) {
-        sprintf(fname, "%s/Data/Intensities/BaseCalls/L00%i/C%i.1/s_%i_%i.bcl.gz", basePath, lane, cycles[i], lane, tile);
-        o[i] = gzopen(fname, "r");
-        if(!o[i] != Z_NULL) goto error;
+        sprintf(fname, "%s/Data/Intensities/BaseCalls/L001/%04i.bcl.bgzf", basePath, cycles[i]);
+        if(openBCL(o + i, fname, 1)) {
+            closeBCLs(o, i);
+            return NULL;
+        }
     }
     return o;
-
-error:
-    for(i=0; i<=nCycles; i++) if(o[i] != Z_NULL && o[i] != NULL) gzclose(o[i]);
-    free(o);
-    return NULL;
 }
 
-// NovaSeq 6000
-FILE **openNovaSeq(char *basePath, int lane, int *cycles, int nCycles) {
+//HiSeq 2000/2500/3000/4000/X single tile
+bclFile *openHiSeq(char *basePath, int lane, int tile, int *cycles, int nCycles) {
     int i;
     char fname[16384];
-    FILE **o = NULL;
-    o = calloc(nCycles, sizeof(FILE*));  // Use only 1 surface
+    bclFile *o = NULL;
+    o = calloc(nCycles, sizeof(bclFile));
     if(!o) return NULL;
 
     for(i=0; i<nCycles; i++) {
-        sprintf(fname, "%s/Data/Intensities/BaseCalls/L00%i/C%i.1/L00%i_1.cbcl", basePath, lane, cycles[i], lane);
-        if(access(fname, F_OK) != 0) sprintf(fname, "%s/Data/Intensities/BaseCalls/L00%i/C%i.1/L00%i_2.cbcl", basePath, lane, cycles[i], lane);
-        o[i] = fopen(fname, "r");
-        if(!o[i] != Z_NULL) goto error;
+        sprintf(fname, "%s/Data/Intensities/BaseCalls/L00%i/C%i.1/s_%i_%i.bcl.gz", basePath, lane, cycles[i], lane, tile);
+        if(openBCL(o + i, fname, 1)) {
+            closeBCLs(o, i);
+            return NULL;
+        }
     }
-
     return o;
-
-error:
-    for(i=0; i<=nCycles; i++) if(o[i] != NULL) fclose(o[i]);
-    free(o);
-    return NULL;
 }
 
-//MiSeq runs are the same as HiSeq, except the bcl files aren't compressed
-gzFile *openMiSeq(char *basePath, int tile, int *cycles, int nCycles) {
+//MiSeq runs are the same as HiSeq, except the bcl files aren't compressed, so they're memory-mapped
+bclFile *openMiSeq(char *basePath, int tile, int *cycles, int nCycles) {
     int i;
     char fname[16384];
-    gzFile *o = NULL;
-    o = calloc(nCycles, sizeof(FILE*));
+    bclFile *o = NULL;
+    o = calloc(nCycles, sizeof(bclFile));
     if(!o) return NULL;
 
     for(i=0; i<nCycles; i++) {
         sprintf(fname, "%s/Data/Intensities/BaseCalls/L001/C%i.1/s_1_%i.bcl", basePath, cycles[i], tile);
-        o[i] = gzopen(fname, "r");
-        if(!o[i] != Z_NULL) goto error;
+        if(openBCL(o + i, fname, 0)) {
+            closeBCLs(o, i);
+            return NULL;
+        }
     }
     return o;
-
-error:
-    for(i=0; i<=nCycles; i++) if(o[i] != Z_NULL && o[i] != NULL) gzclose(o[i]);
-    free(o);
-    return NULL;
 }
 
 //NextSeq 500/550 and MiniSeq
@@ -174,49 +399,6 @@ FILE *openFilterHiSeq(char *basePath, int lane, int tile) {
     return fopen(fname, "r");
 }
 
-void closeBCLs(gzFile *bcls, int nBCLs) {
-    int i;
-    for(i=0; i<nBCLs; i++) gzclose(bcls[i]);
-    free(bcls);
-}
-
-void closeCBCLs(FILE **cbcls, int nBCLs) {
-    int i;
-    for(i=0; i<nBCLs; i++) fclose(cbcls[i]);
-    free(cbcls);
-}
-
-//Returns 1 on error, 0 on success
-int getSequence(uint32_t cluster, gzFile *bcls, uint32_t nBCLs, char *seq) {
-    uint8_t byte;
-    uint32_t i;
-
-    for(i=0; i<nBCLs; i++) {
-        gzseek(bcls[i], cluster + 3, SEEK_SET);
-        if(gzread(bcls[i], (void*) &byte, 1) != 1) return 1;
-        if(byte == 0) {
-            seq[i] = 'N';
-        } else {
-            switch(byte & 3) {
-                case 0:
-                    seq[i] = 'A';
-                    break;
-                case 1:
-                    seq[i] = 'C';
-                    break;
-                case 2:
-                    seq[i] = 'G';
-                    break;
-                default:
-                    seq[i] = 'T';
-                    break;
-            }
-        }
-    }
-
-    return 0;
-}
-
 //returns 1 on error, 0 on success
 int initCBCL(CBCL *cbcl, uint32_t nTiles) {
     cbcl->nClusters = calloc(nTiles, sizeof(uint32_t));
@@ -232,55 +414,52 @@ int initCBCL(CBCL *cbcl, uint32_t nTiles) {
 
 //destroy a CBCL object
 void destroyCBCL(CBCL *cbcl) {
-    if(cbcl->nTiles) {
-        if(cbcl->nClusters) free(cbcl->nClusters);
-        if(cbcl->uncompressedSize) free(cbcl->uncompressedSize);
-        if(cbcl->compressedSize) free(cbcl->compressedSize);
-        if(cbcl->offsets) free(cbcl->offsets);
-    }
+    if(cbcl->nClusters) free(cbcl->nClusters);
+    if(cbcl->uncompressedSize) free(cbcl->uncompressedSize);
+    if(cbcl->compressedSize) free(cbcl->compressedSize);
+    if(cbcl->offsets) free(cbcl->offsets);
+    if(cbcl->map) munmap(cbcl->map, cbcl->size);
     free(cbcl);
 }
 
-//Returns a NULL pointe on error
-CBCL* loadCBCL(FILE *bcl) {
-    uint8_t bitsPerBase, bitsPerQScore;
-    uint16_t version;
-    uint32_t i, j;
-    uint32_t headerSize, QBins, nTiles;
+//Memory-map a CBCL file and parse its header, returns a NULL pointer on error
+CBCL* loadCBCL(const char *fname) {
+    uint32_t i, QBins, nTiles, from, to;
     uint64_t blockOffset;
+    size_t pos;
     CBCL *cbcl = NULL;
     cbcl = calloc(1, sizeof(CBCL));
     if(!cbcl) goto error;
-
-    //CBCL header
-    fseek(bcl, 0, SEEK_SET);
-    if(fread((void*) &version, 2, 1, bcl) != 1) goto error;
-    if(fread((void*) &headerSize, 4, 1, bcl) != 1) goto error;
-    if(fread((void*) &bitsPerBase, 1, 1, bcl) != 1) goto error;
-    if(fread((void*) &bitsPerQScore, 1, 1, bcl) != 1) goto error;
-    if(fread((void*) &QBins, 4, 1, bcl) != 1) goto error;
-    fseek(bcl, 8 * QBins, SEEK_CUR);  // Skip Q-value binning definition
-    if(fread((void*) &nTiles, 4, 1, bcl) != 1) goto error;
+    if(mapFile(fname, &(cbcl->map), &(cbcl->size))) goto error;
+
+    //CBCL header: the version (2 bytes), header size (4), bits per base (1), bits per Q-score (1) and the number of Q-score bins (4)
+    if(cbcl->size < 12) goto error;
+    memcpy(&QBins, cbcl->map + 8, 4);
+    pos = 12 + 8 * (size_t) QBins;  // Skip Q-value binning definition
+    if(pos + 4 > cbcl->size) goto error;
+    memcpy(&nTiles, cbcl->map + pos, 4);
+    pos += 4;
+
+    //Each Q-score bin is the 2-bit value stored (from) and the quality score it stands for (to)
+    for(i=0; i<4; i++) cbcl->qScores[i] = i;
+    for(i=0; i<QBins; i++) {
+        memcpy(&from, cbcl->map + 12 + 8 * (size_t) i, 4);
+        memcpy(&to, cbcl->map + 16 + 8 * (size_t) i, 4);
+        if(from < 4) cbcl->qScores[from] = (to < NQUALS) ? to : NQUALS - 1;
+    }
+    if(pos + 16 * (size_t) nTiles + 1 > cbcl->size) goto error;
 
     cbcl->nTiles = nTiles;
     if(initCBCL(cbcl, nTiles)) goto error;
-    
-    blockOffset = (uint64_t) ftell(bcl);
-    blockOffset += 16 * nTiles + 1;  // Start just after the per-tile information
-    for(i=0; i<nTiles; i++) {
-        // Tile number
-        if(fread((void*) &headerSize, 4, 1, bcl) != 1) goto error;
-        // nClusters
-        if(fread((void*) &headerSize, 4, 1, bcl) != 1) goto error;
-        cbcl->nClusters[i] = headerSize;
-        // uncompressedSize
-        if(fread((void*) &headerSize, 4, 1, bcl) != 1) goto error;
-        cbcl->uncompressedSize[i] = headerSize;
-        // compressedSize
-        if(fread((void*) &headerSize, 4, 1, bcl) != 1) goto error;
-        cbcl->compressedSize[i] = headerSize;
+
+    blockOffset = pos + 16 * (uint64_t) nTiles + 1;  // Start just after the per-tile information
+    for(i=0; i<nTiles; i++, pos+=16) {
+        // Tile number, nClusters, uncompressedSize and compressedSize
+        memcpy(cbcl->nClusters + i, cbcl->map + pos + 4, 4);
+        memcpy(cbcl->uncompressedSize + i, cbcl->map + pos + 8, 4);
+        memcpy(cbcl->compressedSize + i, cbcl->map + pos + 12, 4);
         cbcl->offsets[i] = blockOffset;
-        blockOffset += headerSize;
+        blockOffset += cbcl->compressedSize[i];
     }
 
     return cbcl;
@@ -290,389 +469,730 @@ error:
     return NULL;
 }
 
-//Return the number of clusters passing filter (up to 1 million), -1 on error
-int commonProcess(FILE *filterFile, gzFile *bcls, khash_t(32) *h, int nCycles) {
-    khiter_t k;
-    int i, ret, good = 0;
-    uint32_t nClusters;
+void closeCBCLs(CBCL **cbcls, int nBCLs) {
+    int i;
+    for(i=0; i<nBCLs; i++) {
+        if(cbcls[i]) destroyCBCL(cbcls[i]);
+    }
+    free(cbcls);
+}
+
+// NovaSeq 6000
+// surface 0 is the first of the two that exists
+CBCL **openNovaSeq(char *basePath, int lane, int surface, int *cycles, int nCycles) {
+    int i;
+    char fname[16384];
+    CBCL **o = NULL;
+    o = calloc(nCycles, sizeof(CBCL*));  // Use only 1 surface
+    if(!o) return NULL;
+
+    for(i=0; i<nCycles; i++) {
+        sprintf(fname, "%s/Data/Intensities/BaseCalls/L00%i/C%i.1/L00%i_%i.cbcl", basePath, lane, cycles[i], lane, surface ? surface : 1);
+        if(surface == 0 && access(fname, F_OK) != 0) sprintf(fname, "%s/Data/Intensities/BaseCalls/L00%i/C%i.1/L00%i_2.cbcl", basePath, lane, cycles[i], lane);
+        o[i] = loadCBCL(fname);
+        if(!o[i]) goto error;
+        if(o[i]->nTiles != o[0]->nTiles) goto error;
+    }
+
+    return o;
+
+error:
+    closeCBCLs(o, nCycles);
+    return NULL;
+}
+
+//Add one to the count of a barcode, returns 1 on error, 0 on success
+static inline int countBarcode(khash_t(bc) *h, bcKey key) {
+    int ret;
+    khiter_t k = kh_put(bc, h, key, &ret);
+    if(ret < 0) return 1;
+    if(ret) kh_value(h, k) = 0;
+    kh_value(h, k)++;
+    return 0;
+}
+
+//Add a cluster to a sink, returns 1 on error, 0 on success
+static inline int addBarcode(bcSink *sink, bcKey key) {
+    uint8_t *row;
+    int cycle;
+
+    if(sink->h) return countBarcode(sink->h, key);
+    if(sink->n >= sink->capacity) return 1;
+    row = sink->calls + (size_t) sink->n * sink->nCycles;
+    for(cycle=0; cycle<sink->nCycles; cycle++) {
+        if(key.nMask & ((uint32_t) 1 << cycle)) row[cycle] = BASECALLN;
+        else row[cycle] = (key.bases >> (2 * cycle)) & 3;
+    }
+    sink->n++;
+    return 0;
+}
+
+//Tally the calls (N if 0, otherwise the lower 2 bits) and quality scores (the upper 6 bits) of one cycle of the passing clusters in a BCL chunk
+static inline void bclCycleStats(uint8_t *bases, uint32_t *pass, uint32_t nPass, uint64_t *composition, uint64_t *quality) {
+    uint32_t j;
     uint8_t byte;
-    char *seq = NULL;
 
-    seq = malloc(nCycles + 1);
-    if(!seq) return -1;
-    seq[nCycles] = '\0';
+    for(j=0; j<nPass; j++) {
+        byte = bases[pass[j]];
+        composition[byte ? (byte & 3) : BASECALLN]++;
+        quality[byte >> 2]++;
+    }
+}
+
+int compareInt(const void *a, const void *b) {
+    return *(const int*) a - *(const int*) b;
+}
+
+//Choose which of nTiles tiles to sample, in order: every tileStride'th or randomTiles at random
+//Returns the number chosen, with their indices in *chosen (which must be free()d), or -1 on error
+int chooseTiles(int nTiles, decodeOpts *opts, int **chosen) {
+    int i, j, tmp, n = 0;
+    unsigned int seed = opts->seed;
+    int *idx = malloc((nTiles > 0 ? nTiles : 1) * sizeof(int));
+    if(!idx) return -1;
+
+    for(i=0; i<nTiles; i++) idx[i] = i;
+    if(opts->randomTiles > 0 && opts->randomTiles < nTiles) {
+        //A partial Fisher-Yates shuffle, sorted afterward so the files are read in order
+        for(i=0; i<opts->randomTiles; i++) {
+            j = i + rand_r(&seed) % (nTiles - i);
+            tmp = idx[i];
+            idx[i] = idx[j];
+            idx[j] = tmp;
+        }
+        n = opts->randomTiles;
+        qsort(idx, n, sizeof(int), compareInt);
+    } else {
+        for(i=0; i<nTiles; i+=opts->tileStride) idx[n++] = i;
+    }
+    *chosen = idx;
+    return n;
+}
+
+//The share of the remaining clusters to take from each of nLeft tiles (or surfaces)
+static inline uint32_t quota(uint32_t sampleSize, uint32_t good, int nLeft) {
+    if(good >= sampleSize || nLeft < 1) return 0;
+    return (sampleSize - good + nLeft - 1) / nLeft;
+}
+
+//Only with tileStride or randomTiles is the sample spread over the chosen tiles, otherwise it comes from the first tiles, which reads far less
+static inline int spreadSample(decodeOpts *opts) {
+    return opts->tileStride > 1 || opts->randomTiles > 0;
+}
+
+//The most clusters to take from the next of nLeft chosen tiles
+static inline uint32_t tileQuota(decodeOpts *opts, uint32_t sampleSize, uint32_t good, int nLeft) {
+    if(spreadSample(opts)) return quota(sampleSize, good, nLeft);
+    return (good < sampleSize) ? sampleSize - good : 0;
+}
+
+//The next n bytes of a BCL file, read into buf unless the file is memory-mapped. Returns NULL on error
+static inline uint8_t *readBCL(bclFile *f, uint8_t *buf, uint32_t n) {
+    uint8_t *p;
+    if(f->map) {
+        if(f->pos + n > f->size) return NULL;
+        p = f->map + f->pos;
+        f->pos += n;
+        return p;
+    }
+    if(gzread(f->gz, (void*) buf, n) != (int) n) return NULL;
+    return buf;
+}
+
+//Skip the header (the number of clusters) of each BCL file, returns 1 on error, 0 on success
+int skipBCLHeaders(bclFile *bcls, int nBCLs) {
+    uint32_t nClusters;
+    int i;
+
+    for(i=0; i<nBCLs; i++) {
+        if(!readBCL(bcls + i, (uint8_t*) &nClusters, 4)) return 1;
+    }
+    return 0;
+}
+
+//Return the number of clusters passing filter (up to limit), -1 on error
+//Each cycle is inflated sequentially, CHUNKSIZE clusters at a time. The passing clusters of a chunk are then assembled a cycle (column) at a time.
+int commonProcess(FILE *filterFile, bclFile *bcls, bcSink *sink, int nCycles, uint32_t limit) {
+    int cycle;
+    uint32_t good = 0, nClusters, start, n, nPass, i, j;
+    uint8_t *filter = NULL, *bases = NULL, *p, byte;
+    uint32_t *pass = NULL;
+    bcKey *keys = NULL;
+
+    filter = malloc(CHUNKSIZE);
+    bases = malloc(CHUNKSIZE);
+    pass = malloc(CHUNKSIZE * sizeof(uint32_t));
+    keys = malloc(CHUNKSIZE * sizeof(bcKey));
+    if(!filter || !bases || !pass || !keys) goto error;
 
     //Read in the header
     if(fread((void*) &nClusters, 4, 1, filterFile) != 1) goto error;
     if(fread((void*) &nClusters, 4, 1, filterFile) != 1) goto error;
     if(fread((void*) &nClusters, 4, 1, filterFile) != 1) goto error;
+    if(skipBCLHeaders(bcls, nCycles)) goto error;
+
+    for(start=0; start<nClusters && good < limit; start += n) {
+        n = nClusters - start;
+        if(n > CHUNKSIZE) n = CHUNKSIZE;
+        if(fread((void*) filter, 1, n, filterFile) != n) goto error;
+
+        //The clusters passing filter, up to limit in total
+        for(i=0, nPass=0; i<n && good < limit; i++) {
+            if(filter[i] & 1) {
+                pass[nPass++] = i;
+                good++;
+            }
+        }
 
-    for(i=0; i<nClusters; i++) {
-        if(fread((void*) &byte, 1, 1, filterFile) != 1) goto error;
-        if(byte & 1) {
-            good++;
-            if(getSequence(i, bcls, nCycles, seq)) goto error;
-
-            //increment the counter
-            k = kh_get(32, h, seq);
-            if(k == kh_end(h)) {
-                k = kh_put(32, h, seq, &ret);
-                kh_value(h, k) = 0;
-                seq = malloc(nCycles + 1);
-                if(!seq) goto error;
-                seq[nCycles] = '\0';
+        //The files are read to the end of the chunk even if the last ones are skipped
+        memset(keys, 0, nPass * sizeof(bcKey));
+        for(cycle=0; cycle<nCycles; cycle++) {
+            p = readBCL(bcls + cycle, bases, n);
+            if(!p) goto error;
+            for(j=0; j<nPass; j++) {
+                byte = p[pass[j]];
+                if(byte == 0) keys[j].nMask |= (uint32_t) 1 << cycle;
+                else keys[j].bases |= (uint64_t) (byte & 3) << (2 * cycle);
             }
-            kh_value(h, k)++;
+            if(sink->composition) bclCycleStats(p, pass, nPass, sink->composition + NCALLS * cycle, sink->quality + NQUALS * cycle);
+        }
+
+        //count or store them
+        for(j=0; j<nPass; j++) {
+            if(addBarcode(sink, keys[j])) goto error;
         }
-        if(good > MINCLUSTERS) break;
     }
 
-    free(seq);
-    return good;
+    free(filter);
+    free(bases);
+    free(pass);
+    free(keys);
+    return (int) good;
 
 error:
-    if(seq) free(seq);
+    if(filter) free(filter);
+    if(bases) free(bases);
+    if(pass) free(pass);
+    if(keys) free(keys);
     return -1;
 }
 
-char getCBCLBase(uint8_t *uncompressedTiles, uint32_t cluster) {
+//The 4 bits of a cluster in a CBCL file: 2 for the base and 2 for the quality bin
+static inline uint8_t getCBCLNibble(uint8_t *uncompressedTiles, uint32_t cluster) {
     uint8_t byte = uncompressedTiles[cluster/2];
-    int offset = cluster % 2;
-
-    if(offset) byte>>=4;
-    switch(byte & 3) {
-        case 0:
-            return 'A';
-        case 1:
-            return 'C';
-        case 3:
-            return 'T';
-        case 2:
-        default:
-            return 'G';
-    }
+    if(cluster % 2) byte >>= 4;
+    return byte & 15;
 }
 
-//TODO handle a return value of 0
-uint32_t cbclTile(uint8_t **uncompressedTiles, int nCycles, uint32_t nClusters, khash_t(32) *h) {
-    khiter_t k;
-    char *seq = NULL;
-    int cycle, ret;
+//Returns the number of clusters counted, 0 on error
+//Quality bin 0 is a no-call, which is an N (as in cbclCycleStats())
+uint32_t cbclTile(uint8_t **uncompressedTiles, int nCycles, uint32_t nClusters, bcSink *sink) {
+    bcKey key;
+    int cycle;
     uint32_t cluster;
-
-    seq = malloc(nCycles + 1);
-    if(!seq) return 0;
-    seq[nCycles] = '\0';
+    uint8_t nibble;
 
     for(cluster=0; cluster<nClusters; cluster++) {
+        key.bases = 0;
+        key.nMask = 0;
         for(cycle=0; cycle<nCycles; cycle++) {
-           seq[cycle] = getCBCLBase(uncompressedTiles[cycle], cluster);
+            nibble = getCBCLNibble(uncompressedTiles[cycle], cluster);
+            if(nibble & 12) key.bases |= (uint64_t) (nibble & 3) << (2 * cycle);
+            else key.nMask |= (uint32_t) 1 << cycle;
         }
 
-        //increment the counter
-        k = kh_get(32, h, seq);
-        if(k == kh_end(h)) {
-            k = kh_put(32, h, seq, &ret);
-            kh_value(h, k) = 0;
-            seq = malloc(nCycles + 1);
-            if(!seq) goto error;
-            seq[nCycles] = '\0';
-        }
-        kh_value(h, k)++;
+        //count or store it
+        if(addBarcode(sink, key)) return 0;
     }
 
-    free(seq);
     return nClusters;
-
-error:
-    if(seq) free(seq);
-    return 0;
 }
 
+//Tally the calls and quality scores of the first nClusters clusters of a tile, for each cycle
+//A cluster in a CBCL file is 2 bits of base followed by 2 bits of quality bin, where bin 0 is a no-call
+void cbclCycleStats(uint8_t **uncompressedTiles, CBCL **CBCLs, int nCycles, uint32_t nClusters, bcSink *sink) {
+    int cycle;
+    uint32_t cluster;
+    uint8_t nibble, *tile, *qScores;
+    uint64_t *composition, *quality;
+
+    for(cycle=0; cycle<nCycles; cycle++) {
+        tile = uncompressedTiles[cycle];
+        qScores = CBCLs[cycle]->qScores;
+        composition = sink->composition + NCALLS * cycle;
+        quality = sink->quality + NQUALS * cycle;
+        for(cluster=0; cluster<nClusters; cluster++) {
+            nibble = tile[cluster/2];
+            if(cluster % 2) nibble >>= 4;
+            composition[(nibble & 12) ? (nibble & 3) : BASECALLN]++;
+            quality[qScores[(nibble >> 2) & 3]]++;
+        }
+    }
+}
 
-// Returns the number of clusters returning sequence, which is all of them
-// This will load nCycles of data into memory for one tile!
-int getCBCLSequence(CBCL** CBCLs, FILE **bcls, int tile, khash_t(32) *h, int nCycles) {
-    int rv = 0, i;
-    uint8_t **uncompressedTiles = NULL;
-    uint8_t *compressedTile = NULL;
-    uLongf destLen;
-    uLong sourceLen;
-    z_stream zs = {
-        .zalloc = NULL,
-        .zfree = NULL,
-        .msg = NULL
-    };
+//Inflate one tile of a CBCL file straight from its memory map into out, which must hold uncompressedSize[tile] bytes
+//zs is reset rather than initialized, so each thread can reuse one
+//Returns 1 on error, 0 on success
+int inflateCBCLTile(CBCL *cbcl, int tile, z_stream *zs, uint8_t *out) {
+    uint32_t sourceLen = cbcl->compressedSize[tile];
 
-    uncompressedTiles = (uint8_t**) calloc(nCycles, sizeof(uint8_t*));
-    if(!uncompressedTiles) goto error;
+    if(sourceLen < 10 || cbcl->offsets[tile] + sourceLen > cbcl->size) return 1;
+    if(inflateReset(zs) != Z_OK) return 1;
 
-    for(i=0; i<nCycles; i++) {
-        destLen = CBCLs[i]->uncompressedSize[tile];
-        sourceLen = CBCLs[i]->compressedSize[tile];
+    // Skip the 10 byte header
+    zs->next_in = cbcl->map + cbcl->offsets[tile] + 10;
+    zs->avail_in = sourceLen - 10;
+    zs->next_out = out;
+    zs->avail_out = cbcl->uncompressedSize[tile];
 
-        uncompressedTiles[i] = malloc(destLen);
-        if(!uncompressedTiles[i]) goto error;
+    if(inflate(zs, Z_FINISH) != Z_STREAM_END) return 1;
+    if(zs->total_out != cbcl->uncompressedSize[tile]) return 1;
+    return 0;
+}
 
-        compressedTile = malloc(sourceLen);
-        if(!compressedTile) goto error;
+//Each worker takes the next (tile, cycle) block, staying at most prefetch tiles ahead of the counting
+//Blocks are inflated into the buffers of their slot, which aren't touched by the counting until the slot is done
+void *cbclWorker(void *arg) {
+    cbclWorkerArg *w = (cbclWorkerArg*) arg;
+    cbclQueue *q = w->q;
+    cbclSlot *slot;
+    uint32_t item, tile, total = q->nTiles * q->nCycles;
+    int cycle, rv;
+
+    pthread_mutex_lock(&(q->lock));
+    while(1) {
+        while(!q->stop && q->next < total && q->next / q->nCycles >= q->counted + (uint32_t) q->prefetch) pthread_cond_wait(&(q->space), &(q->lock));
+        if(q->stop || q->next >= total) break;
+        item = q->next++;
+        pthread_mutex_unlock(&(q->lock));
+
+        tile = item / q->nCycles;
+        cycle = item % q->nCycles;
+        slot = q->slots + (tile % q->prefetch);
+        rv = inflateCBCLTile(q->CBCLs[cycle], q->tiles[tile], &(w->zs), slot->cycles[cycle]);
+
+        pthread_mutex_lock(&(q->lock));
+        if(rv) slot->error = 1;
+        slot->done++;
+        if(slot->done == q->nCycles) pthread_cond_broadcast(&(q->ready));
+    }
+    pthread_mutex_unlock(&(q->lock));
+    return NULL;
+}
 
-        fseek(bcls[i], CBCLs[i]->offsets[tile], SEEK_SET);
-        fread(compressedTile, sourceLen, 1,  bcls[i]);
+//Return the number of clusters passing filter (up to limit, see tileQuota()), -1 on error
+// No filter files, since the cbcl files have been filtered already
+//With opts->threads > 1, blocks are inflated by that many worker threads while the tiles are counted in order as they complete
+//Each thread has its own z_stream and each slot has a buffer per cycle large enough for any of the chosen tiles, so nothing is allocated per tile
+int CBCLProcess(CBCL **CBCLs, bcSink *sink, int nCycles, decodeOpts *opts, uint32_t limit) {
+    int i, cycle, nStreams = 0, nThreads = 0, err = 0, threads = opts->threads;
+    uint32_t tile, rv, n, good = 0, maxSize = 1;
+    pthread_t *workers = NULL;
+    cbclWorkerArg *args = NULL;
+    cbclSlot *slot;
+    cbclQueue q;
+
+    memset(&q, 0, sizeof(cbclQueue));
+    q.CBCLs = CBCLs;
+    q.nCycles = nCycles;
+    i = chooseTiles(CBCLs[0]->nTiles, opts, &(q.tiles));
+    if(i < 0) goto cleanup;
+    q.nTiles = i;
+    //Otherwise the workers would inflate tiles that aren't needed
+    if(!spreadSample(opts)) {
+        for(tile=0, n=0; tile<q.nTiles && n<limit; tile++) n += CBCLs[0]->nClusters[q.tiles[tile]];
+        q.nTiles = tile;
+    }
+    q.prefetch = (threads > 1) ? 2 + threads / nCycles : 1;
 
-        // Skip the 10 byte header
-        zs.next_in = compressedTile + 10;
-        zs.avail_in = sourceLen - 10;
-        zs.next_out = uncompressedTiles[i];
-        zs.avail_out = destLen;
+    for(tile=0; tile<q.nTiles; tile++) {
+        for(cycle=0; cycle<nCycles; cycle++) {
+            if(CBCLs[cycle]->uncompressedSize[q.tiles[tile]] > maxSize) maxSize = CBCLs[cycle]->uncompressedSize[q.tiles[tile]];
+        }
+    }
+    q.slots = calloc(q.prefetch, sizeof(cbclSlot));
+    if(!q.slots) goto cleanup;
+    for(i=0; i<q.prefetch; i++) {
+        q.slots[i].cycles = calloc(nCycles, sizeof(uint8_t*));
+        if(!q.slots[i].cycles) goto cleanup;
+        for(cycle=0; cycle<nCycles; cycle++) {
+            q.slots[i].cycles[cycle] = malloc(maxSize);
+            if(!q.slots[i].cycles[cycle]) goto cleanup;
+        }
+    }
 
-        rv = inflateInit2(&zs, -15);
-        rv = inflate(&zs, Z_FINISH);
-        inflateEnd(&zs);
-        free(compressedTile);
-        compressedTile = NULL;
-        if(rv != Z_STREAM_END) goto error;
-        if(destLen != zs.total_out) goto error;
+    //One z_stream per worker, or just one if the blocks are inflated in this thread
+    args = calloc(threads > 1 ? threads : 1, sizeof(cbclWorkerArg));
+    if(!args) goto cleanup;
+    for(nStreams=0; nStreams<(threads > 1 ? threads : 1); nStreams++) {
+        args[nStreams].q = &q;
+        if(inflateInit2(&(args[nStreams].zs), -15) != Z_OK) break;
     }
+    if(nStreams == 0) goto cleanup;
 
-    rv += (int) cbclTile(uncompressedTiles, nCycles, CBCLs[0]->nClusters[0], h);
+    pthread_mutex_init(&(q.lock), NULL);
+    pthread_cond_init(&(q.ready), NULL);
+    pthread_cond_init(&(q.space), NULL);
 
-    for(i=0; i<nCycles; i++) free(uncompressedTiles[i]);
-    free(uncompressedTiles);
+    //If the workers can't be started, the blocks are inflated in this thread
+    if(threads > 1) workers = calloc(nStreams, sizeof(pthread_t));
+    if(workers) {
+        for(nThreads=0; nThreads<nStreams; nThreads++) {
+            if(pthread_create(workers + nThreads, NULL, cbclWorker, args + nThreads)) break;
+        }
+    }
 
-    return rv;
+    //Count each tile once all of its cycles are inflated
+    for(tile=0; tile<q.nTiles; tile++) {
+        slot = q.slots + (tile % q.prefetch);
+        if(nThreads == 0) {
+            for(cycle=0; cycle<nCycles; cycle++) {
+                if(inflateCBCLTile(CBCLs[cycle], q.tiles[tile], &(args[0].zs), slot->cycles[cycle])) slot->error = 1;
+            }
+            slot->done = nCycles;
+        }
+        pthread_mutex_lock(&(q.lock));
+        while(slot->done < nCycles) pthread_cond_wait(&(q.ready), &(q.lock));
+        pthread_mutex_unlock(&(q.lock));
+        if(slot->error) {
+            err = 1;
+            break;
+        }
 
-error:
-    if(compressedTile) free(compressedTile);
-    if(uncompressedTiles) {
-        for(i=0; i<nCycles; i++) {
-            if(uncompressedTiles[i]) free(uncompressedTiles[i]);
+        //The first clusters of each tile, up to its share of what's left
+        n = CBCLs[0]->nClusters[q.tiles[tile]];
+        if(n > tileQuota(opts, limit, good, q.nTiles - tile)) n = tileQuota(opts, limit, good, q.nTiles - tile);
+        rv = cbclTile(slot->cycles, nCycles, n, sink);
+        if(rv == 0 && n > 0) err = 1;
+        else if(sink->composition) cbclCycleStats(slot->cycles, CBCLs, nCycles, rv, sink);
+        good += rv;
+
+        pthread_mutex_lock(&(q.lock));
+        slot->done = 0;
+        q.counted++;
+        pthread_cond_broadcast(&(q.space));
+        pthread_mutex_unlock(&(q.lock));
+        if(good >= limit || err) break;
+    }
+
+    //Stop any workers that are still prefetching
+    pthread_mutex_lock(&(q.lock));
+    q.stop = 1;
+    pthread_cond_broadcast(&(q.space));
+    pthread_mutex_unlock(&(q.lock));
+    for(i=0; i<nThreads; i++) pthread_join(workers[i], NULL);
+    if(workers) free(workers);
+    pthread_cond_destroy(&(q.space));
+    pthread_cond_destroy(&(q.ready));
+    pthread_mutex_destroy(&(q.lock));
+
+cleanup:
+    if(args) {
+        for(i=0; i<nStreams; i++) inflateEnd(&(args[i].zs));
+        free(args);
+    }
+    if(q.slots) {
+        for(i=0; i<q.prefetch; i++) {
+            if(!q.slots[i].cycles) continue;
+            for(cycle=0; cycle<nCycles; cycle++) {
+                if(q.slots[i].cycles[cycle]) free(q.slots[i].cycles[cycle]);
+            }
+            free(q.slots[i].cycles);
         }
-        free(uncompressedTiles);
+        free(q.slots);
     }
+    if(q.tiles) free(q.tiles);
 
-    //TODO return -1 on error and handle that
-    return 0;
+    //nStreams is 0 if setting up failed
+    if(err || nStreams == 0) return -1;
+    return (int) good;
 }
 
-//Return the number of clusters passing filter (up to 1 million), -1 on error
-// No filter files, since the cbcl files have been filtered already
-int CBCLProcess(FILE **bcls, khash_t(32) *h, int nCycles) {
-    int i, good = 0;
-    CBCL** CBCLs = NULL;
-
-    CBCLs = calloc(nCycles, sizeof(CBCL));
-    if(!CBCLs) goto error;
+//Convert the barcodes seen in at least threshold of the good clusters to strings
+//Returns the number of values in *barcodes and *frequencies, which must both be free()d, or -1 on error
+int hashToBarcodes(khash_t(bc) *h, int nCycles, uint32_t good, double threshold, char ***barcodes, float **frequencies) {
+    khiter_t k;
+    bcKey key;
+    int nBarcodes = 0, i = 0, cycle;
+    char *seq;
 
-    //Open each file, reading each into a data structure with offsets and a vector of numbers of clusters
-    for(i=0; i<nCycles; i++) {
-        CBCLs[i] = loadCBCL(bcls[i]);
-        if(!CBCLs[i]) goto error;
+    //Count the number of barcodes that will be output
+    for(k = kh_begin(h); k != kh_end(h); k++) {
+        if(kh_exist(h, k)) {
+            if(kh_value(h, k) >= threshold * good) nBarcodes++;
+        }
     }
 
-    //Send each tile into getCBCLSequence
-    for(i=0; i<CBCLs[0]->nTiles; i++) {
-        good += getCBCLSequence(CBCLs, bcls, i, h, nCycles);
-        if(good > MINCLUSTERS) break;
+    *barcodes = calloc(nBarcodes ? nBarcodes : 1, sizeof(char*));
+    *frequencies = malloc((nBarcodes ? nBarcodes : 1) * sizeof(float));
+    if(!*barcodes || !*frequencies) goto error;
+    for(k = kh_begin(h); k != kh_end(h); k++) {
+        if(kh_exist(h, k) && kh_value(h, k) >= threshold * good) {
+            key = kh_key(h, k);
+            seq = malloc(nCycles + 1);
+            if(!seq) goto error;
+            for(cycle=0; cycle<nCycles; cycle++) {
+                if(key.nMask & ((uint32_t) 1 << cycle)) seq[cycle] = 'N';
+                else seq[cycle] = "ACGT"[(key.bases >> (2 * cycle)) & 3];
+            }
+            seq[nCycles] = '\0';
+            (*frequencies)[i] = (100. * kh_value(h, k)) / good;
+            (*barcodes)[i++] = seq;
+        }
     }
 
-    for(i=0; i<nCycles; i++) destroyCBCL(CBCLs[i]);
-    free(CBCLs);
-
-    return good;
+    return nBarcodes;
 
 error:
-    if(CBCLs) {
-        for(i=0; i<nCycles; i++) {
-            if(CBCLs[i]) destroyCBCL(CBCLs[i]);
-        }
-        free(CBCLs);
+    if(*barcodes) {
+        while(i > 0) free((*barcodes)[--i]);
+        free(*barcodes);
     }
+    if(*frequencies) free(*frequencies);
+    *barcodes = NULL;
+    *frequencies = NULL;
     return -1;
 }
 
+//Count the barcodes of h over a subset of their cycles (nPositions indices into them) into a new hash
+//Barcodes differing only outside of the subset are merged. Returns NULL on error
+khash_t(bc) *projectHash(khash_t(bc) *h, int nPositions, int *positions) {
+    khash_t(bc) *out = kh_init(bc);
+    khiter_t k, k2;
+    bcKey key, projected;
+    int i, ret;
+
+    if(!out) return NULL;
+    for(k = kh_begin(h); k != kh_end(h); k++) {
+        if(!kh_exist(h, k)) continue;
+        key = kh_key(h, k);
+        projected.bases = 0;
+        projected.nMask = 0;
+        for(i=0; i<nPositions; i++) {
+            if(key.nMask & ((uint32_t) 1 << positions[i])) projected.nMask |= (uint32_t) 1 << i;
+            else projected.bases |= ((key.bases >> (2 * positions[i])) & 3) << (2 * i);
+        }
+        k2 = kh_put(bc, out, projected, &ret);
+        if(ret < 0) {
+            kh_destroy(bc, out);
+            return NULL;
+        }
+        if(ret) kh_value(out, k2) = 0;
+        kh_value(out, k2) += kh_value(h, k);
+    }
+    return out;
+}
+
+//Fill s->masked with the barcodes of h over each of opts->masks, returns 1 on error, 0 on success
+int maskedBarcodes(khash_t(bc) *h, int nCycles, uint32_t good, decodeOpts *opts, laneStats *s) {
+    khash_t(bc) *projected;
+    int i, j, identity;
+
+    s->masked = calloc(opts->nMasks, sizeof(laneStats));
+    if(!s->masked) return 1;
+    s->nMasks = opts->nMasks;
+    for(i=0; i<opts->nMasks; i++) {
+        s->masked[i].lane = s->lane;
+        //A mask covering every cycle in order needs no projecting
+        identity = (opts->maskLens[i] == nCycles);
+        for(j=0; identity && j<nCycles; j++) identity = (opts->masks[i][j] == j);
+        projected = identity ? h : projectHash(h, opts->maskLens[i], opts->masks[i]);
+        if(!projected) return 1;
+        s->masked[i].nBarcodes = hashToBarcodes(projected, opts->maskLens[i], good, opts->threshold, &(s->masked[i].barcodes), &(s->masked[i].frequencies));
+        if(!identity) kh_destroy(bc, projected);
+        if(s->masked[i].nBarcodes < 0) return 1;
+    }
+    return 0;
+}
+
 //Handle NextSeq 500/550 and MiniSeq runs, will only look at lane 1
-//Returns the number of values in *barcodes and *frequencies, which must both be free()d
-int handleNextSeq(char *basePath, int nCycles, int *cycles, char ***barcodes, float **frequencies) {
+//All tiles are in the same files, so only opts->sampleSize is used to sample them
+//Returns the number of clusters added to sink, or -1 on error
+int handleNextSeq(char *basePath, int nCycles, int *cycles, decodeOpts *opts, bcSink *sink) {
     FILE *filterFile = NULL;
-    gzFile *bcls = NULL;
-    uint32_t i;
-    int good = 0, nBarcodes = 0;
-    khiter_t k;
+    bclFile *bcls = NULL;
+    int good = 0;
 
-    khash_t(32) *h = kh_init(32);
     filterFile = openFilterNextSeq(basePath);
     if(!filterFile) goto error;
 
     bcls = openNextSeqBCLs(basePath, cycles, nCycles);
     if(!bcls) goto error;
 
-    good = commonProcess(filterFile, bcls, h, nCycles);
+    good = commonProcess(filterFile, bcls, sink, nCycles, opts->sampleSize);
     if(good == -1) goto error;
 
-    //Count the number of barcodes that will be output
-    for(k = kh_begin(h); k != kh_end(h); k++) {
-        if(kh_exist(h, k)) {
-            if(kh_value(h, k) >= THRESHOLD * good) nBarcodes++;
-        }
-    }
-
-    *barcodes = malloc(nBarcodes * sizeof(char**));
-    *frequencies = malloc(nBarcodes * sizeof(float));
-    if(!*barcodes) goto error;
-    if(!*frequencies) goto error;
-    for(k = kh_begin(h), i = 0; k != kh_end(h); k++) {
-        if(kh_exist(h, k)) {
-            if(kh_value(h, k) >= THRESHOLD * good) {
-                (*frequencies)[i] = (100. * kh_value(h, k)) / good;
-                (*barcodes)[i++] = (char *) kh_key(h, k);
-            } else {
-                free((char*) kh_key(h, k));
-            }
-        }
-    }
-
     fclose(filterFile);
     closeBCLs(bcls, nCycles);
-    kh_destroy(32, h);
 
-    return nBarcodes;
+    return good;
 
 error:
     if(bcls) closeBCLs(bcls, nCycles);
     if(filterFile) fclose(filterFile);
-    kh_destroy(32, h);
     return -1;
 }
 
-// Returns the number of values in *barcodes and *frequencies, which must both be free()d
-int handleHiSeq(char *basePath, int lane, int nCycles, int maxSwath, int maxTile, int *cycles, char ***barcodes, float **frequencies) {
+// Returns the number of clusters added to sink, or -1 on error
+int handleHiSeq(char *basePath, int lane, int nCycles, int maxSwath, int maxTile, int *cycles, decodeOpts *opts, bcSink *sink) {
     FILE *filterFile = NULL;
-    gzFile *bcls = NULL;
-    char *seq;
-    uint32_t i, good = 0;
-    int side, swath, tile, tileNum, rv, nBarcodes = 0;
-    khiter_t k;
-
-    seq = malloc(nCycles + 1);
-    if(!seq) return -1;
-    seq[nCycles] = '\0';
-
-    //This hash will get reused until we've processed up to a million clusters
-    khash_t(32) *h = kh_init(32);
+    bclFile *bcls = NULL;
+    uint32_t good = 0;
+    int side, swath, tile, rv, nTiles = 0, nChosen;
+    int *tileNums = NULL, *chosen = NULL;
 
+    tileNums = malloc(2 * maxSwath * maxTile * sizeof(int));
+    if(!tileNums) goto error;
     for(side=1; side<3; side++) {
         for(swath=1; swath<=maxSwath; swath++) {
-            for(tile=1; tile<=maxTile; tile++) {
-                tileNum = 1000 * side + 100 * swath + tile;
-                filterFile = openFilterHiSeq(basePath, lane, tileNum);
-                if(!filterFile) goto error;
-
-                if(maxSwath > 1) bcls = openHiSeq(basePath, lane, tileNum, cycles, nCycles);
-                else bcls = openMiSeq(basePath, tileNum, cycles, nCycles);
-                if(!bcls) goto error;
-
-                rv = commonProcess(filterFile, bcls, h, nCycles);
-                if(rv == -1) goto error;
-                good += rv;
-
-                fclose(filterFile);
-                closeBCLs(bcls, nCycles);
-                bcls = NULL;
-                filterFile = NULL;
-                if(good > MINCLUSTERS) break;
-            }
-            if(good > MINCLUSTERS) break;
+            for(tile=1; tile<=maxTile; tile++) tileNums[nTiles++] = 1000 * side + 100 * swath + tile;
         }
-        if(good > MINCLUSTERS) break;
     }
-
-    //Count the number of barcodes that will be output
-    for(k = kh_begin(h); k != kh_end(h); k++) {
-        if(kh_exist(h, k)) {
-            if(kh_value(h, k) >= THRESHOLD * good) nBarcodes++;
-        }
+    nChosen = chooseTiles(nTiles, opts, &chosen);
+    if(nChosen < 0) goto error;
+
+    //The same sink is used until we've processed sampleSize clusters
+    for(tile=0; tile<nChosen && good < opts->sampleSize; tile++) {
+        filterFile = openFilterHiSeq(basePath, lane, tileNums[chosen[tile]]);
+        if(!filterFile) goto error;
+
+        if(maxSwath > 1) bcls = openHiSeq(basePath, lane, tileNums[chosen[tile]], cycles, nCycles);
+        else bcls = openMiSeq(basePath, tileNums[chosen[tile]], cycles, nCycles);
+        if(!bcls) goto error;
+
+        //Each tile gets its share of what's left
+        rv = commonProcess(filterFile, bcls, sink, nCycles, tileQuota(opts, opts->sampleSize, good, nChosen - tile));
+        if(rv == -1) goto error;
+        good += rv;
+
+        fclose(filterFile);
+        closeBCLs(bcls, nCycles);
+        bcls = NULL;
+        filterFile = NULL;
     }
+    free(tileNums);
+    free(chosen);
 
-    *barcodes = malloc(nBarcodes * sizeof(char**));
-    *frequencies = malloc(nBarcodes * sizeof(float));
-    if(!*barcodes) goto error;
-    if(!*frequencies) goto error;
-    for(k = kh_begin(h), i = 0; k != kh_end(h); k++) {
-        if(kh_exist(h, k)) {
-            if(kh_value(h, k) >= THRESHOLD * good) {
-                (*frequencies)[i] = (100. * kh_value(h, k)) / good;
-                (*barcodes)[i++] = (char *) kh_key(h, k);
-            } else {
-                free((char*) kh_key(h, k));
-            }
-        }
-    }
-
-    kh_destroy(32, h);
-    free(seq);
-
-    return nBarcodes;
+    return (int) good;
 
 error:
-    kh_destroy(32, h);
-    if(seq) free(seq);
+    if(tileNums) free(tileNums);
+    if(chosen) free(chosen);
     if(bcls) closeBCLs(bcls, nCycles);
     if(filterFile) fclose(filterFile);
     return -1;
 }
 
-// Returns the number of values in *barcodes and *frequencies, which must both be free()d
-// Unlike the other functions, this doesn't care about tiles since they're concatenated.
-// Only a single side of each lane is used.
-int handleNovaSeq(char *basePath, int lane, int nCycles, int *cycles, char ***barcodes, float **frequencies) {
-    FILE **cbcls = NULL;
-    uint32_t i;
-    int rv, good, nBarcodes = 0;
-    khiter_t k;
-
-    //This hash will get reused until we've processed up to a million clusters
-    khash_t(32) *h = kh_init(32);
+// Returns the number of clusters added to sink, or -1 on error
+// The tiles of each surface are concatenated in a single CBCL file per cycle.
+// Only the first surface of each lane is used, unless opts->bothSurfaces is set.
+int handleNovaSeq(char *basePath, int lane, int nCycles, int *cycles, decodeOpts *opts, bcSink *sink) {
+    CBCL **cbcls = NULL;
+    uint32_t good = 0;
+    int surface, nSurfaces = opts->bothSurfaces ? 2 : 1, rv;
+
+    //The same sink is used until we've processed sampleSize clusters
+    for(surface=0; surface<nSurfaces && good < opts->sampleSize; surface++) {
+        cbcls = openNovaSeq(basePath, lane, opts->bothSurfaces ? surface + 1 : 0, cycles, nCycles);
+        if(!cbcls) goto error;
+
+        rv = CBCLProcess(cbcls, sink, nCycles, opts, quota(opts->sampleSize, good, nSurfaces - surface));
+        if(rv == -1) goto error;
+        good += rv;
+
+        closeCBCLs(cbcls, nCycles);
+        cbcls = NULL;
+    }
 
-    cbcls = openNovaSeq(basePath, lane, cycles, nCycles);
-    if(!cbcls) goto error;
+    return (int) good;
 
-    good = CBCLProcess(cbcls, h, nCycles);
-    if(good == -1) goto error;
+error:
+    if(cbcls) closeCBCLs(cbcls, nCycles);
+    return -1;
+}
 
-    closeCBCLs(cbcls, nCycles);
-    cbcls = NULL;
+//Sample the index cycles of a single lane into sink, this doesn't touch any python objects so it can run without the GIL
+//Returns the number of clusters sampled, or -1 on error
+int sampleLane(char *basePath, char *runType, int lane, int nCycles, int *cycles, decodeOpts *opts, bcSink *sink) {
+    if(strcmp(runType, "NextSeq") == 0) return handleNextSeq(basePath, nCycles, cycles, opts, sink);
+    else if(strcmp(runType, "NovaSeq") == 0) return handleNovaSeq(basePath, lane, nCycles, cycles, opts, sink);
+    else if(strcmp(runType, "HiSeq3000") == 0 || \
+            strcmp(runType, "HiSeq4000") == 0 || \
+            strcmp(runType, "HiSeqX") == 0) return handleHiSeq(basePath, lane, nCycles, 2, 28, cycles, opts, sink);
+    else if(strcmp(runType, "HiSeq2500") == 0 || \
+            strcmp(runType, "HiSeq2000") == 0) return handleHiSeq(basePath, lane, nCycles, 2, 16, cycles, opts, sink);
+    else if(strcmp(runType, "MiSeq") == 0) return handleHiSeq(basePath, 1, nCycles, 1, 19, cycles, opts, sink);
+    return -1;
+}
 
-    //Count the number of barcodes that will be output
-    for(k = kh_begin(h); k != kh_end(h); k++) {
-        if(kh_exist(h, k)) {
-            if(kh_value(h, k) >= THRESHOLD * good) nBarcodes++;
-        }
+//Decode the barcodes of a single lane (s->lane) into s, this doesn't touch any python objects so it can run without the GIL
+//Returns the number of values in s->barcodes and s->frequencies (which is also stored in s->nBarcodes), or -1 on error
+//With opts->nMasks the barcodes go in s->masked instead and 0 is returned on success
+//Everything allocated in s is freed by freeLaneStats()
+int decodeLane(char *basePath, char *runType, int nCycles, int *cycles, decodeOpts *opts, laneStats *s) {
+    int good;
+    bcSink sink;
+
+    s->nBarcodes = -1;
+    memset(&sink, 0, sizeof(bcSink));
+    if(opts->cycleStats) {
+        s->composition = calloc(nCycles * NCALLS, sizeof(uint64_t));
+        s->quality = calloc(nCycles * NQUALS, sizeof(uint64_t));
+        if(!s->composition || !s->quality) return -1;
+        sink.composition = s->composition;
+        sink.quality = s->quality;
     }
+    sink.h = kh_init(bc);
+    if(!sink.h) return -1;
 
-    *barcodes = malloc(nBarcodes * sizeof(char**));
-    *frequencies = malloc(nBarcodes * sizeof(float));
-    if(!*barcodes) goto error;
-    if(!*frequencies) goto error;
-    for(k = kh_begin(h), i = 0; k != kh_end(h); k++) {
-        if(kh_exist(h, k)) {
-            if(kh_value(h, k) >= THRESHOLD * good) {
-                (*frequencies)[i] = (100. * kh_value(h, k)) / good;
-                (*barcodes)[i++] = (char *) kh_key(h, k);
-            } else {
-                free((char*) kh_key(h, k));
-            }
-        }
+    good = sampleLane(basePath, runType, s->lane, nCycles, cycles, opts, &sink);
+    if(good >= 0) {
+        if(opts->nMasks) s->nBarcodes = maskedBarcodes(sink.h, nCycles, good, opts, s) ? -1 : 0;
+        else s->nBarcodes = hashToBarcodes(sink.h, nCycles, good, opts->threshold, &(s->barcodes), &(s->frequencies));
     }
 
-    kh_destroy(32, h);
+    kh_destroy(bc, sink.h);
+    return s->nBarcodes;
+}
 
-    return nBarcodes;
+//Each thread decodes lanes until there are none left
+void *laneWorker(void *arg) {
+    laneQueue *q = (laneQueue*) arg;
+    laneStats *s;
+    int i;
 
-error:
-    kh_destroy(32, h);
-    if(cbcls) closeCBCLs(cbcls, nCycles);
-    return -1;
+    while(1) {
+        pthread_mutex_lock(&(q->lock));
+        i = q->next++;
+        pthread_mutex_unlock(&(q->lock));
+        if(i >= q->nLanes) break;
+
+        s = q->stats + i;
+        decodeLane(q->basePath, q->runType, q->nCycles, q->cycles, &(q->opts), s);
+    }
+    return NULL;
+}
+
+void freeLaneStats(laneStats *s) {
+    int i;
+    if(s->nBarcodes > 0 && s->barcodes) {
+        for(i=0; i<s->nBarcodes; i++) free(s->barcodes[i]);
+    }
+    if(s->barcodes) free(s->barcodes);
+    if(s->frequencies) free(s->frequencies);
+    if(s->composition) free(s->composition);
+    if(s->quality) free(s->quality);
+    if(s->masked) {
+        //The masked entries have no masks of their own
+        for(i=0; i<s->nMasks; i++) freeLaneStats(s->masked + i);
+        free(s->masked);
+    }
+    s->masked = NULL;
+    s->nMasks = 0;
+    s->barcodes = NULL;
+    s->frequencies = NULL;
+    s->composition = NULL;
+    s->quality = NULL;
 }
 
 /********************************************************************
@@ -680,92 +1200,496 @@ error:
  * Begin python wrapping stuff
  *
  ********************************************************************/
-static PyObject *pyGetStats(PyObject *self, PyObject *args) {
-    char *basePath = NULL;
-    char *runType = NULL;
-    PyObject *listObj = NULL, *item = NULL, *rv = NULL, *key = NULL, *value = NULL;
-    int lane = 1;
-    int *cycles = NULL, nCycles, i, nBarcodes = -1;
-    char **barcodes = NULL;
-    float *frequencies = NULL;
-
-    if(!(PyArg_ParseTuple(args, "ssO|i", &basePath, &runType, &listObj, &lane))) {
-        PyErr_SetString(PyExc_RuntimeError, "You must supply at least a path, a run type and a list of cycles.");
+//Convert a sequence of integers (e.g., a list or range) to a C array, which must be free()d. Returns NULL on error, with an exception set.
+int *intSequence(PyObject *seq, int *n, const char *what) {
+    PyObject *item = NULL;
+    int *rv = NULL, i;
+    char msg[128];
+
+    if(!PySequence_Check(seq)) {
+        snprintf(msg, 128, "The %s must be a list of integers.", what);
+        PyErr_SetString(PyExc_RuntimeError, msg);
+        return NULL;
+    }
+    *n = PySequence_Size(seq);
+    rv = malloc((*n > 0 ? *n : 1) * sizeof(int));
+    if(!rv) {
+        PyErr_SetString(PyExc_RuntimeError, "Ran out of memory!");
         return NULL;
     }
+    for(i=0; i<*n; i++) {
+        item = PySequence_GetItem(seq, i);
+        if(!item || !PyLong_Check(item)) {
+            if(item) Py_DECREF(item);
+            free(rv);
+            snprintf(msg, 128, "The %s must be a list of integers.", what);
+            PyErr_SetString(PyExc_RuntimeError, msg);
+            return NULL;
+        }
+        rv[i] = (int) PyLong_AsLong(item);
+        Py_DECREF(item);
+    }
+    return rv;
+}
 
+int checkCycles(int nCycles) {
+    if(nCycles < 1 || nCycles > MAXCYCLES) {
+        PyErr_SetString(PyExc_RuntimeError, "Between 1 and 32 barcode cycles are supported.");
+        return 0;
+    }
+    return 1;
+}
+
+//Set from the python arguments with initOpts(), returns 0 (with an exception set) if any are out of range
+int checkOpts(decodeOpts *opts, int sampleSize) {
+    if(sampleSize < 1) {
+        PyErr_SetString(PyExc_RuntimeError, "sampleSize must be at least 1.");
+        return 0;
+    }
+    opts->sampleSize = sampleSize;
+    if(opts->threshold < 0 || opts->threshold > 1) {
+        PyErr_SetString(PyExc_RuntimeError, "threshold must be between 0 and 1.");
+        return 0;
+    }
+    if(opts->tileStride < 1) {
+        PyErr_SetString(PyExc_RuntimeError, "tileStride must be at least 1.");
+        return 0;
+    }
+    if(opts->randomTiles < 0) {
+        PyErr_SetString(PyExc_RuntimeError, "randomTiles can't be negative.");
+        return 0;
+    }
+    return 1;
+}
+
+void initOpts(decodeOpts *opts) {
+    opts->threads = 1;
+    opts->sampleSize = MINCLUSTERS;
+    opts->threshold = THRESHOLD;
+    opts->tileStride = 1;
+    opts->randomTiles = 0;
+    opts->seed = 0;
+    opts->bothSurfaces = 0;
+    opts->cycleStats = 0;
+    opts->nMasks = 0;
+    opts->maskLens = NULL;
+    opts->masks = NULL;
+}
+
+int checkRunType(char *runType) {
     if(strcmp(runType, "NextSeq") != 0 && \
        strcmp(runType, "HiSeq2500") != 0 && \
        strcmp(runType, "HiSeq3000") != 0 && \
        strcmp(runType, "NovaSeq") != 0 && \
        strcmp(runType, "MiSeq") != 0) {
         PyErr_SetString(PyExc_RuntimeError, "The run type must be one of NextSeq, HiSeq2500, HiSeq3000, NovaSeq or MiSeq");
+        return 0;
+    }
+    return 1;
+}
+
+//Create a dictionary with barcodes as keys and frequencies as values, freeing the barcodes as we go
+PyObject *statsDict(laneStats *s) {
+    PyObject *rv = NULL, *key = NULL, *value = NULL;
+    int i;
+
+    rv = PyDict_New();
+    if(!rv) goto error;
+    for(i=0; i<s->nBarcodes; i++) {
+        key = PyString_FromString(s->barcodes[i]);
+        if(!key) goto error;
+        value = PyFloat_FromDouble((double) s->frequencies[i]);
+        if(!value) goto error;
+        if(PyDict_SetItem(rv, key, value)) goto error;
+        Py_DECREF(key);
+        Py_DECREF(value);
+        key = NULL;
+        value = NULL;
+    }
+    freeLaneStats(s);
+    return rv;
+
+error:
+    freeLaneStats(s);
+    if(rv) Py_DECREF(rv);
+    if(key) Py_DECREF(key);
+    if(value) Py_DECREF(value);
+    return NULL;
+}
+
+//A 2 dimensional memoryview of a copy of rows x cols unsigned 64-bit counts, returns NULL on error
+PyObject *countsView(uint64_t *counts, int rows, int cols) {
+    PyObject *buf = NULL, *view = NULL, *rv = NULL;
+
+    buf = PyByteArray_FromStringAndSize((char*) counts, (Py_ssize_t) rows * cols * sizeof(uint64_t));
+    if(!buf) return NULL;
+    view = PyMemoryView_FromObject(buf);
+    if(view) rv = PyObject_CallMethod(view, "cast", "s(ii)", "Q", rows, cols);
+
+    if(view) Py_DECREF(view);
+    Py_DECREF(buf);
+    return rv;
+}
+
+//result, or with cycleStats a tuple of it and the per-cycle composition and quality score histograms
+//The reference to result is stolen. Returns NULL on error
+PyObject *withCycleStats(PyObject *result, uint64_t *composition, uint64_t *quality, int nCycles, int cycleStats) {
+    PyObject *comp = NULL, *qual = NULL;
+
+    if(!result || !cycleStats) return result;
+    comp = countsView(composition, nCycles, NCALLS);
+    if(!comp) goto error;
+    qual = countsView(quality, nCycles, NQUALS);
+    if(!qual) goto error;
+    return Py_BuildValue("(NNN)", result, comp, qual);
+
+error:
+    Py_DECREF(result);
+    if(comp) Py_DECREF(comp);
+    return NULL;
+}
+
+//A list of the dictionaries of each mask of a lane (see statsDict()), returns NULL on error
+PyObject *maskedDicts(laneStats *s) {
+    PyObject *rv = PyList_New(s->nMasks), *d;
+    int i;
+
+    if(!rv) return NULL;
+    for(i=0; i<s->nMasks; i++) {
+        d = statsDict(s->masked + i);
+        if(!d) {
+            Py_DECREF(rv);
+            return NULL;
+        }
+        PyList_SET_ITEM(rv, i, d);
+    }
+    return rv;
+}
+
+//The dictionary of a decoded lane (see statsDict()), or with masks the list of them, with its cycle statistics if requested. s is freed
+PyObject *laneResult(laneStats *s, int nCycles, int cycleStats) {
+    uint64_t *composition = s->composition, *quality = s->quality;
+    PyObject *rv;
+
+    //statsDict() and freeLaneStats() would free these
+    s->composition = NULL;
+    s->quality = NULL;
+    if(s->masked) {
+        rv = withCycleStats(maskedDicts(s), composition, quality, nCycles, cycleStats);
+        freeLaneStats(s);
+    } else {
+        rv = withCycleStats(statsDict(s), composition, quality, nCycles, cycleStats);
+    }
+    if(composition) free(composition);
+    if(quality) free(quality);
+    return rv;
+}
+
+static PyObject *pyGetStats(PyObject *self, PyObject *args, PyObject *kwds) {
+    static char *kwlist[] = {"path", "runType", "cycles", "lane", "threads", "sampleSize", "threshold", "tileStride", "randomTiles", "seed", "bothSurfaces", "cycleStats", NULL};
+    char *basePath = NULL;
+    char *runType = NULL;
+    PyObject *listObj = NULL, *rv = NULL;
+    int lane = 1, sampleSize = MINCLUSTERS;
+    int *cycles = NULL, nCycles;
+    laneStats s;
+    decodeOpts opts;
+
+    initOpts(&opts);
+    memset(&s, 0, sizeof(laneStats));
+    if(!(PyArg_ParseTupleAndKeywords(args, kwds, "ssO|iiidiiIpp", kwlist, &basePath, &runType, &listObj, &lane, &(opts.threads),
+                                     &sampleSize, &(opts.threshold), &(opts.tileStride), &(opts.randomTiles), &(opts.seed), &(opts.bothSurfaces),
+                                     &(opts.cycleStats)))) {
+        PyErr_SetString(PyExc_RuntimeError, "You must supply at least a path, a run type and a list of cycles.");
         return NULL;
     }
 
+    if(!checkRunType(runType)) return NULL;
+    if(!checkOpts(&opts, sampleSize)) return NULL;
+
     if(lane < 1 || lane > 8) {
         PyErr_SetString(PyExc_RuntimeError, "You have specified an illegal lane (only values between 1 and 8 are acceptable for currently existing machines");
         return NULL;
     }
 
     //set up the bounds
-    if(PySequence_Check(listObj)) nCycles = PySequence_Size(listObj);
-    else nCycles = PySequence_Size(listObj);
-    cycles = malloc(nCycles * sizeof(int));
-    if(!cycles) {
+    cycles = intSequence(listObj, &nCycles, "cycles");
+    if(!cycles) return NULL;
+    if(!checkCycles(nCycles)) {
+        free(cycles);
+        return NULL;
+    }
+
+    //The BCL files are decoded without holding the GIL, so other threads can continue
+    s.lane = lane;
+    Py_BEGIN_ALLOW_THREADS
+    decodeLane(basePath, runType, nCycles, cycles, &opts, &s);
+    Py_END_ALLOW_THREADS
+    free(cycles);
+    if(s.nBarcodes < 0) {
+        freeLaneStats(&s);
+        PyErr_SetString(PyExc_RuntimeError, "Received an error while parsing the BCL files!");
+        return NULL;
+    }
+
+    rv = laneResult(&s, nCycles, opts.cycleStats);
+    if(!rv) PyErr_SetString(PyExc_RuntimeError, "Received an error while parsing the BCL files!");
+    return rv;
+}
+
+//Convert a sequence of cycle subsets to positions in cycles (opts->masks), returns 0 (with an exception set) on error
+int maskPositions(PyObject *masksObj, int nCycles, int *cycles, decodeOpts *opts) {
+    PyObject *item = NULL;
+    int *mask, i, j, k;
+
+    if(!PySequence_Check(masksObj)) {
+        PyErr_SetString(PyExc_RuntimeError, "The masks must be a list of lists of cycles.");
+        return 0;
+    }
+    opts->nMasks = PySequence_Size(masksObj);
+    opts->maskLens = calloc(opts->nMasks > 0 ? opts->nMasks : 1, sizeof(int));
+    opts->masks = calloc(opts->nMasks > 0 ? opts->nMasks : 1, sizeof(int*));
+    if(!opts->maskLens || !opts->masks) {
         PyErr_SetString(PyExc_RuntimeError, "Ran out of memory!");
+        return 0;
+    }
+    for(i=0; i<opts->nMasks; i++) {
+        item = PySequence_GetItem(masksObj, i);
+        if(!item) return 0;
+        mask = intSequence(item, opts->maskLens + i, "cycles of each mask");
+        Py_DECREF(item);
+        if(!mask) return 0;
+        opts->masks[i] = mask;
+        if(!checkCycles(opts->maskLens[i])) return 0;
+        for(j=0; j<opts->maskLens[i]; j++) {
+            for(k=0; k<nCycles; k++) {
+                if(cycles[k] == mask[j]) break;
+            }
+            if(k == nCycles) {
+                PyErr_SetString(PyExc_RuntimeError, "Every cycle in the masks must also be in the cycles.");
+                return 0;
+            }
+            mask[j] = k;
+        }
+    }
+    return 1;
+}
+
+void freeMasks(decodeOpts *opts) {
+    int i;
+    if(opts->masks) {
+        for(i=0; i<opts->nMasks; i++) {
+            if(opts->masks[i]) free(opts->masks[i]);
+        }
+        free(opts->masks);
+    }
+    if(opts->maskLens) free(opts->maskLens);
+    opts->masks = NULL;
+    opts->maskLens = NULL;
+    opts->nMasks = 0;
+}
+
+static PyObject *pyGetStatsMulti(PyObject *self, PyObject *args, PyObject *kwds) {
+    static char *kwlist[] = {"path", "runType", "cycles", "lanes", "threads", "sampleSize", "threshold", "tileStride", "randomTiles", "seed", "bothSurfaces", "cycleStats", "masks", NULL};
+    char *basePath = NULL;
+    char *runType = NULL;
+    char msg[128];
+    PyObject *cyclesObj = NULL, *lanesObj = NULL, *masksObj = NULL, *rv = NULL, *d = NULL;
+    int *cycles = NULL, *lanes = NULL, nCycles, nLanes = 1, nThreads = 0, sampleSize = MINCLUSTERS, i, failed = -1;
+    laneStats *stats = NULL;
+    pthread_t *threads = NULL;
+    laneQueue q;
+
+    initOpts(&(q.opts));
+    if(!(PyArg_ParseTupleAndKeywords(args, kwds, "ssO|OiidiiIppO", kwlist, &basePath, &runType, &cyclesObj, &lanesObj, &nThreads,
+                                     &sampleSize, &(q.opts.threshold), &(q.opts.tileStride), &(q.opts.randomTiles), &(q.opts.seed), &(q.opts.bothSurfaces),
+                                     &(q.opts.cycleStats), &masksObj))) {
+        PyErr_SetString(PyExc_RuntimeError, "You must supply at least a path, a run type and a list of cycles.");
         return NULL;
     }
-    for(i=0; i<nCycles; i++) {
-        if(PySequence_Check(listObj)) item = PySequence_GetItem(listObj, i);
-        else item = PyList_GET_ITEM(listObj, i);
-        if(!PyLong_Check(item)) goto error;
-        cycles[i] = (int) PyLong_AsLong(item);
+
+    if(!checkRunType(runType)) return NULL;
+    if(!checkOpts(&(q.opts), sampleSize)) return NULL;
+
+    cycles = intSequence(cyclesObj, &nCycles, "cycles");
+    if(!cycles) return NULL;
+    if(!checkCycles(nCycles)) goto error;
+    if(masksObj && masksObj != Py_None && !maskPositions(masksObj, nCycles, cycles, &(q.opts))) goto error;
+    if(lanesObj && lanesObj != Py_None) {
+        lanes = intSequence(lanesObj, &nLanes, "lanes");
+        if(!lanes) goto error;
+    } else {
+        lanes = malloc(sizeof(int));
+        if(!lanes) goto oom;
+        lanes[0] = 1;
+    }
+    for(i=0; i<nLanes; i++) {
+        if(lanes[i] < 1 || lanes[i] > 8) {
+            PyErr_SetString(PyExc_RuntimeError, "You have specified an illegal lane (only values between 1 and 8 are acceptable for currently existing machines");
+            goto error;
+        }
+    }
+    //Any threads beyond one per lane inflate the CBCL files of each lane
+    if(nThreads < 1) nThreads = nLanes;
+    if(nThreads > nLanes) {
+        q.opts.threads = nThreads / nLanes;
+        nThreads = nLanes;
     }
 
-    if(strcmp(runType, "NextSeq") == 0) nBarcodes = handleNextSeq(basePath, nCycles, cycles, &barcodes, &frequencies);
-    else if(strcmp(runType, "NovaSeq") == 0) nBarcodes = handleNovaSeq(basePath, lane, nCycles, cycles, &barcodes, &frequencies);
-    else if(strcmp(runType, "HiSeq3000") == 0 || \
-            strcmp(runType, "HiSeq4000") == 0 || \
-            strcmp(runType, "HiSeqX") == 0) nBarcodes = handleHiSeq(basePath, lane, nCycles, 2, 28, cycles, &barcodes, &frequencies);
-    else if(strcmp(runType, "HiSeq2500") == 0 || \
-            strcmp(runType, "HiSeq2000") == 0) nBarcodes = handleHiSeq(basePath, lane, nCycles, 2, 16, cycles, &barcodes, &frequencies);
-    else if(strcmp(runType, "MiSeq") == 0) nBarcodes = handleHiSeq(basePath, 1, nCycles, 1, 19, cycles, &barcodes, &frequencies);
-    if(nBarcodes < 0) printf("The number of barcodes is %i\n", nBarcodes);
-    if(nBarcodes < 0) goto error;
+    stats = calloc(nLanes > 0 ? nLanes : 1, sizeof(laneStats));
+    threads = calloc(nThreads > 0 ? nThreads : 1, sizeof(pthread_t));
+    if(!stats || !threads) goto oom;
+    for(i=0; i<nLanes; i++) {
+        stats[i].lane = lanes[i];
+        stats[i].nBarcodes = -1;
+    }
 
-    // Create a dictionary with barcodes as keys and frequencies as views
-    rv = PyDict_New();
-    if(!rv) printf("No new dictionary\n");
+    q.basePath = basePath;
+    q.runType = runType;
+    q.nCycles = nCycles;
+    q.cycles = cycles;
+    q.nLanes = nLanes;
+    q.next = 0;
+    q.stats = stats;
+    pthread_mutex_init(&(q.lock), NULL);
+
+    //Nothing below touches python objects until the threads are joined
+    Py_BEGIN_ALLOW_THREADS
+    for(i=0; i<nThreads; i++) {
+        if(pthread_create(threads + i, NULL, laneWorker, &q)) break;
+    }
+    nThreads = i;
+    //If no thread could be started, do the work here
+    if(nThreads == 0) laneWorker(&q);
+    for(i=0; i<nThreads; i++) pthread_join(threads[i], NULL);
+    Py_END_ALLOW_THREADS
+    pthread_mutex_destroy(&(q.lock));
+
+    for(i=0; i<nLanes; i++) {
+        if(stats[i].nBarcodes < 0) {
+            failed = stats[i].lane;
+            break;
+        }
+    }
+    if(failed > 0) {
+        snprintf(msg, 128, "Received an error while parsing the BCL files of lane %i!", failed);
+        PyErr_SetString(PyExc_RuntimeError, msg);
+        goto error;
+    }
+
+    rv = PyList_New(nLanes);
     if(!rv) goto error;
-    if(nBarcodes) {
-        for(i=0; i<nBarcodes; i++) {
-            key = PyString_FromString(barcodes[i]);
-            if(!key) goto error;
-            value = PyFloat_FromDouble((double) frequencies[i]);
-            if(!value) goto error;
-            if(PyDict_SetItem(rv, key, value)) goto error;
-            free(barcodes[i]);
+    for(i=0; i<nLanes; i++) {
+        d = laneResult(stats + i, nCycles, q.opts.cycleStats);
+        if(!d) {
+            PyErr_SetString(PyExc_RuntimeError, "Received an error while parsing the BCL files!");
+            goto error;
         }
-        free(barcodes);
-        free(frequencies);
+        PyList_SET_ITEM(rv, i, d);
     }
-    free(cycles);
 
+    free(stats);
+    free(threads);
+    free(cycles);
+    free(lanes);
+    freeMasks(&(q.opts));
     return rv;
 
+oom:
+    PyErr_SetString(PyExc_RuntimeError, "Ran out of memory!");
 error:
-    PyErr_SetString(PyExc_RuntimeError, "Received an error while parsing the BCL files!");
+    if(stats) {
+        for(i=0; i<nLanes; i++) freeLaneStats(stats + i);
+        free(stats);
+    }
+    if(threads) free(threads);
     if(cycles) free(cycles);
-    if(barcodes) free(barcodes);
-    if(frequencies) free(frequencies);
+    if(lanes) free(lanes);
+    freeMasks(&(q.opts));
     if(rv) Py_DECREF(rv);
-    if(key) Py_DECREF(key);
-    if(value) Py_DECREF(value);
-
     return NULL;
 }
 
+static PyObject *pyGetBaseCalls(PyObject *self, PyObject *args, PyObject *kwds) {
+    static char *kwlist[] = {"path", "runType", "cycles", "lane", "threads", "sampleSize", "tileStride", "randomTiles", "seed", "bothSurfaces", "cycleStats", NULL};
+    char *basePath = NULL;
+    char *runType = NULL;
+    PyObject *listObj = NULL, *calls = NULL, *numpy = NULL, *arr = NULL, *rv = NULL;
+    int lane = 1, sampleSize = MINCLUSTERS, good;
+    int *cycles = NULL, nCycles;
+    decodeOpts opts;
+    bcSink sink;
+
+    initOpts(&opts);
+    memset(&sink, 0, sizeof(bcSink));
+    if(!(PyArg_ParseTupleAndKeywords(args, kwds, "ssO|iiiiiIpp", kwlist, &basePath, &runType, &listObj, &lane, &(opts.threads),
+                                     &sampleSize, &(opts.tileStride), &(opts.randomTiles), &(opts.seed), &(opts.bothSurfaces),
+                                     &(opts.cycleStats)))) {
+        PyErr_SetString(PyExc_RuntimeError, "You must supply at least a path, a run type and a list of cycles.");
+        return NULL;
+    }
+
+    if(!checkRunType(runType)) return NULL;
+    if(!checkOpts(&opts, sampleSize)) return NULL;
+
+    if(lane < 1 || lane > 8) {
+        PyErr_SetString(PyExc_RuntimeError, "You have specified an illegal lane (only values between 1 and 8 are acceptable for currently existing machines");
+        return NULL;
+    }
+
+    cycles = intSequence(listObj, &nCycles, "cycles");
+    if(!cycles) return NULL;
+    if(!checkCycles(nCycles)) goto cleanup;
+
+    //The calls are decoded straight into a bytearray, which is shrunk to fit afterward
+    calls = PyByteArray_FromStringAndSize(NULL, (Py_ssize_t) sampleSize * nCycles);
+    if(!calls) goto cleanup;
+    if(opts.cycleStats) {
+        sink.composition = calloc(nCycles * NCALLS, sizeof(uint64_t));
+        sink.quality = calloc(nCycles * NQUALS, sizeof(uint64_t));
+        if(!sink.composition || !sink.quality) {
+            PyErr_SetString(PyExc_RuntimeError, "Ran out of memory!");
+            goto cleanup;
+        }
+    }
+    sink.calls = (uint8_t*) PyByteArray_AS_STRING(calls);
+    sink.nCycles = nCycles;
+    sink.capacity = sampleSize;
+
+    //Nothing else can reference the bytearray yet, so it's safe to fill it without the GIL
+    Py_BEGIN_ALLOW_THREADS
+    good = sampleLane(basePath, runType, lane, nCycles, cycles, &opts, &sink);
+    Py_END_ALLOW_THREADS
+    if(good < 0) {
+        PyErr_SetString(PyExc_RuntimeError, "Received an error while parsing the BCL files!");
+        goto cleanup;
+    }
+
+    //numpy is only needed here, so it isn't imported with the module
+    numpy = PyImport_ImportModule("numpy");
+    if(!numpy) goto cleanup;
+    if(sink.n == 0) {
+        //Nothing passed filter, an empty buffer can't be viewed as rows of cycles
+        rv = PyObject_CallMethod(numpy, "zeros", "(ii)s", 0, nCycles, "uint8");
+    } else {
+        if(PyByteArray_Resize(calls, (Py_ssize_t) sink.n * nCycles)) goto cleanup;
+        //The array uses the bytearray's buffer, so the calls aren't copied
+        arr = PyObject_CallMethod(numpy, "frombuffer", "Os", calls, "uint8");
+        if(!arr) goto cleanup;
+        rv = PyObject_CallMethod(arr, "reshape", "ii", (int) sink.n, nCycles);
+    }
+    rv = withCycleStats(rv, sink.composition, sink.quality, nCycles, opts.cycleStats);
+
+cleanup:
+    if(sink.composition) free(sink.composition);
+    if(sink.quality) free(sink.quality);
+    if(arr) Py_DECREF(arr);
+    if(numpy) Py_DECREF(numpy);
+    if(calls) Py_DECREF(calls);
+    if(cycles) free(cycles);
+    return rv;
+}
+
 #if PY_MAJOR_VERSION >= 3
 PyMODINIT_FUNC PyInit_pyBarcodes(void) {
 #else
@@ -782,6 +1706,7 @@ PyMODINIT_FUNC initpyBarcodes(void) {
 #endif
 
     PyModule_AddStringConstant(res, "__version__", pyBarcodesVersion);
+    PyModule_AddIntConstant(res, "N", BASECALLN);
 
 #if PY_MAJOR_VERSION >= 3
     return res;
@@ -3,7 +3,7 @@ from setuptools import setup, Extension
 from distutils import sysconfig
 
 srcs = ["pyBarcodes.c"]
-libs=["z"]
+libs=["z", "pthread"]
 if sysconfig.get_config_vars('BLDLIBRARY') is not None:
     #Note the "-l" prefix!
     for e in sysconfig.get_config_vars('BLDLIBRARY')[0].split():
@@ -27,7 +27,7 @@ setup(name = 'bcl2fastq_pipeline',
        description = 'bcl2fastq_pipeline',
        author = "Devon P. Ryan",
        author_email = "ryan@ie-freiburg.mpg.de",
-       scripts = ['bin/bfq.py', 'bin/renameProject.py'],
+       scripts = ['bin/bfq.py', 'bin/renameProject.py', 'bin/fakeBatch.py', 'bin/checkImportTime.py'],
        packages = ['bcl2fastq_pipeline'],
        include_package_data = False,
        install_requires = ['configparser',